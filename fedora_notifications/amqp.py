@@ -3,9 +3,11 @@
 # Copyright (C) 2018 Red Hat, Inc.
 import logging
 
-from fedora_messaging import _session, exceptions as fml_exceptions
+from fedora_messaging import _session, config as fml_config, exceptions as fml_exceptions
+import pika
 
-from . import config
+from . import config, db, exceptions
+from .db import models
 
 
 _log = logging.getLogger(__name__)
@@ -45,3 +47,108 @@ def create_queues_with_bindings(queues):
             _log.warning(
                 "Failed to create the %r queue with bindings: %s", queue.id, str(e)
             )
+
+
+def convert_severity_bindings(page_size=1000):
+    """
+    Move the header bindings of every queue to the topology the
+    ``SEVERITY_EXCHANGES`` setting selects.
+
+    The severity exchanges are declared and bound to ``amq.match`` first. Then
+    each queue gets its new bindings before its old ones are removed, so it
+    doesn't miss messages while it's converted, although it may get a few
+    twice. Queues that don't exist on the broker are left for the delivery
+    service to declare.
+
+    Args:
+        page_size (int): The number of queues to load from the database at a time.
+
+    Returns:
+        tuple: The number of queues converted and the number that don't exist.
+    """
+    tiered = config.conf["SEVERITY_EXCHANGES"]
+    converted = missing = 0
+    connection = pika.BlockingConnection(pika.URLParameters(fml_config.conf["amqp_url"]))
+    try:
+        channel = connection.channel()
+        for exchange in models.severity_exchanges():
+            channel.exchange_declare(**exchange)
+        for binding in models.severity_exchange_bindings():
+            channel.exchange_bind(**binding)
+        after = None
+        while True:
+            queues = db.Queue.query.with_bindings().page(after, page_size).all()
+            if not queues:
+                break
+            after = queues[-1].id
+            for queue in queues:
+                try:
+                    channel.queue_declare(queue.name, passive=True)
+                except pika.exceptions.ChannelClosed:
+                    # The broker closes the channel when the queue doesn't exist
+                    channel = connection.channel()
+                    missing += 1
+                    continue
+                for header in queue.header_bindings:
+                    for binding in models.header_bindings(
+                        queue.name, header.key_name, header.severity, tiered
+                    ):
+                        channel.queue_bind(
+                            binding["queue"],
+                            binding["exchange"],
+                            routing_key=binding["routing_key"],
+                            arguments=binding["arguments"],
+                        )
+                    for binding in models.header_bindings(
+                        queue.name, header.key_name, header.severity, not tiered
+                    ):
+                        channel.queue_unbind(
+                            binding["queue"],
+                            binding["exchange"],
+                            routing_key=binding["routing_key"],
+                            arguments=binding["arguments"],
+                        )
+                queue.topology = queue.applied_topology = queue.fingerprint()
+                converted += 1
+            # Queues that weren't converted still need a fingerprint for the new topology
+            for queue in queues:
+                queue.topology = queue.fingerprint()
+            db.Session.commit()
+            _log.info("Converted the bindings of %d queues", converted)
+        db.Session.merge(db.AppliedTopology(id=1, severity_exchanges=tiered))
+        db.Session.commit()
+    finally:
+        db.Session.remove()
+        connection.close()
+    return converted, missing
+
+
+def check_exchange_mode():
+    """
+    Check the bindings on the broker were declared in the exchange mode the
+    ``SEVERITY_EXCHANGES`` setting selects.
+
+    The queues' applied topology fingerprints describe bindings in the mode
+    that was recorded with them, so if the setting is changed without running
+    ``fedora-notifications convert-bindings``, the delivery service would leave
+    the old bindings in place. If no mode is recorded yet, the setting is.
+
+    Raises:
+        exceptions.ConfigurationError: If the setting doesn't match the recorded mode.
+    """
+    tiered = config.conf["SEVERITY_EXCHANGES"]
+    try:
+        applied = db.AppliedTopology.query.get(1)
+        if applied is None:
+            db.Session.add(db.AppliedTopology(id=1, severity_exchanges=tiered))
+            db.Session.commit()
+        elif applied.severity_exchanges != tiered:
+            raise exceptions.ConfigurationError(
+                '"SEVERITY_EXCHANGES" is {}, but the bindings on the broker were declared '
+                'with it {}; run "fedora-notifications convert-bindings" to move them '
+                "over".format(
+                    "on" if tiered else "off", "on" if applied.severity_exchanges else "off"
+                )
+            )
+    finally:
+        db.Session.remove()
@@ -54,3 +54,48 @@ def createdb(alembic_ini):
     with connectable.connect() as connection:
         db.Base.metadata.create_all(connection)
         command.stamp(alembic_config.Config(alembic_ini), "head")
+
+
+@cli.command()
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="The number of worker processes; defaults to the delivery_workers setting.",
+)
+def deliver(workers):
+    """Run the delivery service."""
+    from . import amqp
+    from .delivery import workers as delivery_workers
+
+    engine = db.initialize(config.conf)
+    try:
+        amqp.check_exchange_mode()
+    except exceptions.ConfigurationError as e:
+        raise click.ClickException(str(e))
+    finally:
+        engine.dispose()
+    workers = workers or config.conf["DELIVERY_WORKERS"]
+    if workers == 1:
+        delivery_workers.run()
+    else:
+        delivery_workers.supervise(workers)
+
+
+@cli.command("convert-bindings")
+@click.option(
+    "--page-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    help="The number of queues to load from the database at a time.",
+)
+def convert_bindings(page_size):
+    """Move header bindings to the topology the severity_exchanges setting selects."""
+    from . import amqp
+
+    db.initialize(config.conf)
+    converted, missing = amqp.convert_severity_bindings(page_size)
+    click.echo(
+        "Converted {} queues; {} queues don't exist on the broker and will be "
+        "declared by the delivery service".format(converted, missing)
+    )
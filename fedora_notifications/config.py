@@ -29,6 +29,235 @@ The number of consumers per connection to the broker. Each consumer uses a
 channel, and each connection typically has a channel limit. Set this well below
 the channel limit. Defaults to 1000.
 
+.. _conf-delivery-workers:
+
+delivery_workers
+----------------
+The number of worker processes ``fedora-notifications deliver`` runs. Each
+worker consumes a share of the queues, so several workers can use several CPU
+cores. The default is 1.
+
+.. _conf-worker-id:
+
+worker_id
+---------
+The ID this delivery service uses when it shares the queues with other
+workers. Workers record heartbeats in the database, and each queue is consumed
+by exactly one of the live workers. If a worker stops, the others take over its
+queues. The ID must be unique, and should stay the same when the service
+restarts. Workers started by ``fedora-notifications deliver`` are named after
+this setting, or the host name if it's empty, and their index.
+
+The default is ``""``, which means the service consumes every queue.
+
+.. _conf-worker-index:
+
+worker_index
+------------
+The index of this worker when the queues are shared between workers. Workers
+use it to pick IRC nicknames that don't clash with each other's. Workers
+started by ``fedora-notifications deliver`` set it themselves.
+
+The default is 0.
+
+.. _conf-worker-heartbeat-interval:
+
+worker_heartbeat_interval
+-------------------------
+The number of seconds between heartbeats of workers that share the queues.
+The default is 10.
+
+.. _conf-worker-timeout:
+
+worker_timeout
+--------------
+The number of seconds without a heartbeat after which a worker is assumed to
+have stopped and its queues are shared out between the others. The clocks of
+hosts running workers must be kept in sync. The default is 30.
+
+.. _conf-queue-load-page-size:
+
+queue_load_page_size
+--------------------
+The number of queues the delivery service loads from the database at a time
+when it starts. It starts consuming each page of queues while it loads the
+next. The default is 1000.
+
+.. _conf-queue-load-retry-interval:
+
+queue_load_retry_interval
+-------------------------
+The number of seconds the delivery service waits before trying again when it
+fails to load a page of queues from the database at startup. The default is 10.
+
+.. _conf-database-threads:
+
+database_threads
+----------------
+The number of threads the delivery service runs database queries in. Queries
+run outside the reactor thread so they don't hold up deliveries, and each
+thread uses one database connection at a time. The default is 4.
+
+.. _conf-severity-exchanges:
+
+severity_exchanges
+------------------
+Whether to route messages by severity through a headers exchange per severity.
+Normally a subscription is bound to ``amq.match`` once for each severity it
+wants, so up to four bindings, and the broker checks every binding for every
+message. When this is on, ``amq.match`` is bound to one exchange per severity,
+and each gets the messages at that severity and above. Each subscription is
+then a single binding to the exchange for its lowest severity. After changing
+this, run ``fedora-notifications convert-bindings`` to move the existing
+bindings over; the delivery service refuses to start until it has been run.
+The default is ``false``.
+
+.. _conf-delivery-mode:
+
+delivery_mode
+-------------
+How the delivery service receives messages. With ``"queues"``, every user
+queue has its own bindings and the delivery service consumes each one. With
+``"shared"``, the delivery service consumes a single shared queue (see
+:ref:`conf-shared-queue`) and works out which users each message is for itself,
+so the broker doesn't need a queue and bindings per user. Queues that are
+delivered in batches still have their own queue in either mode. The default is
+``"queues"``.
+
+.. _conf-shared-queue:
+
+shared_queue
+------------
+The name of the queue consumed in the shared delivery mode. The default is
+``"fedora-notifications-shared"``.
+
+.. _conf-shared-queue-bindings:
+
+shared_queue_bindings
+---------------------
+The bindings of the shared queue, as a list of tables with ``exchange`` and
+``routing_key`` keys. They should route every message a user could subscribe to
+into the queue. The default binds it to every topic on ``amq.topic``.
+
+.. _conf-breaker-failure-threshold:
+
+breaker_failure_threshold
+-------------------------
+The number of consecutive deliveries that must fail because a backend (the SMTP
+server or the IRC server) is unreachable before the delivery service pauses
+deliveries to that backend. Paused deliveries wait, and their messages stay in
+their queues, until the backend can be reached again.
+
+The default is 5.
+
+.. _conf-breaker-reset-timeout:
+
+breaker_reset_timeout
+---------------------
+The number of seconds between attempts to reach a backend after deliveries to
+it have been paused. Deliveries resume once the backend can be reached.
+
+The default is 30.
+
+.. _conf-batch-max-messages:
+
+batch_max_messages
+------------------
+The maximum number of notifications to include in a single digest for queues
+that are delivered in batches. If a queue holds more than this when it is due,
+the remainder is sent in additional digests right away.
+
+The default is 500.
+
+.. _conf-batch-concurrency:
+
+batch_concurrency
+-----------------
+The maximum number of batched queues to drain at the same time.
+
+The default is 10.
+
+.. _conf-render-cache-size:
+
+render_cache_size
+-----------------
+The maximum size, in bytes, of the rendered notifications (subjects and bodies)
+to keep in memory. A message is often delivered to many users, so it is
+rendered once and reused for each of them while it's in the cache. Set this to
+0 to disable the cache.
+
+The default is 67108864 (64 MiB).
+
+.. _conf-spool-enabled:
+
+spool_enabled
+-------------
+A boolean to control whether messages are spooled to local disk before they're
+delivered. When enabled, a message is acknowledged to the broker as soon as it
+has been written to the spool, and the spool feeds the messages to the IRC and
+email backends. Anything left in the spool when the service stops is delivered
+when it starts again. Messages from batched queues aren't spooled.
+
+The default is ``False``.
+
+.. _conf-spool-directory:
+
+spool_directory
+---------------
+The directory to keep the spool in. It's created if it doesn't exist.
+
+The default is ``/var/spool/fedora-notifications``.
+
+.. _conf-spool-segment-size:
+
+spool_segment_size
+------------------
+The spool is made of segment files, which are deleted once all the messages in
+them have been delivered. This is the size in bytes at which a new segment is
+started.
+
+The default is 67108864 (64 MiB).
+
+.. _conf-spool-sync-interval:
+
+spool_sync_interval
+-------------------
+The number of milliseconds to collect writes to the spool for before flushing
+them to disk with a single ``fsync``. Messages are acknowledged once they have
+been flushed, so this trades acknowledgement latency for fewer ``fsync`` calls.
+
+The default is 50.
+
+.. _conf-spool-max-in-flight:
+
+spool_max_in_flight
+-------------------
+The maximum number of spooled messages being delivered at once.
+
+The default is 100.
+
+.. _conf-spool-retry-interval:
+
+spool_retry_interval
+--------------------
+The number of seconds to stop delivering spooled messages for after a delivery
+fails because a backend is unavailable. The failed message is put back in the
+spool.
+
+The default is 30.
+
+.. _conf-spool-max-attempts:
+
+spool_max_attempts
+------------------
+The number of times to try delivering a spooled message. Once a message has
+failed this many times, or as soon as the SMTP server rejects it with a
+permanent (5xx) error, it's moved to the dead-letter queue (see
+:ref:`conf-retry-max-attempts`) rather than put back in the spool. If email
+delivery is disabled there's no dead-letter queue, and the message is discarded.
+
+The default is 10.
+
 .. _conf-queue-expires:
 
 queue_expires
@@ -56,6 +285,64 @@ messages are dropped from the head of the queue to accommodate new messages.
 The default is unlimited.
 
 
+.. _conf-database:
+
+Database Configuration
+======================
+
+Settings for the connections to the database. The connection pool settings
+apply to the primary database and to each replica, in each process. They don't
+apply to SQLite databases.
+
+.. _conf-database-pool-size:
+
+database_pool_size
+------------------
+The number of connections to keep open to each database. The default is 5.
+
+.. _conf-database-max-overflow:
+
+database_max_overflow
+---------------------
+The number of connections that can be opened beyond ``database_pool_size``
+when they're all in use. They're closed as soon as they're returned. The
+default is 10.
+
+.. _conf-database-pool-timeout:
+
+database_pool_timeout
+---------------------
+The number of seconds to wait for a connection when they're all in use before
+giving up. The time spent waiting is reported in the delivery service's
+statistics. The default is 30.
+
+.. _conf-database-pool-recycle:
+
+database_pool_recycle
+---------------------
+The number of seconds after which a connection is replaced, so connections
+aren't closed by the database server or a proxy for being idle. ``-1`` keeps
+connections forever. The default is 3600.
+
+.. _conf-database-pool-pre-ping:
+
+database_pool_pre_ping
+----------------------
+Whether to check that a connection still works before using it, and replace it
+if it doesn't. This costs a round trip each time a connection is taken from the
+pool. The default is ``true``.
+
+.. _conf-database-replica-urls:
+
+database_replica_urls
+---------------------
+The URLs of read-only replicas of the database. Queries that can tolerate
+replication lag, such as listing the queues and loading them when the delivery
+service starts, are spread over the replicas; everything else uses
+``database_url``. The default is ``[]``, which sends every query to
+``database_url``.
+
+
 .. _conf-irc:
 
 IRC Notifications
@@ -96,6 +383,133 @@ The password to use when identifying to NickServ.
 
 The default is ``None``.
 
+.. _conf-irc-connections:
+
+irc_connections
+---------------
+The number of connections to make to the IRC server. IRC servers apply their
+flood limits per connection, so more connections allow more notifications per
+second. Each connection uses its own nickname: the first uses ``irc_nick`` and
+the others append their number to it, so with the default nick they are
+``fedora-notif``, ``fedora-notif1``, ``fedora-notif2``, and so on. If
+``irc_password`` is set, it's used to identify every nickname. Recipients are
+spread across the connections, and each recipient's notifications always go
+through the same connection while it's connected, so they arrive in order.
+
+The default is 1.
+
+.. _conf-irc-coalesce-window:
+
+irc_coalesce_window
+-------------------
+The number of seconds to collect notifications to the same IRC recipient for
+before merging them onto as few lines as possible. The first notification in a
+quiet period is sent right away; the ones that follow it within the window are
+merged. Set this to 0 to send every notification on its own line.
+
+A notification isn't acknowledged until the line it was merged onto has been
+sent. Since each IRC queue is consumed one message at a time, notifications
+from a user's own queue are only merged when several are delivered at once:
+from the spool (see :ref:`conf-spool-enabled`) or in a digest.
+
+The default is 3.
+
+.. _conf-irc-coalesce-max-lines:
+
+irc_coalesce_max_lines
+----------------------
+The maximum number of lines of merged notifications to send to a recipient
+when a coalescing window closes. Notifications that don't fit are summarized
+in a final "...and N more" line.
+
+The default is 3.
+
+.. _conf-irc-fanout-window:
+
+irc_fanout_window
+-----------------
+The number of milliseconds to collect identical IRC notifications to different
+recipients for, so they can be sent as a single message to several targets.
+The first recipient is sent the notification right away; the ones that follow
+within the window are sent it together when the window closes. How many
+targets fit in one message depends on the server's ``TARGMAX`` or
+``MAXTARGETS`` and the length of the notification. Set this to 0 to send every
+notification separately.
+
+The default is 500.
+
+.. _conf-irc-max-buffered:
+
+irc_max_buffered
+----------------
+The maximum number of lines, and notifications waiting to be coalesced, that
+each IRC connection buffers before it's sent. A message is only acknowledged
+once it has been written to the server, and when the buffer is full, IRC
+deliveries wait until it has drained to half this size.
+
+The default is 500.
+
+.. _conf-irc-offline-policy:
+
+irc_offline_policy
+------------------
+What to do with IRC notifications to nicks that are offline. The client tracks
+whether recipients are online using the server's ``MONITOR`` support, or by
+polling with ``ISON`` every ``irc_presence_interval`` seconds. It's one of:
+
+* ``"send"``: don't track presence and send every notification.
+* ``"drop"``: discard notifications to offline nicks.
+* ``"park"``: put notifications to offline nicks in the delayed retry queues
+  (see :ref:`conf-retry-delays`), so they're delivered again later. A
+  notification that's still undeliverable after ``retry_max_attempts`` is
+  moved to the dead-letter queue.
+
+Notifications to nicks whose status isn't known yet, and to channels, are
+always sent. The default is ``"drop"``.
+
+.. _conf-irc-presence-interval:
+
+irc_presence_interval
+---------------------
+The number of seconds between ``ISON`` polls of recipients who can't be
+monitored with ``MONITOR``. The default is 60.
+
+.. _conf-irc-presence-max-nicks:
+
+irc_presence_max_nicks
+----------------------
+The maximum number of recipients each IRC connection tracks the presence of.
+The recipients that were sent a notification least recently are forgotten
+first. The default is 10000.
+
+.. _conf-irc-send-burst:
+
+irc_send_burst
+--------------
+The number of lines that can be sent to the IRC server back to back before the
+client slows down to ``irc_send_rate``. Set this to match the server's flood
+limits.
+
+The default is 5.
+
+.. _conf-irc-send-rate:
+
+irc_send_rate
+-------------
+The sustained number of lines per second sent to the IRC server.
+
+The default is 2.
+
+.. _conf-irc-send-byte-cost:
+
+irc_send_byte_cost
+------------------
+Many IRC servers penalize long lines more than short ones. Each byte of a line
+counts as this fraction of a line towards ``irc_send_burst`` and
+``irc_send_rate``. Set this to 0 to treat every line the same.
+
+The default is 0.002 (a 500 byte line counts as two lines).
+
 .. _conf-email:
 
 Email Notifications
@@ -119,6 +533,51 @@ The "From" address used in email notifications.
 
 The default is ``notifications@localhost``.
 
+.. _conf-email-max-body-size:
+
+email_max_body_size
+-------------------
+The maximum size, in bytes, of the body of a notification. Rendering a message
+stops once its body reaches this size, and the body is truncated with a note
+saying so.
+
+The default is 500000.
+
+.. _conf-email-max-in-flight:
+
+email_max_in_flight
+-------------------
+The maximum number of emails being sent at once. When this many are in flight,
+the consumers wait for a send to complete before accepting another message, so
+a slow SMTP server causes messages to wait in the broker rather than in memory.
+
+The default is 100.
+
+.. _conf-retry-delays:
+
+retry_delays
+------------
+A list of delays, in seconds, before another attempt is made to deliver an
+email that failed for a temporary reason, such as the SMTP server being
+unreachable. Each delay is a separate AMQP queue that holds the message until
+it expires. The first retry uses the first delay, the second retry uses the
+second delay, and so on; once the list is exhausted, the last delay is used
+for every remaining retry.
+
+IRC notifications to offline nicks are retried with the same delays when
+:ref:`conf-irc-offline-policy` is ``"park"``.
+
+The default is ``[30, 300, 1800]``.
+
+.. _conf-retry-max-attempts:
+
+retry_max_attempts
+------------------
+The number of times delivery of a message is attempted before it is moved to the
+``fedora-notifications-dead-letter`` queue.
+
+The default is 10.
+
 .. _conf-smtp-server-hostname:
 
 smtp_server_hostname
@@ -127,6 +586,35 @@ The SMTP server's hostname.
 
 The default is ``localhost``.
 
+.. _conf-smtp-pool-size:
+
+smtp_pool_size
+--------------
+The maximum number of connections to keep open to the SMTP server. Each
+connection is authenticated once and then used to send many emails.
+
+The default is 4.
+
+.. _conf-smtp-pool-idle-timeout:
+
+smtp_pool_idle_timeout
+----------------------
+The number of seconds an SMTP connection can sit idle before it is closed. This
+is also how long the SMTP server has to respond to a command before the message
+is considered failed.
+
+The default is 60.
+
+.. _conf-smtp-pool-health-check-interval:
+
+smtp_pool_health_check_interval
+-------------------------------
+The number of seconds between health checks (an SMTP ``NOOP``) of idle
+connections. Connections that fail the check are closed and replaced when next
+needed. Set this to 0 to disable health checks.
+
+The default is 30.
+
 .. _conf-smtp-server-port:
 
 smtp_server_port
@@ -169,6 +657,42 @@ A Boolean indicating whether or not TLS is required for the SMTP server.
 
 The default is ``False``.
 
+.. _conf-smtp-relays:
+
+smtp_relays
+-----------
+A list of SMTP relays to spread email across. Each relay is a table with a
+``hostname`` and, optionally, a ``port`` (default 25), a ``weight`` (default 1),
+a ``username`` and ``password``, and ``require_authentication`` and
+``require_tls`` flags (default ``false``). Each relay gets its own pool of
+``smtp_pool_size`` connections. A message goes to the relay with the fewest
+messages in flight relative to its weight. A relay that can't be reached is
+left out of rotation for ``smtp_relay_retry_interval`` seconds, and its
+messages go to the other relays. For example::
+
+    [[smtp_relays]]
+    hostname = "relay1.example.com"
+    port = 587
+    weight = 2
+    require_tls = true
+
+    [[smtp_relays]]
+    hostname = "relay2.example.com"
+
+If this is empty, the single server configured with the ``smtp_server_*`` and
+``smtp_*`` settings above is used.
+
+The default is ``[]``.
+
+.. _conf-smtp-relay-retry-interval:
+
+smtp_relay_retry_interval
+-------------------------
+The number of seconds an SMTP relay that couldn't be reached is left out of
+rotation.
+
+The default is 30.
+
 .. _conf-log-config:
 """
 import logging
@@ -187,6 +711,12 @@ DEFAULTS = {
     "SECRET_KEY": "change me",
     "SQL_DEBUG": False,
     "DATABASE_URL": "sqlite:////",
+    "DATABASE_REPLICA_URLS": [],
+    "DATABASE_POOL_SIZE": 5,
+    "DATABASE_MAX_OVERFLOW": 10,
+    "DATABASE_POOL_TIMEOUT": 30,
+    "DATABASE_POOL_RECYCLE": 3600,
+    "DATABASE_POOL_PRE_PING": True,
     "QUEUE_EXPIRES": 60 * 5,
     "QUEUE_MAX_LENGTH": None,
     "QUEUE_MAX_SIZE": None,
@@ -194,15 +724,59 @@ DEFAULTS = {
     "IRC_ENDPOINT": "tcp:localhost:6667",
     "IRC_NICK": "fedora-notif",
     "IRC_PASSWORD": None,
+    "IRC_CONNECTIONS": 1,
+    "IRC_COALESCE_WINDOW": 3,
+    "IRC_COALESCE_MAX_LINES": 3,
+    "IRC_FANOUT_WINDOW": 500,
+    "IRC_MAX_BUFFERED": 500,
+    "IRC_OFFLINE_POLICY": "drop",
+    "IRC_PRESENCE_INTERVAL": 60,
+    "IRC_PRESENCE_MAX_NICKS": 10000,
+    "IRC_SEND_BURST": 5,
+    "IRC_SEND_RATE": 2,
+    "IRC_SEND_BYTE_COST": 0.002,
     "EMAIL_ENABLED": True,
     "EMAIL_FROM_ADDRESS": "notifications@localhost",
+    "EMAIL_MAX_BODY_SIZE": 500000,
+    "EMAIL_MAX_IN_FLIGHT": 100,
+    "RETRY_DELAYS": [30, 300, 1800],
+    "RETRY_MAX_ATTEMPTS": 10,
     "SMTP_SERVER_HOSTNAME": "localhost",
+    "SMTP_POOL_SIZE": 4,
+    "SMTP_POOL_IDLE_TIMEOUT": 60,
+    "SMTP_POOL_HEALTH_CHECK_INTERVAL": 30,
     "SMTP_SERVER_PORT": 25,
     "SMTP_USERNAME": None,
     "SMTP_PASSWORD": None,
     "SMTP_REQUIRE_AUTHENTICATION": False,
     "SMTP_REQUIRE_TLS": False,
+    "SMTP_RELAYS": [],
+    "SMTP_RELAY_RETRY_INTERVAL": 30,
     "CONSUMERS_PER_CONNECTION": 1000,
+    "DELIVERY_WORKERS": 1,
+    "WORKER_ID": "",
+    "WORKER_INDEX": 0,
+    "WORKER_HEARTBEAT_INTERVAL": 10,
+    "WORKER_TIMEOUT": 30,
+    "QUEUE_LOAD_PAGE_SIZE": 1000,
+    "QUEUE_LOAD_RETRY_INTERVAL": 10,
+    "DATABASE_THREADS": 4,
+    "SEVERITY_EXCHANGES": False,
+    "DELIVERY_MODE": "queues",
+    "SHARED_QUEUE": "fedora-notifications-shared",
+    "SHARED_QUEUE_BINDINGS": [{"exchange": "amq.topic", "routing_key": "#"}],
+    "BREAKER_FAILURE_THRESHOLD": 5,
+    "BREAKER_RESET_TIMEOUT": 30,
+    "BATCH_MAX_MESSAGES": 500,
+    "BATCH_CONCURRENCY": 10,
+    "RENDER_CACHE_SIZE": 64 * 1024 * 1024,
+    "SPOOL_ENABLED": False,
+    "SPOOL_DIRECTORY": "/var/spool/fedora-notifications",
+    "SPOOL_SEGMENT_SIZE": 64 * 1024 * 1024,
+    "SPOOL_SYNC_INTERVAL": 50,
+    "SPOOL_MAX_IN_FLIGHT": 100,
+    "SPOOL_RETRY_INTERVAL": 30,
+    "SPOOL_MAX_ATTEMPTS": 10,
     "LOG_CONFIG": {
         "version": 1,
         "disable_existing_loggers": False,
@@ -324,12 +898,114 @@ class LazyConfig(dict):
                 "This is NOT safe for production deployments!"
             )
 
-        for key in ("QUEUE_EXPIRES", "QUEUE_MAX_LENGTH", "QUEUE_MAX_SIZE"):
+        for key in (
+            "QUEUE_EXPIRES",
+            "QUEUE_MAX_LENGTH",
+            "QUEUE_MAX_SIZE",
+            "SMTP_POOL_IDLE_TIMEOUT",
+            "SMTP_POOL_HEALTH_CHECK_INTERVAL",
+            "RENDER_CACHE_SIZE",
+            "SPOOL_SYNC_INTERVAL",
+            "IRC_COALESCE_WINDOW",
+            "IRC_FANOUT_WINDOW",
+            "WORKER_INDEX",
+        ):
             if self[key] and (not isinstance(self[key], int) or self[key] < 0):
                 raise exceptions.ConfigurationError(
                     '"{}" must be a positive integer'.format(key)
                 )
 
+        for key in (
+            "SMTP_POOL_SIZE",
+            "IRC_CONNECTIONS",
+            "IRC_COALESCE_MAX_LINES",
+            "IRC_MAX_BUFFERED",
+            "IRC_PRESENCE_INTERVAL",
+            "IRC_PRESENCE_MAX_NICKS",
+            "EMAIL_MAX_IN_FLIGHT",
+            "EMAIL_MAX_BODY_SIZE",
+            "BATCH_MAX_MESSAGES",
+            "BATCH_CONCURRENCY",
+            "RETRY_MAX_ATTEMPTS",
+            "BREAKER_FAILURE_THRESHOLD",
+            "BREAKER_RESET_TIMEOUT",
+            "SPOOL_SEGMENT_SIZE",
+            "SPOOL_MAX_IN_FLIGHT",
+            "SPOOL_RETRY_INTERVAL",
+            "SPOOL_MAX_ATTEMPTS",
+            "SMTP_RELAY_RETRY_INTERVAL",
+            "DELIVERY_WORKERS",
+            "WORKER_HEARTBEAT_INTERVAL",
+            "WORKER_TIMEOUT",
+            "QUEUE_LOAD_PAGE_SIZE",
+            "QUEUE_LOAD_RETRY_INTERVAL",
+            "DATABASE_THREADS",
+            "DATABASE_POOL_SIZE",
+            "DATABASE_POOL_TIMEOUT",
+        ):
+            if not isinstance(self[key], int) or self[key] < 1:
+                raise exceptions.ConfigurationError(
+                    '"{}" must be an integer greater than 0'.format(key)
+                )
+
+        for key in ("IRC_SEND_BURST", "IRC_SEND_RATE", "IRC_SEND_BYTE_COST"):
+            if not isinstance(self[key], (int, float)) or self[key] < 0:
+                raise exceptions.ConfigurationError('"{}" must be a positive number'.format(key))
+        if not self["IRC_SEND_BURST"] or not self["IRC_SEND_RATE"]:
+            raise exceptions.ConfigurationError(
+                '"IRC_SEND_BURST" and "IRC_SEND_RATE" must be greater than 0'
+            )
+
+        if self["IRC_OFFLINE_POLICY"] not in ("send", "drop", "park"):
+            raise exceptions.ConfigurationError(
+                '"IRC_OFFLINE_POLICY" must be one of "send", "drop", or "park"'
+            )
+
+        if not isinstance(self["DATABASE_MAX_OVERFLOW"], int) or self["DATABASE_MAX_OVERFLOW"] < 0:
+            raise exceptions.ConfigurationError(
+                '"DATABASE_MAX_OVERFLOW" must be an integer of 0 or more'
+            )
+        if not isinstance(self["DATABASE_POOL_RECYCLE"], int) or (
+            self["DATABASE_POOL_RECYCLE"] < 1 and self["DATABASE_POOL_RECYCLE"] != -1
+        ):
+            raise exceptions.ConfigurationError(
+                '"DATABASE_POOL_RECYCLE" must be an integer greater than 0, or -1'
+            )
+        if not isinstance(self["DATABASE_REPLICA_URLS"], list) or not all(
+            isinstance(url, str) and url for url in self["DATABASE_REPLICA_URLS"]
+        ):
+            raise exceptions.ConfigurationError('"DATABASE_REPLICA_URLS" must be a list of URLs')
+
+        if self["DELIVERY_MODE"] not in ("queues", "shared"):
+            raise exceptions.ConfigurationError(
+                '"DELIVERY_MODE" must be one of "queues" or "shared"'
+            )
+        for binding in self["SHARED_QUEUE_BINDINGS"]:
+            if not isinstance(binding, dict) or "exchange" not in binding:
+                raise exceptions.ConfigurationError(
+                    'Every entry in "SHARED_QUEUE_BINDINGS" must be a table with an "exchange"'
+                )
+
+        for relay in self["SMTP_RELAYS"]:
+            if not isinstance(relay, dict) or not relay.get("hostname"):
+                raise exceptions.ConfigurationError(
+                    'Every entry in "SMTP_RELAYS" must be a table with a "hostname"'
+                )
+            weight = relay.get("weight", 1)
+            if not isinstance(weight, int) or weight < 1:
+                raise exceptions.ConfigurationError(
+                    'The weight of SMTP relay "{}" must be an integer greater than 0'.format(
+                        relay["hostname"]
+                    )
+                )
+
+        if not self["RETRY_DELAYS"] or not all(
+            isinstance(d, int) and d > 0 for d in self["RETRY_DELAYS"]
+        ):
+            raise exceptions.ConfigurationError(
+                '"RETRY_DELAYS" must be a list of integers greater than 0'
+            )
+
 
 #: The application configuration dictionary.
 conf = LazyConfig()
@@ -23,6 +23,14 @@ changes to the database schema are managed with Alembic
 .. _Alembic: http://alembic.zzzcomputing.com/en/latest/
 .. _SQLAlchemy: http://www.sqlalchemy.org/
 """
-from .meta import initialize, Session, Base  # noqa: F401
-from .models import TopicBinding, HeaderBinding, Queue, User  # noqa: F401
+from .meta import initialize, pool_stats, replica, Session, Base  # noqa: F401
+from .models import (  # noqa: F401
+    AppliedTopology,
+    DeliveryWorker,
+    TopicBinding,
+    HeaderBinding,
+    Queue,
+    User,
+)
 from .types import DeliveryType, SeverityType  # noqa: F401
+from . import events, queries  # noqa: F401
@@ -3,15 +3,26 @@
 # Copyright (C) 2018 Red Hat, Inc.
 """This module contains functions that are triggered by SQLAlchemy events."""
 
+import itertools
+import json
 import logging
 
+from fedora_messaging import api, exceptions as fml_exceptions
 from sqlalchemy import event
 
 from .meta import Session
+from .models import HeaderBinding, Queue, TopicBinding, header_bindings, topic_binding
+from .. import messages
 
 
 _log = logging.getLogger(__name__)
 
+#: The key in ``Session.info`` of the binding changes waiting to be committed.
+_UPDATES_KEY = "fedora_notifications.queue_updates"
+
+#: The key in ``Session.info`` of the queues created and deleted, waiting to be committed.
+_LIFECYCLE_KEY = "fedora_notifications.queue_lifecycle"
+
 
 @event.listens_for(Session, "before_flush")
 def validate_settings(session, flush_context, instances):
@@ -28,3 +39,195 @@ def validate_settings(session, flush_context, instances):
         ValueError: If the settings aren't valid
     """
     pass
+
+
+@event.listens_for(Session, "before_flush")
+def record_binding_changes(session, flush_context, instances):
+    """
+    An SQLAlchemy event listener that records the AMQP bindings added to and
+    removed from existing queues, to announce them with a
+    :class:`fedora_notifications.messages.QueueUpdated` once the changes are
+    committed.
+
+    The bindings in the database are compared with the bindings about to be
+    flushed. Changes from several flushes in the same transaction are combined.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that is about to be committed.
+        flush_context (sqlalchemy.orm.session.UOWTransaction): Unused.
+        instances (object): deprecated and unused
+    """
+    updates = session.info.setdefault(_UPDATES_KEY, {})
+    for queue in _changed_queues(session):
+        if queue in session.new or queue in session.deleted:
+            continue
+        stored = {_key(b): b for b in _stored_bindings(session, queue)}
+        current = {_key(b): b for b in _current_bindings(queue, session.deleted)}
+        if stored.keys() == current.keys():
+            continue
+        added, removed, previous, _ = updates.get(queue.name, ({}, {}, queue.topology, None))
+        for key in current.keys() - stored.keys():
+            if removed.pop(key, None) is None:
+                added[key] = current[key]
+        for key in stored.keys() - current.keys():
+            if added.pop(key, None) is None:
+                removed[key] = stored[key]
+        updates[queue.name] = (
+            added,
+            removed,
+            previous,
+            queue.fingerprint(exclude=session.deleted),
+        )
+
+
+@event.listens_for(Session, "after_commit")
+def publish_binding_changes(session):
+    """
+    An SQLAlchemy event listener that announces the committed binding changes.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that was committed.
+    """
+    for queue_name, (added, removed, previous, topology) in session.info.pop(
+        _UPDATES_KEY, {}
+    ).items():
+        if not added and not removed:
+            continue
+        message = messages.QueueUpdated(
+            body={
+                "name": queue_name,
+                "added": list(added.values()),
+                "removed": list(removed.values()),
+                "topology": topology,
+                "previous_topology": previous,
+            }
+        )
+        try:
+            api.publish(message)
+        except (fml_exceptions.PublishException, fml_exceptions.ConnectionException) as e:
+            _log.error("Failed to announce the new bindings of %s: %s", queue_name, e)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_binding_changes(session):
+    """
+    An SQLAlchemy event listener that forgets binding changes that were rolled back.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that was rolled back.
+    """
+    session.info.pop(_UPDATES_KEY, None)
+
+
+@event.listens_for(Session, "before_flush")
+def record_created_and_deleted(session, flush_context, instances):
+    """
+    An SQLAlchemy event listener that records the queues added and deleted, to
+    announce them with a :class:`fedora_notifications.messages.QueueCreated` or
+    :class:`fedora_notifications.messages.QueueDeleted` once the changes are
+    committed.
+
+    A queue that's created and deleted again in the same transaction is never
+    announced. One that's deleted and created again is announced as deleted
+    and then created, so the delivery service picks up its new settings.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that is about to be committed.
+        flush_context (sqlalchemy.orm.session.UOWTransaction): Unused.
+        instances (object): deprecated and unused
+    """
+    created, deleted = session.info.setdefault(_LIFECYCLE_KEY, ([], []))
+    for obj in session.deleted:
+        if not isinstance(obj, Queue):
+            continue
+        if obj.name in created:
+            created.remove(obj.name)
+        else:
+            deleted.append(obj.name)
+    for obj in session.new:
+        if isinstance(obj, Queue) and obj.name not in created:
+            created.append(obj.name)
+
+
+@event.listens_for(Session, "after_commit")
+def publish_created_and_deleted(session):
+    """
+    An SQLAlchemy event listener that announces the committed queues and the
+    queues whose deletion was committed.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that was committed.
+    """
+    created, deleted = session.info.pop(_LIFECYCLE_KEY, ([], []))
+    announcements = [(messages.QueueDeleted, name) for name in deleted]
+    announcements += [(messages.QueueCreated, name) for name in created]
+    for message_cls, queue_name in announcements:
+        try:
+            api.publish(message_cls(body={"name": queue_name}))
+        except (fml_exceptions.PublishException, fml_exceptions.ConnectionException) as e:
+            _log.error("Failed to announce the queue %s: %s", queue_name, e)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_created_and_deleted(session):
+    """
+    An SQLAlchemy event listener that forgets queues whose creation or deletion
+    was rolled back.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that was rolled back.
+    """
+    session.info.pop(_LIFECYCLE_KEY, None)
+
+
+@event.listens_for(Session, "before_flush")
+def update_topology(session, flush_context, instances):
+    """
+    An SQLAlchemy event listener that updates the topology fingerprint of every
+    queue that's new or whose bindings changed.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that is about to be committed.
+        flush_context (sqlalchemy.orm.session.UOWTransaction): Unused.
+        instances (object): deprecated and unused
+    """
+    for queue in _changed_queues(session):
+        if queue not in session.deleted:
+            queue.topology = queue.fingerprint(exclude=session.deleted)
+
+
+def _changed_queues(session):
+    """The queues in a session that changed, or whose bindings changed."""
+    queues = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Queue):
+            queues.add(obj)
+        elif isinstance(obj, (TopicBinding, HeaderBinding)) and obj.queue is not None:
+            queues.add(obj.queue)
+    return queues
+
+
+def _stored_bindings(session, queue):
+    """The AMQP bindings of a queue as they are in the database."""
+    with session.no_autoflush:
+        topics = session.query(TopicBinding.topic).filter(TopicBinding.queue_id == queue.id)
+        headers = session.query(HeaderBinding.key_name, HeaderBinding.severity).filter(
+            HeaderBinding.queue_id == queue.id
+        )
+        bindings = [topic_binding(queue.name, topic) for topic, in topics]
+        for key_name, severity in headers:
+            bindings += header_bindings(queue.name, key_name, severity)
+    return bindings
+
+
+def _current_bindings(queue, deleted):
+    """The AMQP bindings of a queue as they're about to be flushed."""
+    bindings = [t.binding() for t in queue.topic_bindings if t not in deleted]
+    for header in queue.header_bindings:
+        if header not in deleted:
+            bindings += header.bindings()
+    return bindings
+
+
+def _key(binding):
+    return json.dumps(binding, sort_keys=True)
@@ -8,13 +8,57 @@ rely on. This includes the declarative base class and global scoped session.
 This is in its own module to avoid circular imports from forming. Models and
 events need to be imported by ``__init__.py``, but  they also need access to
 the :class:`Base` model and :class:`Session`.
+
+Sessions write to and read from the primary database, except for queries made
+inside a :func:`replica` block, which go to one of the read replicas if any are
+configured (see :ref:`conf-database-replica-urls`).
 """
-from sqlalchemy import create_engine, event
+import contextlib
+import logging
+import random
+import threading
+import time
+
+from sqlalchemy import create_engine, event, pool
 from sqlalchemy.ext import declarative
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import sessionmaker, scoped_session, Session as BaseSession
+from sqlalchemy.sql import expression
 
 from .. import config
 
+_log = logging.getLogger(__name__)
+
+#: The keys in :attr:`Session.info` that send queries to a replica, and record
+#: which replica the session uses.
+_REPLICA_KEY = "fedora_notifications.replica"
+_REPLICA_ENGINE_KEY = "fedora_notifications.replica_engine"
+
+#: The engines of the read replicas, set by :func:`initialize`.
+_replicas = []
+
+
+class RoutingSession(BaseSession):
+    """
+    A session that sends reads to a replica when asked to.
+
+    Inside a :func:`replica` block, SELECT statements go to a replica chosen
+    when the session first uses one. Flushes, other statements, and anything
+    outside the block go to the primary the session is bound to.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if (
+            _replicas
+            and self.info.get(_REPLICA_KEY)
+            and not self._flushing
+            and isinstance(clause, expression.SelectBase)
+        ):
+            engine = self.info.get(_REPLICA_ENGINE_KEY)
+            if engine is None:
+                engine = self.info[_REPLICA_ENGINE_KEY] = random.choice(_replicas)
+            return engine
+        return super(RoutingSession, self).get_bind(mapper=mapper, clause=clause)
+
 
 #: This is a configured scoped session. It creates thread-local sessions. This
 #: means that ``Session() is Session()`` is ``True``. This is a convenient way
@@ -22,15 +66,132 @@ from .. import config
 #: for details.
 #:
 #: Before you can use this, you must call :func:`initialize`.
-Session = scoped_session(sessionmaker())
+Session = scoped_session(sessionmaker(class_=RoutingSession))
+
+
+@contextlib.contextmanager
+def replica(session=None):
+    """
+    Send the reads made in a session during the block to a read replica.
+
+    Replicas lag behind the primary, so this is only for reads that don't need
+    to see the latest writes, such as listing queues. Without replicas the
+    reads go to the primary as usual.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session; defaults to the current
+            :data:`Session`.
+
+    Yields:
+        sqlalchemy.orm.Session: The session.
+    """
+    session = session if session is not None else Session()
+    previous = session.info.get(_REPLICA_KEY, False)
+    session.info[_REPLICA_KEY] = True
+    try:
+        yield session
+    finally:
+        session.info[_REPLICA_KEY] = previous
+
+
+class TimedQueuePool(pool.QueuePool):
+    """
+    A :class:`sqlalchemy.pool.QueuePool` that records how long checkouts wait.
+
+    A checkout waits when every connection is in use and the pool can't
+    overflow, so the time spent waiting shows whether the pool is too small
+    for the number of threads using it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            wait = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            if wait >= 1:
+                _log.warning("Waited %.2f seconds for a database connection", wait)
+
+    def stats(self):
+        """
+        Report the size of the pool and how long checkouts waited.
+
+        Returns:
+            dict: The size of the pool, the number of connections checked out
+                and in overflow, the number of checkouts, and the total and
+                longest time checkouts waited, in seconds.
+        """
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "checked_out": self.checkedout(),
+                "overflow": max(self.overflow(), 0),
+                "checkouts": self.checkouts,
+                "wait_total": self.wait_total,
+                "wait_max": self.wait_max,
+            }
+
+
+def pool_stats():
+    """
+    Report the connection pools of the primary database and the replicas.
+
+    Returns:
+        dict: Maps "primary" and "replica-<n>" to the statistics of each pool
+            that records them; SQLite databases don't.
+    """
+    engines = [("primary", Session.session_factory.kw.get("bind"))]
+    engines.extend(("replica-{}".format(i), engine) for i, engine in enumerate(_replicas))
+    return {
+        name: engine.pool.stats()
+        for name, engine in engines
+        if engine is not None and isinstance(engine.pool, TimedQueuePool)
+    }
+
+
+def _create_engine(url, config):
+    """Create an engine with the configured connection pool settings."""
+    kwargs = {
+        "echo": config["SQL_DEBUG"],
+        "pool_pre_ping": config["DATABASE_POOL_PRE_PING"],
+        "pool_recycle": config["DATABASE_POOL_RECYCLE"],
+    }
+    if not url.startswith("sqlite:"):
+        kwargs.update(
+            poolclass=TimedQueuePool,
+            pool_size=config["DATABASE_POOL_SIZE"],
+            max_overflow=config["DATABASE_MAX_OVERFLOW"],
+            pool_timeout=config["DATABASE_POOL_TIMEOUT"],
+        )
+    engine = create_engine(url, **kwargs)
+    if url.startswith("sqlite:"):
+        # Flip on foreign key constraints if the database in use is SQLite. See
+        # http://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#foreign-key-support
+        event.listen(
+            engine,
+            "connect",
+            lambda db_con, con_record: db_con.execute("PRAGMA foreign_keys=ON"),
+        )
+    return engine
 
 
 def initialize(config=config.conf):
     """
     Initialize the database.
 
-    This creates a database engine from the provided configuration and
-    configures the scoped session to use the engine.
+    This creates a database engine from the provided configuration, and one
+    for each read replica, and configures the scoped session to use them.
 
     .. note::
         This approach makes it very simple to write your unit tests. Since
@@ -43,17 +204,10 @@ def initialize(config=config.conf):
             to initialize the database.
 
     Returns:
-        sqlalchemy.engine: The database engine created from the configuration.
+        sqlalchemy.engine: The engine of the primary database.
     """
-    engine = create_engine(config["DATABASE_URL"], echo=config["SQL_DEBUG"])
-    if config["DATABASE_URL"].startswith("sqlite:"):
-        # Flip on foreign key constraints if the database in use is SQLite. See
-        # http://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#foreign-key-support
-        event.listen(
-            engine,
-            "connect",
-            lambda db_con, con_record: db_con.execute("PRAGMA foreign_keys=ON"),
-        )
+    engine = _create_engine(config["DATABASE_URL"], config)
+    _replicas[:] = [_create_engine(url, config) for url in config["DATABASE_REPLICA_URLS"]]
     Session.configure(bind=engine)
     return engine
 
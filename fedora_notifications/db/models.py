@@ -2,10 +2,13 @@
 #
 # Copyright (C) 2018 Red Hat, Inc.
 """The database models."""
+import hashlib
+import json
 import uuid
 
 from sqlalchemy import (
     Column,
+    DateTime,
     ForeignKey,
     UnicodeText,
     orm,
@@ -19,6 +22,9 @@ from .meta import Base
 from .types import GUID, DeliveryType
 from .. import config
 
+#: The prefix of the names of the severity exchanges.
+_SEVERITY_EXCHANGE_PREFIX = "fedora-notifications-severity-"
+
 
 class User(Base):
     """
@@ -59,6 +65,13 @@ class Queue(Base):
         batch (int): The number of minutes in between batches of notifications
             from this queue. If ``None``, batching is not applied and delivery
             occurs immediately.
+        topology (str): The :meth:`fingerprint` of the queue's bindings. It's
+            kept up to date whenever the bindings change; see
+            :mod:`fedora_notifications.db.events`.
+        applied_topology (str): The fingerprint of the bindings the delivery
+            service last declared on the broker, or ``None`` if it hasn't
+            declared them yet. If it matches :attr:`topology`, the broker
+            already has the right bindings.
     """
 
     __tablename__ = "queues"
@@ -69,6 +82,8 @@ class Queue(Base):
 
     identity = Column(UnicodeText, nullable=False)
     batch = Column(Integer, nullable=True, index=True, default=None)
+    topology = Column(UnicodeText, nullable=True)
+    applied_topology = Column(UnicodeText, nullable=True)
 
     topic_bindings = orm.relationship(
         "TopicBinding", backref="queue", cascade="all, delete-orphan"
@@ -100,6 +115,26 @@ class Queue(Base):
         topic_bindings = [t.binding() for t in self.topic_bindings]
         return header_bindings + topic_bindings
 
+    def fingerprint(self, exclude=()):
+        """
+        A fingerprint of the queue's bindings, which changes if and only if the
+        bindings do.
+
+        Args:
+            exclude (collection): Bindings to leave out, for example because
+                they're about to be deleted.
+
+        Returns:
+            str: The SHA-256 hex digest of the bindings.
+        """
+        bindings = []
+        for header in self.header_bindings:
+            if header not in exclude:
+                bindings += header.bindings()
+        bindings += [t.binding() for t in self.topic_bindings if t not in exclude]
+        serialized = sorted(json.dumps(b, sort_keys=True) for b in bindings)
+        return hashlib.sha256("\n".join(serialized).encode("utf-8")).hexdigest()
+
     def arguments(self):
         """
         Arguments to create the AMQP queue.
@@ -141,12 +176,7 @@ class TopicBinding(Base):
 
     def binding(self):
         """Produce a dictionary for the fedora-messaging library."""
-        return {
-            "queue": self.queue.name,
-            "exchange": "amq.topic",
-            "routing_key": self.topic,
-            "arguments": {},
-        }
+        return topic_binding(self.queue.name, self.topic)
 
 
 class HeaderBinding(Base):
@@ -234,19 +264,179 @@ class HeaderBinding(Base):
     queue_id = Column(GUID, ForeignKey("queues.id"), nullable=False)
 
     def bindings(self):
-        binds = []
-        for sev in SEVERITIES:
-            if sev >= self.severity:
-                binds.append(
-                    {
-                        "queue": self.queue.name,
-                        "exchange": "amq.match",
-                        "routing_key": None,
-                        "arguments": {
-                            "x-match": "all",
-                            self.key_name: True,
-                            "fedora_messaging_severity": sev,
-                        },
-                    }
-                )
-        return binds
+        return header_bindings(self.queue.name, self.key_name, self.severity)
+
+
+class AppliedTopology(Base):
+    """
+    The exchange mode the bindings on the broker were declared in.
+
+    A queue's :attr:`Queue.applied_topology` fingerprint only describes the
+    bindings on the broker if they were declared in the exchange mode the
+    ``SEVERITY_EXCHANGES`` setting selects now. The mode is recorded the first
+    time the delivery service starts and whenever ``fedora-notifications
+    convert-bindings`` moves the bindings, and the delivery service refuses to
+    start if the setting no longer matches it.
+
+    Attributes:
+        id (int): The primary key; there's only ever one row, with the ID 1.
+        severity_exchanges (bool): Whether the header bindings are to the
+            severity exchanges.
+    """
+
+    __tablename__ = "applied_topology"
+
+    id = Column(Integer, primary_key=True)
+    severity_exchanges = Column(Boolean, nullable=False)
+
+
+class DeliveryWorker(Base):
+    """
+    A delivery service worker, used to share the queues out between workers.
+
+    See :mod:`fedora_notifications.delivery.membership`.
+
+    Attributes:
+        id (str): The worker's ID, for example "host.example.com-0".
+        heartbeat (datetime.datetime): When the worker last checked in, in UTC.
+    """
+
+    __tablename__ = "delivery_workers"
+
+    id = Column(UnicodeText, primary_key=True)
+    heartbeat = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "DeliveryWorker(id={}, heartbeat={})".format(self.id, self.heartbeat)
+
+
+def topic_binding(queue_name, topic):
+    """
+    The AMQP binding of a :class:`TopicBinding`.
+
+    Args:
+        queue_name (str): The name of the queue.
+        topic (str): The topic.
+
+    Returns:
+        dict: The binding, for the fedora-messaging library.
+    """
+    return {
+        "queue": queue_name,
+        "exchange": "amq.topic",
+        "routing_key": topic,
+        "arguments": {},
+    }
+
+
+def header_bindings(queue_name, key_name, severity, tiered=None):
+    """
+    The AMQP bindings of a :class:`HeaderBinding`.
+
+    Normally there's a binding to ``amq.match`` for each severity at or above
+    the one requested. If the ``SEVERITY_EXCHANGES`` setting is on, there's a
+    single binding to the exchange for that severity instead; see
+    :func:`severity_exchange`.
+
+    Args:
+        queue_name (str): The name of the queue.
+        key_name (str): The header key's name.
+        severity (int): The lowest severity to bind.
+        tiered (bool): Whether to bind to the severity exchanges; defaults to
+            the ``SEVERITY_EXCHANGES`` setting.
+
+    Returns:
+        list of dict: The bindings, for the fedora-messaging library.
+    """
+    if tiered is None:
+        tiered = config.conf["SEVERITY_EXCHANGES"]
+    if tiered:
+        floor = min([sev for sev in SEVERITIES if sev >= severity] or [max(SEVERITIES)])
+        return [
+            {
+                "queue": queue_name,
+                "exchange": severity_exchange(floor),
+                "routing_key": None,
+                "arguments": {"x-match": "all", key_name: True},
+            }
+        ]
+    binds = []
+    for sev in SEVERITIES:
+        if sev >= severity:
+            binds.append(
+                {
+                    "queue": queue_name,
+                    "exchange": "amq.match",
+                    "routing_key": None,
+                    "arguments": {
+                        "x-match": "all",
+                        key_name: True,
+                        "fedora_messaging_severity": sev,
+                    },
+                }
+            )
+    return binds
+
+
+def severity_exchange(severity):
+    """
+    The name of the headers exchange that gets every message at or above a severity.
+
+    Args:
+        severity (int): One of the fedora-messaging severities.
+
+    Returns:
+        str: The name of the exchange.
+    """
+    return "{}{}".format(_SEVERITY_EXCHANGE_PREFIX, severity)
+
+
+def exchange_severity(exchange):
+    """
+    The severity of a severity exchange.
+
+    Args:
+        exchange (str): The name of an exchange.
+
+    Returns:
+        int: The lowest severity of the messages the exchange gets, or ``None``
+            if it's not a severity exchange.
+    """
+    if not exchange.startswith(_SEVERITY_EXCHANGE_PREFIX):
+        return None
+    return int(exchange[len(_SEVERITY_EXCHANGE_PREFIX):])
+
+
+def severity_exchanges():
+    """
+    The severity exchanges.
+
+    Returns:
+        list of dict: The exchanges, for the fedora-messaging library.
+    """
+    return [
+        {"exchange": severity_exchange(sev), "exchange_type": "headers", "durable": True}
+        for sev in SEVERITIES
+    ]
+
+
+def severity_exchange_bindings():
+    """
+    The exchange-to-exchange bindings that route messages from ``amq.match`` to
+    the severity exchanges. Each severity exchange gets the messages at its
+    severity and above.
+
+    Returns:
+        list of dict: The bindings, as keyword arguments for pika's ``exchange_bind``.
+    """
+    return [
+        {
+            "destination": severity_exchange(floor),
+            "source": "amq.match",
+            "routing_key": "",
+            "arguments": {"x-match": "all", "fedora_messaging_severity": sev},
+        }
+        for floor in SEVERITIES
+        for sev in SEVERITIES
+        if sev >= floor
+    ]
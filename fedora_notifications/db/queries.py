@@ -14,3 +14,181 @@ them to be created from session objects.
 .. _model Managers:
     https://docs.djangoproject.com/en/dev/topics/db/managers/
 """
+import collections
+
+from sqlalchemy import orm
+
+from . import models
+from .meta import Session
+from .types import DeliveryType
+
+#: A queue as the delivery service needs it. ``bindings`` is ``None`` if they
+#: weren't loaded, ``topology`` is their fingerprint, and ``changed`` is whether
+#: they changed since they were last declared on the broker.
+QueueRecord = collections.namedtuple(
+    "QueueRecord", ("id", "arguments", "bindings", "batch", "topology", "changed")
+)
+
+#: A queue's description, without its bindings.
+QueueSummary = collections.namedtuple(
+    "QueueSummary", ("name", "delivery_type", "identity", "batch")
+)
+
+
+class BaseQuery(orm.Query):
+    """The base class of the custom query classes."""
+
+
+class QueueQuery(BaseQuery):
+    """
+    Queries for :class:`.models.Queue`.
+
+    Queues' bindings are in other tables, and building a queue's AMQP bindings
+    loads them, so any query whose results are used for their bindings should
+    eager-load them with :meth:`with_bindings`. The methods that return records
+    load everything they need with a fixed number of queries.
+    """
+
+    def with_bindings(self):
+        """
+        Eager-load the bindings of the queues, with one query per binding type.
+
+        Returns:
+            QueueQuery: The query.
+        """
+        return self.options(
+            orm.selectinload(models.Queue.topic_bindings),
+            orm.selectinload(models.Queue.header_bindings),
+        )
+
+    def by_delivery_type(self, delivery_types):
+        """
+        Filter the queues by delivery type.
+
+        Args:
+            delivery_types (list of DeliveryType): The delivery types to include.
+
+        Returns:
+            QueueQuery: The query.
+        """
+        return self.filter(models.Queue.delivery_type.in_(delivery_types))
+
+    def for_user(self, username):
+        """
+        Find a user's queues, with their bindings.
+
+        Args:
+            username (str): The user's name.
+
+        Returns:
+            QueueQuery: The query.
+        """
+        return self.filter(models.Queue.username == username).with_bindings()
+
+    def by_name(self, queue_name):
+        """
+        Find a queue by its name, such as ``irc.jcline``.
+
+        Args:
+            queue_name (str): The name of the queue.
+
+        Returns:
+            QueueQuery: The query.
+        """
+        delivery_type, identity = queue_name.split(".", 1)
+        return self.filter_by(
+            delivery_type=DeliveryType.from_string(delivery_type), identity=identity
+        )
+
+    def page(self, after=None, limit=None):
+        """
+        Get a page of queues in order of their IDs.
+
+        Args:
+            after (uuid.UUID): The ID of the last queue of the previous page, or
+                ``None`` for the first page.
+            limit (int): The maximum number of queues, or ``None`` for all of them.
+
+        Returns:
+            QueueQuery: The query.
+        """
+        query = self
+        if after is not None:
+            query = query.filter(models.Queue.id > after)
+        return query.order_by(models.Queue.id).limit(limit)
+
+    def consumable(self, delivery_types, after=None, limit=None, with_bindings=False):
+        """
+        Load a page of the queues the delivery service consumes.
+
+        Bindings are only loaded for the queues whose bindings changed since
+        they were last declared, unless ``with_bindings`` is set, so a page
+        takes one query, or four if any bindings are loaded.
+
+        Args:
+            delivery_types (list of DeliveryType): The enabled delivery types.
+            after (uuid.UUID): The ID of the last queue of the previous page, or
+                ``None`` for the first page.
+            limit (int): The maximum number of queues, or ``None`` for all of them.
+            with_bindings (bool): Whether to load the bindings of the queues
+                that aren't batched even if they haven't changed.
+
+        Returns:
+            list of QueueRecord: The queues.
+        """
+        queues = self.by_delivery_type(delivery_types).page(after, limit).all()
+        changed = {
+            q.id for q in queues if q.topology is None or q.topology != q.applied_topology
+        }
+        needed = changed | {q.id for q in queues if with_bindings and q.batch is None}
+        if needed:
+            # The queues are already in the session, so this just loads their bindings
+            query = QueueQuery(models.Queue, session=self.session)
+            query.filter(models.Queue.id.in_(needed)).with_bindings().all()
+        return [
+            QueueRecord(
+                q.id,
+                q.arguments(),
+                q.bindings() if q.id in needed else None,
+                q.batch,
+                q.topology or q.fingerprint(),
+                q.id in changed,
+            )
+            for q in queues
+        ]
+
+    def bindings_by_id(self, queue_ids):
+        """
+        Load the bindings of some queues.
+
+        Args:
+            queue_ids (list of uuid.UUID): The IDs of the queues.
+
+        Returns:
+            dict: Maps the ID of each queue that exists to its bindings.
+        """
+        queues = self.filter(models.Queue.id.in_(queue_ids)).with_bindings()
+        return {q.id: q.bindings() for q in queues}
+
+    def summaries(self):
+        """
+        Describe the queues without loading their bindings.
+
+        Returns:
+            list of QueueSummary: The queues.
+        """
+        rows = self.with_entities(
+            models.Queue.delivery_type,
+            models.Queue.identity,
+            models.Queue.batch,
+        )
+        return [
+            QueueSummary(
+                "{}.{}".format(delivery_type, identity), delivery_type, identity, batch
+            )
+            for delivery_type, identity, batch in rows
+        ]
+
+
+# Set here rather than in the model, so the models don't import this module
+models.Queue.query = Session.query_property(query_cls=QueueQuery)
@@ -0,0 +1,225 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Scheduling for batched queues.
+
+Queues with a :attr:`fedora_notifications.db.Queue.batch` interval aren't
+consumed continuously. Instead, the :class:`DigestScheduler` tracks when each
+of them is next due and, when the time comes, drains the queue with
+``basic.get`` and hands everything it found to the backend as a single digest.
+"""
+import heapq
+import itertools
+import logging
+import random
+
+from twisted.internet import defer, reactor as global_reactor
+from twisted.python import failure
+from fedora_messaging import exceptions as fml_exceptions
+from fedora_messaging.message import get_message
+
+_log = logging.getLogger(__name__)
+
+
+class DigestScheduler(object):
+    """
+    Drain batched queues on their schedule and deliver their contents as digests.
+
+    Due times are kept in a heap, so adding a queue or finding the next due
+    queue is ``O(log n)`` and a single timer is pending no matter how many
+    queues are scheduled. Removed queues are marked as such and discarded when
+    they reach the top of the heap.
+
+    Digests are sent by a per-delivery-type callable which is passed the queue
+    name and a list of messages. It may raise :class:`fedora_messaging.exceptions.Nack`
+    to return the messages to the queue, or :class:`fedora_messaging.exceptions.Drop`
+    to discard them. Any other exception also returns the messages to the queue.
+    Either way, the queue is tried again at its next due time.
+
+    Args:
+        amqp_service (fedora_messaging.twisted.service.FedoraMessagingService): The
+            service whose connection is used to drain the queues.
+        dispatchers (dict): Map delivery types (the queue name prefix, e.g. "email")
+            to the callable that delivers a digest.
+        max_messages (int): The maximum number of messages to include in a single
+            digest. If a queue has more, the remainder is sent right away in
+            another digest.
+        concurrency (int): The maximum number of queues to drain at once.
+        reactor (twisted.internet.interfaces.IReactorTime): The reactor to use.
+    """
+
+    def __init__(self, amqp_service, dispatchers, max_messages=500, concurrency=10,
+                 reactor=global_reactor):
+        self.amqp_service = amqp_service
+        self.dispatchers = dispatchers
+        self.max_messages = max_messages
+        self.reactor = reactor
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._timer = None
+        self._running = False
+        self._draining = set()
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+
+    def add(self, queue_name, minutes, first_due=None):
+        """
+        Schedule a batched queue, replacing any existing schedule for it.
+
+        Args:
+            queue_name (str): The name of the queue.
+            minutes (int): The number of minutes between digests.
+            first_due (float): When the queue is first due, in reactor seconds.
+                Defaults to a random point in the first interval so queues loaded
+                at the same time don't all come due together.
+        """
+        interval = minutes * 60
+        if first_due is None:
+            first_due = self.reactor.seconds() + random.uniform(0, interval)
+        self.remove(queue_name)
+        entry = [first_due, next(self._counter), queue_name, interval, True]
+        self._entries[queue_name] = entry
+        heapq.heappush(self._heap, entry)
+        self._reset_timer()
+
+    def remove(self, queue_name):
+        """
+        Stop scheduling a queue. It's not an error if the queue isn't scheduled.
+
+        Args:
+            queue_name (str): The name of the queue.
+        """
+        entry = self._entries.pop(queue_name, None)
+        if entry is not None:
+            entry[-1] = False
+
+    def __contains__(self, queue_name):
+        return queue_name in self._entries
+
+    def start(self):
+        """Start draining queues as they come due."""
+        self._running = True
+        self._reset_timer()
+
+    def stop(self):
+        """Stop draining queues; drains already in progress are allowed to finish."""
+        self._running = False
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def stats(self):
+        """
+        Report the state of the scheduler.
+
+        Returns:
+            dict: The number of scheduled queues and the number being drained.
+        """
+        return {"scheduled": len(self._entries), "draining": len(self._draining)}
+
+    def _reset_timer(self):
+        """Make sure the single pending timer fires when the earliest queue is due."""
+        while self._heap and not self._heap[0][-1]:
+            heapq.heappop(self._heap)
+        if not self._running or not self._heap:
+            return
+        delay = max(0, self._heap[0][0] - self.reactor.seconds())
+        if self._timer is not None and self._timer.active():
+            if self._timer.getTime() <= self._heap[0][0]:
+                return
+            self._timer.cancel()
+        self._timer = self.reactor.callLater(delay, self._run_due)
+
+    def _run_due(self):
+        self._timer = None
+        now = self.reactor.seconds()
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if entry[-1]:
+                self._draining.add(entry[2])
+                d = self._semaphore.run(self._drain, entry[2])
+                d.addBoth(self._drained, entry)
+        self._reset_timer()
+
+    def _drained(self, more, entry):
+        """Re-schedule a queue after it has been drained."""
+        queue_name, interval = entry[2], entry[3]
+        self._draining.discard(queue_name)
+        if isinstance(more, failure.Failure):
+            _log.error("Failed to drain %s: %s", queue_name, more.getErrorMessage())
+        if self._entries.get(queue_name) is not entry:
+            # Removed (or replaced) while it was being drained
+            return
+        if more is True:
+            due = self.reactor.seconds()
+        else:
+            due = self.reactor.seconds() + interval
+        entry[0], entry[1] = due, next(self._counter)
+        heapq.heappush(self._heap, entry)
+        self._reset_timer()
+
+    @defer.inlineCallbacks
+    def _drain(self, queue_name):
+        """
+        Fetch up to :attr:`max_messages` from a queue and deliver them as one digest.
+
+        Returns:
+            defer.Deferred: Fires with ``True`` if the queue had more messages than
+                fit in the digest, ``False`` otherwise.
+        """
+        dispatcher = self.dispatchers[queue_name.split(".", 1)[0]]
+        try:
+            client = yield self.amqp_service.getFactory().whenConnected()
+            channel = yield client.channel()
+        except Exception as e:
+            _log.warning("Unable to drain %s, no AMQP channel available: %s", queue_name, e)
+            defer.returnValue(False)
+
+        try:
+            messages = []
+            last_tag = None
+            while len(messages) < self.max_messages:
+                result = yield channel.basic_get(queue=queue_name, auto_ack=False)
+                if result is None:
+                    break
+                _channel, method, properties, body = result
+                last_tag = method.delivery_tag
+                try:
+                    message = get_message(method.routing_key, properties, body)
+                except fml_exceptions.ValidationError:
+                    _log.warning(
+                        "Message id %s did not pass validation; dropping it from the %s digest",
+                        properties.message_id,
+                        queue_name,
+                    )
+                    continue
+                message.queue = queue_name
+                messages.append(message)
+
+            if last_tag is None:
+                defer.returnValue(False)
+
+            requeue = False
+            if messages:
+                try:
+                    yield defer.maybeDeferred(dispatcher, queue_name, messages)
+                except fml_exceptions.Drop:
+                    _log.warning("Dropping the digest of %d messages for %s",
+                                 len(messages), queue_name)
+                except fml_exceptions.Nack:
+                    requeue = True
+                except Exception:
+                    _log.exception("Failed to deliver the digest for %s", queue_name)
+                    requeue = True
+
+            if requeue:
+                yield channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+                defer.returnValue(False)
+            yield channel.basic_ack(delivery_tag=last_tag, multiple=True)
+            defer.returnValue(len(messages) >= self.max_messages)
+        finally:
+            try:
+                channel.close()
+            except Exception:
+                pass  # pika doesn't handle repeated closes gracefully
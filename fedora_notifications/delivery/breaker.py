@@ -0,0 +1,159 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Circuit breakers for the delivery backends.
+
+When a backend such as the SMTP server or the IRC network is unreachable,
+there's no point in attempting deliveries to it: they can only fail. A
+:class:`CircuitBreaker` counts consecutive failures of a backend and, once
+they reach a threshold, *opens*. While it's open, deliveries wait in
+:meth:`CircuitBreaker.allow` and the breaker periodically probes the backend.
+When a probe succeeds, the waiting deliveries go ahead and the breaker is
+*half-open*: the next delivery either succeeds and *closes* the breaker, or
+fails and opens it again.
+
+The consumers aren't canceled while the breaker is open. Like the
+:class:`.flow.DeliveryLimiter`, holding the consumer callbacks stops the
+consumers once their prefetch windows are full, so messages stay in their
+queues. The queues keep their consumers, so queues declared with ``x-expires``
+aren't deleted by the broker however long the outage lasts.
+"""
+import logging
+
+from twisted.internet import defer, reactor as global_reactor
+
+_log = logging.getLogger(__name__)
+
+#: The breaker is closed and deliveries proceed as normal.
+CLOSED = "closed"
+#: The backend is unavailable and deliveries wait until it's available again.
+OPEN = "open"
+#: A probe succeeded and deliveries have resumed on a trial basis.
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker for a single delivery backend.
+
+    Args:
+        name (str): The name of the backend, used in log messages.
+        probe (callable): Called with no arguments to check whether the backend
+            is available again. It should return a Deferred that fires if it is
+            and errbacks if it isn't.
+        failure_threshold (int): The number of consecutive failures that opens
+            the breaker.
+        reset_timeout (int): The number of seconds between probes while open.
+        reactor (twisted.internet.interfaces.IReactorTime): The reactor to use.
+
+    Attributes:
+        state (str): One of :data:`CLOSED`, :data:`OPEN`, or :data:`HALF_OPEN`.
+        failures (int): The number of consecutive failures seen while closed.
+        times_opened (int): The number of times the breaker has opened.
+    """
+
+    def __init__(self, name, probe, failure_threshold=5, reset_timeout=30,
+                 reactor=global_reactor):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.reactor = reactor
+        self.state = CLOSED
+        self.failures = 0
+        self.times_opened = 0
+        self.state_changed_at = reactor.seconds()
+        self._probe_call = None
+        self._stopped = False
+        # Deliveries waiting for the breaker to stop being open
+        self._waiting = []
+
+    def allow(self):
+        """
+        Wait until deliveries to the backend are allowed.
+
+        Every delivery should wait on this before it starts, so nothing is sent
+        to a backend that's known to be unavailable.
+
+        Returns:
+            defer.Deferred: Fires immediately unless the breaker is open, and
+                otherwise once a probe succeeds.
+        """
+        if self.state != OPEN:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def record_success(self):
+        """Record a successful delivery."""
+        self.failures = 0
+        if self.state == HALF_OPEN:
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        """Record a delivery that failed because the backend is unavailable."""
+        if self.state == OPEN:
+            # Deliveries that were in progress when the breaker opened
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._open()
+
+    def stop(self):
+        """Stop probing the backend."""
+        self._stopped = True
+        if self._probe_call is not None and self._probe_call.active():
+            self._probe_call.cancel()
+        self._probe_call = None
+
+    def stats(self):
+        """
+        Report the state of the breaker.
+
+        Returns:
+            dict: The breaker state, the number of seconds it has been in that
+                state, the current consecutive failure count, the number of
+                times it has opened, and the number of deliveries waiting.
+        """
+        return {
+            "state": self.state,
+            "seconds_in_state": self.reactor.seconds() - self.state_changed_at,
+            "failures": self.failures,
+            "times_opened": self.times_opened,
+            "waiting": len(self._waiting),
+        }
+
+    def _set_state(self, state):
+        _log.warning(
+            "The %s circuit breaker changed from %s to %s", self.name, self.state, state
+        )
+        self.state = state
+        self.state_changed_at = self.reactor.seconds()
+
+    def _open(self):
+        self._set_state(OPEN)
+        self.times_opened += 1
+        self.failures = 0
+        self._schedule_probe()
+
+    def _schedule_probe(self):
+        if self._stopped:
+            return
+        self._probe_call = self.reactor.callLater(self.reset_timeout, self._run_probe)
+
+    @defer.inlineCallbacks
+    def _run_probe(self):
+        self._probe_call = None
+        try:
+            yield defer.maybeDeferred(self.probe)
+        except Exception as e:
+            _log.info("%s is still unavailable: %s", self.name, e)
+            self._schedule_probe()
+            return
+
+        self._set_state(HALF_OPEN)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
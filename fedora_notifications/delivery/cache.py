@@ -0,0 +1,97 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+A cache of rendered messages.
+
+A single message, a kernel build for example, is often routed to thousands of
+user queues. Rendering it (``str(message)`` and ``message.summary``) can be
+expensive, so the :class:`RenderCache` keeps recently rendered messages, keyed
+by message ID, for all the deliveries of the same message to share.
+"""
+import collections
+
+from . import formatters
+
+
+class RenderCache(object):
+    """
+    A least-recently-used cache of :class:`formatters.RenderedMessage` objects.
+
+    The cache is bounded by the total size of the rendered text it holds rather
+    than by the number of entries, since message bodies vary enormously in size.
+    When adding an entry takes the cache over its size, the least recently used
+    entries are evicted. Messages without an ID, and messages whose rendering is
+    larger than the whole cache, are rendered but not cached.
+
+    Args:
+        max_size (int): The maximum size, in bytes, of the rendered text to hold.
+
+    Attributes:
+        size (int): The size, in bytes, of the rendered text currently cached.
+        hits (int): The number of lookups that found a cached rendering.
+        misses (int): The number of lookups that had to render the message.
+        evictions (int): The number of entries evicted to make room for others.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, message):
+        """
+        Get the rendering of a message, rendering it if it isn't cached.
+
+        Args:
+            message (fedora_messaging.message.Message): The message.
+
+        Returns:
+            formatters.RenderedMessage: The rendered message.
+        """
+        try:
+            rendered = self._entries[message.id]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(message.id)
+            return rendered
+
+        rendered = formatters.render(message)
+        entry_size = _size(rendered)
+        if message.id is not None and entry_size <= self.max_size:
+            self._entries[message.id] = rendered
+            self.size += entry_size
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= _size(evicted)
+                self.evictions += 1
+        return rendered
+
+    def stats(self):
+        """
+        Report the cache's effectiveness.
+
+        Returns:
+            dict: The number of entries, their total size, and the hit, miss, and
+                eviction counts.
+        """
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def _size(rendered):
+    """The size, in bytes, of the rendered text in a cache entry."""
+    return len(rendered.summary) + len(rendered.body) + len(rendered.mime_body)
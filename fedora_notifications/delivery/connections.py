@@ -0,0 +1,189 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Spread the queue consumers of a delivery type over several AMQP connections.
+
+Each consumer uses its own channel, and brokers limit the number of channels on
+a connection. One connection for tens of thousands of queues would exceed the
+limit and push every message through a single socket, so the queues of each
+delivery type are spread over as many connections as it takes to keep each one
+at or below ``CONSUMERS_PER_CONNECTION`` consumers.
+"""
+import collections
+import logging
+
+from twisted.internet import defer
+from fedora_messaging.twisted.service import FedoraMessagingService
+
+_log = logging.getLogger(__name__)
+
+
+class ConsumerConnections(object):
+    """
+    The AMQP connections that consume the queues of one delivery type.
+
+    New queues go to the connection with the fewest queues, and a connection is
+    added when they're all full. A connection is retired when its last queue is
+    removed, unless it's the only one.
+
+    Args:
+        name (str): The delivery type; connections are named after it.
+        parent (twisted.application.service.MultiService): The service the
+            connections belong to.
+        per_connection (int): The maximum number of queues on a connection.
+
+    Attributes:
+        producers (list of FedoraMessagingService): The connections, in the order
+            they were created.
+    """
+
+    def __init__(self, name, parent, per_connection):
+        self.name = name
+        self.parent = parent
+        self.per_connection = per_connection
+        self.producers = []
+        self.running = False
+        # Map queue names to the connection consuming them, and connections to
+        # the number of queues they have
+        self._queues = {}
+        self._load = {}
+        self._created = 0
+
+    def __contains__(self, queue_name):
+        return queue_name in self._queues
+
+    def load(self, queues, bindings, callback):
+        """
+        Declare and consume queues that exist at startup, on new connections.
+
+        Args:
+            queues (list of dict): The queue arguments.
+            bindings (list of dict): The bindings of the queues.
+            callback (callable): The consumer callback.
+
+        Returns:
+            defer.Deferred: Fires once the queues have been declared and the
+                consumers have started.
+        """
+        queue_bindings = collections.defaultdict(list)
+        for binding in bindings:
+            queue_bindings[binding["queue"]].append(binding)
+        deferreds = []
+        for start in range(0, len(queues), self.per_connection):
+            chunk = queues[start:start + self.per_connection]
+            producer = self._add_producer(
+                queues=chunk,
+                bindings=[b for q in chunk for b in queue_bindings[q["queue"]]],
+                consumers={q["queue"]: callback for q in chunk},
+            )
+            for queue in chunk:
+                self._queues[queue["queue"]] = producer
+            self._load[producer] = len(chunk)
+            deferreds.append(producer.factory.whenConnected())
+        return defer.gatherResults(deferreds, consumeErrors=True)
+
+    def producer(self, queue_name):
+        """
+        Find the connection a queue is on.
+
+        Args:
+            queue_name (str): The name of the queue.
+
+        Returns:
+            FedoraMessagingService: The connection, or ``None`` if the queue
+                isn't on any.
+        """
+        return self._queues.get(queue_name)
+
+    def add(self, queue_name, callback):
+        """
+        Assign a queue to the least-loaded connection and start consuming it.
+
+        Args:
+            queue_name (str): The name of the queue.
+            callback (callable): The consumer callback.
+
+        Returns:
+            defer.Deferred: Fires once the consumer has started.
+        """
+        producer = min(self._load, key=self._load.get) if self._load else None
+        if producer is None or self._load[producer] >= self.per_connection:
+            producer = self._add_producer()
+            self._load[producer] = 0
+        self._queues[queue_name] = producer
+        self._load[producer] += 1
+        return defer.maybeDeferred(producer.factory.consume, callback, queue_name)
+
+    def remove(self, queue_name):
+        """
+        Stop consuming a queue, and retire its connection if it has no queues left.
+
+        Args:
+            queue_name (str): The name of the queue.
+
+        Returns:
+            defer.Deferred: Fires once the consumer has been canceled.
+        """
+        producer = self._queues.pop(queue_name)
+        self._load[producer] -= 1
+        d = defer.maybeDeferred(producer.factory.cancel, queue_name)
+        if not self._load[producer] and len(self._load) > 1:
+            d.addBoth(self._retire, producer)
+        return d
+
+    def start(self):
+        """Connect to the broker."""
+        self.running = True
+        for producer in self.producers:
+            producer.startService()
+
+    def stop(self):
+        """
+        Disconnect from the broker.
+
+        Returns:
+            defer.Deferred: Fires once every connection is closed.
+        """
+        self.running = False
+        return defer.gatherResults(
+            [defer.maybeDeferred(producer.stopService) for producer in self.producers],
+            consumeErrors=True,
+        )
+
+    def stats(self):
+        """
+        Report how the queues are spread over the connections.
+
+        Returns:
+            dict: The number of connections and queues, and the number of
+                queues on the busiest connection.
+        """
+        return {
+            "connections": len(self.producers),
+            "queues": len(self._queues),
+            "max_per_connection": max(self._load.values()) if self._load else 0,
+        }
+
+    def _add_producer(self, queues=None, bindings=None, consumers=None):
+        producer = FedoraMessagingService(queues=queues, bindings=bindings, consumers=consumers)
+        producer.setName("{}-{}".format(self.name, self._created))
+        self._created += 1
+        producer.setServiceParent(self.parent)
+        self.producers.append(producer)
+        if self.running:
+            _log.info("Starting AMQP connection %s", producer.name)
+            producer.startService()
+        return producer
+
+    def _retire(self, result, producer):
+        """Close a connection that no longer has any queues."""
+        if self._load.get(producer) != 0:
+            # A queue was assigned to it while its last one was being canceled
+            return result
+        _log.info("Retiring AMQP connection %s, which has no queues left", producer.name)
+        del self._load[producer]
+        self.producers.remove(producer)
+        d = defer.maybeDeferred(producer.stopService)
+        d.addBoth(lambda _: producer.disownServiceParent())
+        return result
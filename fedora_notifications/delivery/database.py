@@ -0,0 +1,267 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Access the database from the delivery service without blocking the reactor.
+
+SQLAlchemy is synchronous, so a query run on the reactor thread stops the IRC
+connections from sending lines and the AMQP connections from sending
+heartbeats until it returns. The :class:`Database` runs functions in a session
+on a thread pool of its own and returns a Deferred for their results. The pool
+is bounded so the delivery service never opens more database connections than
+it's configured to (see :ref:`conf-database-threads`), and it's separate from
+the reactor's thread pool so slow queries can't starve DNS lookups or the other
+work the reactor does in threads.
+
+The scoped :data:`.db.Session` hands out a session per thread, and those
+sessions are only cleaned up by calling ``Session.remove`` in the same thread.
+That doesn't fit a pool of threads that run unrelated work, so each function
+gets a session of its own that is committed (or rolled back) and closed as soon
+as the function returns. Sessions come from the scoped session's factory, so
+they use the same engine and event listeners.
+
+The functions at the bottom of this module are the queries the delivery
+service makes; each takes the session as its first argument. The queues are
+loaded at startup from a read replica if there are any (see
+:ref:`conf-database-replica-urls`); a stale page only means some bindings are
+declared again. Lookups that follow a change to a queue go to the primary so
+they see the change.
+"""
+from twisted.internet import reactor as global_reactor, threads
+from twisted.python import failure, threadpool
+from sqlalchemy import sql
+
+from .. import db
+from ..db.queries import QueueQuery
+
+
+class Database(object):
+    """
+    A bounded thread pool that runs functions in database sessions.
+
+    Args:
+        size (int): The maximum number of threads, and so of concurrent sessions.
+        name (str): The name of the thread pool, used to name its threads.
+        reactor (twisted.internet.interfaces.IReactorThreads): The reactor to
+            deliver results on.
+
+    Attributes:
+        size (int): The maximum number of threads.
+        pending (int): The number of functions waiting for or running in a thread.
+        calls (int): The number of functions that finished.
+        failures (int): The number of functions that raised an exception.
+    """
+
+    def __init__(self, size, name="database", reactor=global_reactor):
+        self.size = size
+        self.pending = 0
+        self.calls = 0
+        self.failures = 0
+        self._reactor = reactor
+        self._pool = threadpool.ThreadPool(minthreads=0, maxthreads=size, name=name)
+
+    def start(self):
+        """Start the thread pool."""
+        self._pool.start()
+
+    def stop(self):
+        """
+        Stop the thread pool once the functions already submitted have run.
+
+        This blocks until they finish.
+        """
+        self._pool.stop()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run a function in a session on the thread pool.
+
+        The function is called with a new session followed by the arguments.
+        If it returns, the session is committed; if it raises, the session is
+        rolled back. Either way the session is closed. Objects the function
+        loads aren't expired by the commit, but it should still return plain
+        data rather than objects that need the session to load more.
+
+        Args:
+            func (callable): The function to run.
+            args: The positional arguments to pass after the session.
+            kwargs: The keyword arguments to pass.
+
+        Returns:
+            defer.Deferred: Fires with the function's result, or fails with
+                its exception.
+        """
+        self.pending += 1
+        d = threads.deferToThreadPool(
+            self._reactor, self._pool, self.run_blocking, func, *args, **kwargs
+        )
+        d.addBoth(self._finished)
+        return d
+
+    def run_blocking(self, func, *args, **kwargs):
+        """
+        Run a function in a session in the calling thread.
+
+        This blocks, so on the reactor thread it should only be used before
+        the reactor starts. See :meth:`run` for how the session is handled.
+
+        Args:
+            func (callable): The function to run.
+            args: The positional arguments to pass after the session.
+            kwargs: The keyword arguments to pass.
+
+        Returns:
+            object: The function's result.
+        """
+        session = db.Session.session_factory(expire_on_commit=False)
+        try:
+            result = func(session, *args, **kwargs)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def stats(self):
+        """
+        Report how busy the thread pool is.
+
+        Returns:
+            dict: The size of the pool, the number of threads it has started,
+                the number of functions pending and finished, the number that
+                failed, and the state of the database connection pools.
+        """
+        return {
+            "size": self.size,
+            "threads": len(self._pool.threads),
+            "pending": self.pending,
+            "calls": self.calls,
+            "failures": self.failures,
+            "connection_pools": db.pool_stats(),
+        }
+
+    def _finished(self, result):
+        self.pending -= 1
+        self.calls += 1
+        if isinstance(result, failure.Failure):
+            self.failures += 1
+        return result
+
+
+def _queues(session):
+    """Start a :class:`.QueueQuery` in a session."""
+    return QueueQuery(db.Queue, session=session)
+
+
+def get_queues(session, delivery_types, after=None, limit=None, with_bindings=False):
+    """
+    Load a page of queues.
+
+    Queues are loaded in order of their IDs, so the next page starts after the
+    last queue of this one. See :meth:`.QueueQuery.consumable`.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session.
+        delivery_types (list of DeliveryType): The enabled delivery types.
+        after (uuid.UUID): The ID of the last queue of the previous page, or
+            ``None`` for the first page.
+        limit (int): The maximum number of queues to load, or ``None`` to load
+            them all.
+        with_bindings (bool): Whether to load the bindings of the queues that
+            aren't batched even if they haven't changed.
+
+    Returns:
+        tuple: The ID of the last queue loaded, or ``None`` if there are no
+            more, and a list of :class:`.QueueRecord`.
+    """
+    with db.replica(session):
+        page = _queues(session).consumable(delivery_types, after, limit, with_bindings)
+    return (page[-1].id if page else None), page
+
+
+def get_bindings(session, queue_ids):
+    """
+    Load the bindings of some queues.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session.
+        queue_ids (list of uuid.UUID): The IDs of the queues.
+
+    Returns:
+        dict: Maps the ID of each queue that still exists to its bindings.
+    """
+    with db.replica(session):
+        return _queues(session).bindings_by_id(queue_ids)
+
+
+def get_queue_bindings(session, queue_name):
+    """
+    Load the bindings of a queue by name.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session.
+        queue_name (str): The name of the queue.
+
+    Returns:
+        list of dict: The bindings, or ``None`` if the queue doesn't exist.
+    """
+    queue = _queues(session).by_name(queue_name).with_bindings().first()
+    return queue.bindings() if queue else None
+
+
+def get_batch_interval(session, queue_name):
+    """
+    Look up the batch interval of a queue by name.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session.
+        queue_name (str): The name of the queue.
+
+    Returns:
+        int: The batch interval in minutes, or ``None`` if the queue isn't
+            batched or doesn't exist.
+    """
+    return _queues(session).by_name(queue_name).with_entities(db.Queue.batch).scalar()
+
+
+def set_applied_topology(session, applied):
+    """
+    Record the bindings fingerprints that were declared on the broker.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session.
+        applied (dict): Maps queue IDs to the fingerprints of the bindings that
+            were declared.
+    """
+    if not applied:
+        return
+    queues = db.Queue.__table__
+    statement = queues.update().where(queues.c.id == sql.bindparam("queue_id")).values(
+        applied_topology=sql.bindparam("fingerprint"),
+        topology=sql.func.coalesce(queues.c.topology, sql.bindparam("fingerprint")),
+    )
+    session.execute(
+        statement, [{"queue_id": k, "fingerprint": v} for k, v in applied.items()]
+    )
+
+
+def advance_applied_topology(session, queue_name, previous, fingerprint):
+    """
+    Record that a change to a queue's bindings was applied on the broker.
+
+    The fingerprint is only updated if the broker had the previous bindings;
+    otherwise the queue is declared in full next time.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session.
+        queue_name (str): The name of the queue.
+        previous (str): The fingerprint of the bindings before the change.
+        fingerprint (str): The fingerprint of the bindings after the change.
+    """
+    if previous is None or fingerprint is None:
+        return
+    _queues(session).by_name(queue_name).filter_by(applied_topology=previous).update(
+        {"applied_topology": fingerprint}, synchronize_session=False
+    )
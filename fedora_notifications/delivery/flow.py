@@ -0,0 +1,72 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Flow control between the AMQP consumers and the delivery backends.
+
+The fedora-messaging consumer waits for its callback to finish before it reads
+the next message for that queue, so holding a callback until the backend has
+capacity stops the consumer. Once a consumer's prefetch window is full, the
+broker stops sending it messages, so a backend that can't keep up pushes back
+all the way to the broker rather than buffering work in memory.
+"""
+import logging
+
+from twisted.internet import defer
+
+_log = logging.getLogger(__name__)
+
+
+class DeliveryLimiter(defer.DeferredSemaphore):
+    """
+    Cap the number of deliveries a backend has in progress at once.
+
+    Deliveries started with :meth:`run` beyond the cap wait, in order, for one
+    of the in-progress deliveries to finish.
+
+    Args:
+        name (str): The name of the backend, used in log messages.
+        limit (int): The maximum number of deliveries in flight.
+    """
+
+    def __init__(self, name, limit):
+        defer.DeferredSemaphore.__init__(self, limit)
+        self.name = name
+        self._saturated = False
+
+    @property
+    def in_flight(self):
+        """int: The number of deliveries in progress."""
+        return self.limit - self.tokens
+
+    @property
+    def queued(self):
+        """int: The number of deliveries waiting for one in progress to finish."""
+        return len(self.waiting)
+
+    def acquire(self):
+        d = defer.DeferredSemaphore.acquire(self)
+        if self.waiting and not self._saturated:
+            self._saturated = True
+            _log.warning(
+                "%s delivery has reached its limit of %d deliveries in flight; "
+                "consumers will wait for deliveries to complete",
+                self.name,
+                self.limit,
+            )
+        return d
+
+    def release(self):
+        defer.DeferredSemaphore.release(self)
+        if self._saturated and not self.waiting:
+            self._saturated = False
+            _log.info("%s delivery is below its in-flight limit, resuming", self.name)
+
+    def stats(self):
+        """
+        Report the state of the limiter.
+
+        Returns:
+            dict: The number of deliveries in flight and the number queued.
+        """
+        return {"in_flight": self.in_flight, "queued": self.queued}
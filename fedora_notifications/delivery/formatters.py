@@ -3,9 +3,56 @@
 # Copyright (C) 2018 Red Hat, Inc.
 """Message formatters for email and IRC."""
 
-import email as email_module
+import collections
+import json
+from email import policy, quoprimime
+from email.message import EmailMessage
 
-from . import config
+from fedora_messaging import message as fm_message
+
+from .. import config
+
+#: The policy used for emails. Twisted's SMTP client converts line endings to
+#: CRLF as it sends, so emails are generated with the default "\n" line endings.
+_policy = policy.default
+
+#: The encoder used to render the headers and body of messages that use the
+#: default fedora-messaging format; it matches :meth:`fedora_messaging.message.Message.__str__`.
+_json_encoder = json.JSONEncoder(sort_keys=True, indent=4, separators=(",", ": "))
+
+#: Appended to message bodies that were cut short because they were too large.
+_TRUNCATED_MARKER = "\n\n[This notification was truncated because it is larger than {} bytes]\n"
+
+#: Separates the summaries of notifications merged onto one IRC line.
+_IRC_SEPARATOR = " | "
+
+#: A message rendered for delivery. Rendering is the expensive part of formatting
+#: a notification, so this is produced once per message and reused for every
+#: recipient.
+#:
+#: Attributes:
+#:     id (str): The message ID.
+#:     summary (str): The message summary, used as the email subject and IRC line.
+#:     body (bytes): The UTF-8 encoded message body.
+#:     mime_body (str): The body, quoted-printable encoded for inclusion in an email.
+RenderedMessage = collections.namedtuple(
+    "RenderedMessage", ("id", "summary", "body", "mime_body")
+)
+
+
+def render(message):
+    """
+    Render a message for delivery.
+
+    The body is limited to the configured ``EMAIL_MAX_BODY_SIZE``.
+
+    Args:
+        message (.message.Message): A message from fedora-messaging.
+    Returns:
+        RenderedMessage: The rendered message.
+    """
+    body = _message_body(message, config.conf["EMAIL_MAX_BODY_SIZE"])
+    return RenderedMessage(message.id, message.summary, body, _quoted_printable(body))
 
 
 def _base_email(email_address):
@@ -15,39 +62,164 @@ def _base_email(email_address):
     Args:
         email_address (str): The recipient's email address.
     Returns:
-        email.Message.Message: The email message object with the 'Precedence' and 'Auto-Submitted'
-            headers set.
+        email.message.EmailMessage: The email message object with the 'Precedence' and
+            'Auto-Submitted' headers set.
     """
-    email_message = email_module.Message.Message()
+    email_message = EmailMessage(policy=_policy)
     # Although this is a non-standard header and RFC 2076 discourages it, some
     # old clients don't honour RFC 3834 and will auto-respond unless this is set.
-    email_message.add_header("Precedence", "Bulk")
+    email_message["Precedence"] = "Bulk"
     # Mark this mail as auto-generated so auto-responders don't respond; see RFC 3834
-    email_message.add_header("Auto-Submitted", "auto-generated")
-    email_message.add_header("From", config.conf["email_from_address"])
-    email_message.add_header("To", email_address)
+    email_message["Auto-Submitted"] = "auto-generated"
+    email_message["From"] = config.conf["EMAIL_FROM_ADDRESS"]
+    email_message["To"] = email_address
 
     return email_message
 
 
-def single_message_email(email_address, message):
+def _set_body(email_message, mime_body):
+    """
+    Attach an already-encoded body to an email.
+
+    Args:
+        email_message (email.message.EmailMessage): The email.
+        mime_body (str): The UTF-8 body, quoted-printable encoded.
+    """
+    email_message["MIME-Version"] = "1.0"
+    email_message["Content-Type"] = 'text/plain; charset="utf-8"'
+    email_message["Content-Transfer-Encoding"] = "quoted-printable"
+    email_message.set_payload(mime_body)
+
+
+def single_message_email(email_address, rendered):
     """
     Format a single message for an email notification.
 
     Args:
         email_address (str): The recipient's email address.
-        message (.message.Message): A message from fedora-messaging.
+        rendered (RenderedMessage): The rendered fedora-messaging message.
     Returns:
-        email.Message.Message: The email.
+        email.message.EmailMessage: The email.
     """
     email = _base_email(email_address)
-    email.add_header("Subject", message.summary)
+    email["Subject"] = _one_line(rendered.summary)
+    _set_body(email, rendered.mime_body)
+
+    return email
 
-    payload = str(message)
-    if len(payload) >= 500000:
-        # Someone has done something scary in their __str__ implementation
-        payload = ("Message {} was too large to be sent!\n").format(message.id)
 
-    email.set_payload(payload)
+def digest_email(email_address, rendered_messages):
+    """
+    Format several messages as a single email notification.
+
+    Args:
+        email_address (str): The recipient's email address.
+        rendered_messages (list of RenderedMessage): The rendered fedora-messaging
+            messages, in the order they should appear.
+    Returns:
+        email.message.EmailMessage: The email.
+    """
+    email = _base_email(email_address)
+    email["Subject"] = "{} Fedora notifications".format(len(rendered_messages))
+
+    sections = []
+    for rendered in rendered_messages:
+        summary = _one_line(rendered.summary)
+        sections.append(
+            b"\n".join((summary.encode("utf-8"), b"-" * len(summary), rendered.body))
+        )
+    _set_body(email, _quoted_printable(b"\n\n".join(sections)))
 
     return email
+
+
+def irc_lines(summaries, width, max_lines):
+    """
+    Merge several notifications to the same IRC recipient into as few lines as possible.
+
+    Summaries are joined with " | " while they fit on a line. If they don't all
+    fit in ``max_lines`` lines, the rest are counted in an extra line.
+
+    Args:
+        summaries (list of str): The summaries of the notifications, in order.
+        width (int): The maximum length of a line.
+        max_lines (int): The maximum number of lines of summaries.
+    Returns:
+        list of str: The lines to send.
+    """
+    lines = []
+    included = 0
+    for summary in summaries:
+        summary = _one_line(summary)
+        if lines and len(lines[-1]) + len(_IRC_SEPARATOR) + len(summary) <= width:
+            lines[-1] += _IRC_SEPARATOR + summary
+        elif len(lines) < max_lines:
+            lines.append(summary)
+        else:
+            break
+        included += 1
+    if included < len(summaries):
+        lines.append("...and {} more".format(len(summaries) - included))
+    return lines
+
+
+def _message_body(message, max_size):
+    """
+    Produce the body of a message, guarding against enormous message bodies.
+
+    Rendering stops as soon as the body exceeds ``max_size`` bytes, and the body
+    is cut at that size and marked as truncated.
+
+    Args:
+        message (.message.Message): A message from fedora-messaging.
+        max_size (int): The maximum size of the body in bytes, not counting the
+            truncation marker.
+    Returns:
+        bytes: The UTF-8 encoded message body.
+    """
+    chunks = []
+    size = 0
+    for chunk in _message_body_chunks(message):
+        chunk = chunk.encode("utf-8")
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_size:
+            body = b"".join(chunks)
+            # Don't cut a multi-byte character in half
+            end = max_size
+            while end and body[end] & 0xC0 == 0x80:
+                end -= 1
+            return body[:end] + _TRUNCATED_MARKER.format(max_size).encode("utf-8")
+    return b"".join(chunks)
+
+
+def _message_body_chunks(message):
+    """
+    Render a message body piece by piece.
+
+    Messages that use the default fedora-messaging format are rendered
+    incrementally so that rendering can stop part way through. Message classes
+    that override ``__str__`` can only be rendered in one go.
+
+    Args:
+        message (.message.Message): A message from fedora-messaging.
+    Yields:
+        str: Consecutive pieces of the message body.
+    """
+    if type(message).__str__ is not fm_message.Message.__str__:
+        yield str(message)
+        return
+    yield "Id: {}\nTopic: {}\nHeaders: ".format(message.id, message.topic)
+    yield from _json_encoder.iterencode(message._headers)
+    yield "\nBody: "
+    yield from _json_encoder.iterencode(message._body)
+
+
+def _quoted_printable(body):
+    """Quoted-printable encode a UTF-8 body for inclusion in an email."""
+    return quoprimime.body_encode(body.decode("latin-1"))
+
+
+def _one_line(text):
+    """Collapse a summary onto a single line so it can be used as a header."""
+    return " ".join(text.splitlines())
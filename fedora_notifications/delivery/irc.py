@@ -2,36 +2,172 @@
 #
 # Copyright (C) 2018 Red Hat, Inc.
 """The Twisted IRC client for notification delivery."""
+import bisect
+import collections
+import hashlib
 import logging
 
+from twisted.application import internet, service
 from twisted.words.protocols import irc
-from twisted.internet import defer
+from twisted.internet import defer, protocol, reactor as global_reactor, task
+from twisted.python import failure
 
-from .. import config
+from . import formatters, presence, throttle
+from .. import config, exceptions
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 
+#: The notifications collected for a recipient while its coalescing window is
+#: open, the Deferreds to fire once they're sent, and the call that closes it.
+_Burst = collections.namedtuple("_Burst", ("summaries", "waiting", "call"))
+
+#: The recipients waiting to be sent the same text in a multi-target PRIVMSG,
+#: each with the Deferred to fire once it's sent, and the call that sends it.
+_FanOut = collections.namedtuple("_FanOut", ("targets", "call"))
+
+
 class IrcProtocol(irc.IRCClient):
     """
     A sub-class of the IRC protocol implementation in Twisted that handles
     events and sends messages.
 
+    Lines are sent through a :class:`throttle.FairSendQueue` rather than
+    Twisted's fixed ``lineRate`` delay, so the client sends as fast as the
+    server's flood limits allow and takes turns between recipients.
+
+    Bursts of notifications to the same recipient are coalesced: the first
+    notification is sent right away and opens a window of
+    ``IRC_COALESCE_WINDOW`` seconds. Notifications that arrive during the
+    window are merged onto as few lines as possible when it closes, and a new
+    window opens if there were any. Their deliveries aren't complete, and so
+    their messages aren't acknowledged, until the merged lines are written.
+
+    The lines in the send queue and the notifications waiting for a window to
+    close make up the client's outbound buffer, which holds at most
+    ``IRC_MAX_BUFFERED`` of them. When it's full, :meth:`deliver` waits for it
+    to drain to half that before accepting more, which holds up the consumer
+    callbacks and so stops the IRC consumers.
+
+    Unless ``IRC_OFFLINE_POLICY`` is "send", the client tracks whether the nicks
+    it delivers to are online with a :class:`presence.PresenceCache`.
+    Notifications to nicks known to be offline are either dropped or, with the
+    "park" policy, refused with :class:`exceptions.RetryLater` so they wait in
+    the delayed retry queues and are delivered again later.
+
+    Identical notifications to different recipients are sent as a single
+    PRIVMSG to several targets, as many as the server's ``TARGMAX`` (or
+    ``MAXTARGETS``) and the line length allow. The first is sent right away and
+    opens a window of ``IRC_FANOUT_WINDOW`` milliseconds; the recipients of the
+    same notification during the window are sent it together when it closes.
+    The line takes a turn from each of its targets in the send queue.
+
     Attributes:
-        lineRate (float): The number of seconds of delay between lines sent
-            to the IRC server, useful to avoid throttling.
+        send_queue (throttle.FairSendQueue): The lines waiting to be sent.
+        max_buffered (int): The capacity of the outbound buffer.
+        coalesced (int): The number of notifications merged with others.
+        lines_saved (int): The number of lines coalescing has saved.
+        presence (presence.PresenceCache): The online status of recipients, or
+            ``None`` if deliveries to offline nicks are sent anyway.
+        offline_lines_saved (int): The number of lines not sent to offline nicks.
+        fanout_lines_saved (int): The number of lines saved by sending
+            notifications to several targets at once.
         sourceURL (str): Response used in the CTCP SOURCE request.
     """
 
     def __init__(self, *args, **kwargs):
-        self.lineRate = 0.6
+        self.lineRate = None
+        self.send_queue = throttle.FairSendQueue(
+            self._send,
+            burst=config.conf["IRC_SEND_BURST"],
+            rate=config.conf["IRC_SEND_RATE"],
+            byte_cost=config.conf["IRC_SEND_BYTE_COST"],
+        )
+        self.coalesce_window = config.conf["IRC_COALESCE_WINDOW"]
+        self.coalesce_max_lines = config.conf["IRC_COALESCE_MAX_LINES"]
+        self.coalesced = 0
+        self.lines_saved = 0
+        self.max_buffered = config.conf["IRC_MAX_BUFFERED"]
+        # Map recipients to the summaries waiting for their window to close,
+        # and the call that closes it.
+        self._bursts = {}
+        self._burst_summaries = 0
+        # Deliveries waiting for room in the outbound buffer
+        self._room_waiters = []
+        self.offline_policy = config.conf["IRC_OFFLINE_POLICY"]
+        self.presence = None
+        if self.offline_policy != "send":
+            self.presence = presence.PresenceCache(
+                self.sendLine,
+                max_nicks=config.conf["IRC_PRESENCE_MAX_NICKS"],
+                poll_interval=config.conf["IRC_PRESENCE_INTERVAL"],
+            )
+        self.offline_lines_saved = 0
+        self.fanout_window = config.conf["IRC_FANOUT_WINDOW"] / 1000
+        self.fanout_lines_saved = 0
+        # Map summaries to the recipients waiting to be sent them
+        self._fanouts = {}
+        self._fanout_targets = 0
         self.sourceURL = "http://github.com/fedora-infra/fedora-notifications"
         self.realname = "Fedora Notification Service"
         self.nickname = config.conf["IRC_NICK"]
         self.commands = {}
         self.authentication_done = defer.Deferred()
 
+    def connectionMade(self):
+        irc.IRCClient.connectionMade(self)
+        self.factory.client = self
+
+    def connectionLost(self, reason):
+        self.send_queue.clear(reason)
+        bursts = list(self._bursts.values())
+        self._bursts.clear()
+        self._burst_summaries = 0
+        for burst in bursts:
+            if burst.call.active():
+                burst.call.cancel()
+            _fire_all(reason, burst.waiting)
+        if self.presence is not None:
+            self.presence.stop()
+        fanouts = list(self._fanouts.values())
+        self._fanouts.clear()
+        self._fanout_targets = 0
+        for fanout in fanouts:
+            if fanout.call.active():
+                fanout.call.cancel()
+            for _, d in fanout.targets:
+                d.errback(reason)
+        waiters, self._room_waiters = self._room_waiters, []
+        for d in waiters:
+            d.errback(reason)
+        if self.factory.client is self:
+            self.factory.client = None
+        irc.IRCClient.connectionLost(self, reason)
+
+    @property
+    def buffered(self):
+        """int: The number of lines and grouped notifications waiting to be sent."""
+        return self.send_queue.depth + self._burst_summaries + self._fanout_targets
+
+    def sendLine(self, line):
+        """
+        Queue a line to be sent to the server.
+
+        Messages and notices are queued by recipient; everything else is sent
+        ahead of them.
+        """
+        destination = None
+        if line.startswith(("PRIVMSG ", "NOTICE ")):
+            destination = _destination(line.split(" ", 2)[1])
+        self.send_queue.put(line, destination)
+
+    def _send(self, line):
+        """Write a line the send queue has released to the server."""
+        self.factory.lines_sent += 1
+        self._reallySendLine(line)
+        self._release_waiters()
+
     def signedOn(self):
         """
         Called when the client has successfully connected to the IRC server.
@@ -39,27 +175,281 @@ class IrcProtocol(irc.IRCClient):
         Note that at this point the client is not authenticated with NickServ.
         """
         log.info("Signed on to %s as %r.", self.hostname, self.nickname)
+        if self.presence is not None:
+            self.presence.start()
         if config.conf["IRC_PASSWORD"]:
             log.info("Identifying with NickServ as %s", self.nickname)
             self.msg(
                 "NickServ",
                 "IDENTIFY {nick} {password}".format(
-                    nick=config.conf["IRC_NICK"], password=config.conf["IRC_PASSWORD"]
+                    nick=self.nickname, password=config.conf["IRC_PASSWORD"]
                 ),
             )
         else:
             self.authentication_done.callback(None)
 
-    def deliver(self, message):
+    @defer.inlineCallbacks
+    def deliver(self, message, summary=None):
         """
         Deliver a message to a user or channel.
 
         Args:
-            identity (str): The user or channel to send the message to.
-            message (str): The formatted message ready for delivery.
+            message (fedora_messaging.message.Message): The message to deliver;
+                the recipient is taken from the name of the queue it arrived on.
+            summary (str): The already-rendered summary of the message. If it's
+                not provided, the message's summary is used.
+
+        Returns:
+            defer.Deferred: Fires once the message has been written to the
+                server or, if it's being coalesced with others, once the lines
+                it was merged onto have been. Errbacks with the reason the
+                connection closed if it closes first, or with
+                :class:`exceptions.RetryLater` if the recipient is offline and
+                the offline policy is "park".
         """
         user = message.queue.split('.', 1)[1]
-        return self.msg(user, message.summary)
+        if summary is None:
+            summary = message.summary
+        while self.buffered >= self.max_buffered:
+            yield self._wait_for_room()
+        if (
+            self.presence is not None
+            and user[0] not in irc.CHANNEL_PREFIXES
+            and self.presence.lookup(user) is False
+        ):
+            self._skip_offline(user, summary)
+            return
+        if self.coalesce_window:
+            burst = self._bursts.get(user)
+            if burst is not None:
+                d = defer.Deferred()
+                burst.summaries.append(summary)
+                burst.waiting.append(d)
+                self._burst_summaries += 1
+                yield d
+                return
+            self._open_burst(user)
+        if self.fanout_window and user[0] not in irc.CHANNEL_PREFIXES:
+            yield self._fan_out(user, summary)
+        else:
+            yield self._privmsg(user, summary)
+
+    def stats(self):
+        """
+        Report the state of the client.
+
+        Returns:
+            dict: The send queue statistics, the number of notifications
+                coalesced and the lines saved by doing so, the number of
+                recipients with a coalescing window open, the outbound buffer
+                depth, and the number of deliveries waiting for room in it.
+        """
+        stats = self.send_queue.stats()
+        stats.update(
+            {
+                "coalesced": self.coalesced,
+                "lines_saved": self.lines_saved,
+                "bursts": len(self._bursts),
+                "buffered": self.buffered,
+                "waiting": len(self._room_waiters),
+                "fanout_lines_saved": self.fanout_lines_saved,
+            }
+        )
+        if self.presence is not None:
+            stats["presence"] = self.presence.stats()
+            stats["presence"]["lines_saved"] = self.offline_lines_saved
+        return stats
+
+    def isupport(self, options):
+        """Monitor recipients' presence if the server supports ``MONITOR``."""
+        if self.presence is None or not any(
+            option.split("=", 1)[0] == "MONITOR" for option in options
+        ):
+            return
+        limit = self.supported.getFeature("MONITOR")[0]
+        self.presence.set_monitor_limit(int(limit) if limit else self.presence.max_nicks)
+
+    def irc_730(self, prefix, params):
+        """RPL_MONONLINE: monitored nicks are online."""
+        if self.presence is not None:
+            nicks = [target.split("!", 1)[0] for target in params[1].split(",")]
+            self.presence.set_status(nicks, True)
+
+    def irc_731(self, prefix, params):
+        """RPL_MONOFFLINE: monitored nicks are offline."""
+        if self.presence is not None:
+            self.presence.set_status(params[1].split(","), False)
+
+    def irc_734(self, prefix, params):
+        """ERR_MONLISTFULL: the server won't monitor any more nicks."""
+        if self.presence is not None:
+            self.presence.monitor_list_full(params[2].split(","))
+
+    def irc_RPL_ISON(self, prefix, params):
+        """The reply to an ISON poll: the polled nicks that are online."""
+        if self.presence is not None:
+            self.presence.ison_reply(params[1].split())
+
+    def irc_ERR_NOSUCHNICK(self, prefix, params):
+        """A message was sent to a nick that isn't online."""
+        if self.presence is not None:
+            self.presence.set_status([params[1]], False)
+
+    def _privmsg(self, user, text):
+        """
+        Queue a message like :meth:`msg` does, and track when it's sent.
+
+        Args:
+            user (str): The recipient, or several comma-separated recipients.
+            text (str): The message.
+
+        Returns:
+            defer.Deferred: Fires when the last line of the message has been
+                written; lines to the same recipient are sent in order.
+        """
+        fmt = "PRIVMSG {} :".format(user)
+        destination = _destination(user)
+        lines = irc.split(text, self._line_width(user))
+        if not lines:
+            return defer.succeed(None)
+        for line in lines[:-1]:
+            self.send_queue.put(fmt + line, destination)
+        return self.send_queue.put(fmt + lines[-1], destination, track=True)
+
+    def _fan_out(self, user, summary):
+        """
+        Send a summary to a recipient right away if nobody else was sent it
+        recently, or add them to the group waiting to be sent it.
+
+        Returns:
+            defer.Deferred: Fires once the summary has been sent to the recipient.
+        """
+        fanout = self._fanouts.get(summary)
+        if fanout is None:
+            call = global_reactor.callLater(self.fanout_window, self._send_fanout, summary)
+            self._fanouts[summary] = _FanOut([], call)
+            return self._privmsg(user, summary)
+        d = defer.Deferred()
+        fanout.targets.append((user, d))
+        self._fanout_targets += 1
+        return d
+
+    def _send_fanout(self, summary):
+        """Send a summary to everyone in its group, with as few lines as possible."""
+        targets = self._fanouts.pop(summary).targets
+        if not targets:
+            return
+        self._fanout_targets -= len(targets)
+        for group in self._target_groups(targets, summary):
+            d = self._privmsg(",".join(user for user, _ in group), summary)
+            d.addBoth(_fire_all, [waiting for _, waiting in group])
+        self._release_waiters()
+
+    def _target_groups(self, targets, summary):
+        """
+        Split recipients into groups that can each be sent a summary on one line.
+
+        Groups are limited by the server's TARGMAX for PRIVMSG, or failing
+        that its MAXTARGETS, and by the length of the line. If the summary
+        won't fit on one line even to a single recipient, each recipient gets
+        their own messages.
+
+        Args:
+            targets (list of tuple): The recipients, each with its Deferred.
+            summary (str): The text to send them.
+
+        Returns:
+            list of list: The groups of targets.
+        """
+        max_targets = self._max_targets()
+        groups = []
+        for target in targets:
+            if groups and len(groups[-1]) < max_targets:
+                users = [user for user, _ in groups[-1]] + [target[0]]
+                if self._line_width(",".join(users)) >= len(summary):
+                    groups[-1].append(target)
+                    continue
+            groups.append([target])
+        self.fanout_lines_saved += len(targets) - len(groups)
+        return groups
+
+    def _max_targets(self):
+        """The number of targets the server accepts in one PRIVMSG."""
+        targmax = self.supported.getFeature("TARGMAX")
+        if targmax is not None and "PRIVMSG" in targmax:
+            return targmax["PRIVMSG"] or float("inf")
+        maxtargets = self.supported.getFeature("MAXTARGETS")
+        if maxtargets and maxtargets[0]:
+            return int(maxtargets[0])
+        return 1
+
+    def _line_width(self, user):
+        """The length of the longest message text that fits on one line to ``user``."""
+        fmt = "PRIVMSG {} :".format(user)
+        return self._safeMaximumLineLength(fmt) - len(fmt) - 2
+
+    def _skip_offline(self, user, summary):
+        """
+        Skip a notification to an offline nick.
+
+        Raises:
+            exceptions.RetryLater: If the offline policy is "park", so the
+                notification is tried again later rather than dropped.
+        """
+        self.offline_lines_saved += len(irc.split(summary, self._line_width(user)))
+        if self.offline_policy == "park":
+            raise exceptions.RetryLater()
+
+    def _wait_for_room(self):
+        """Wait for the outbound buffer to drain to half its capacity."""
+        if not self._room_waiters:
+            log.warning(
+                "The outbound buffer of %s is full (%d lines); pausing deliveries",
+                self.nickname,
+                self.max_buffered,
+            )
+        d = defer.Deferred()
+        self._room_waiters.append(d)
+        return d
+
+    def _release_waiters(self):
+        """Let deliveries waiting for room proceed once the buffer has drained."""
+        if self._room_waiters and self.buffered <= self.max_buffered // 2:
+            log.info("The outbound buffer of %s has drained; resuming deliveries", self.nickname)
+            waiters, self._room_waiters = self._room_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def _open_burst(self, user):
+        """Start collecting notifications to a recipient."""
+        call = global_reactor.callLater(self.coalesce_window, self._close_burst, user)
+        self._bursts[user] = _Burst([], [], call)
+
+    def _close_burst(self, user):
+        """Send the notifications collected for a recipient on as few lines as possible."""
+        burst = self._bursts.pop(user)
+        if not burst.summaries:
+            return
+        self._burst_summaries -= len(burst.summaries)
+        self._send_summaries(user, burst.summaries).addBoth(_fire_all, burst.waiting)
+        self._open_burst(user)
+        self._release_waiters()
+
+    def _send_summaries(self, user, summaries):
+        """
+        Send several notifications to a recipient on as few lines as possible.
+
+        Returns:
+            defer.Deferred: Fires when the last of the lines has been written.
+        """
+        lines = formatters.irc_lines(summaries, self._line_width(user), self.coalesce_max_lines)
+        if len(summaries) > 1:
+            self.coalesced += len(summaries)
+            self.lines_saved += len(summaries) - len(lines)
+        d = defer.succeed(None)
+        for line in lines:
+            d = self._privmsg(user, line)
+        return d
 
     def privmsg(self, user, channel, msg):
         """Called when a user sends a private message to the client."""
@@ -68,6 +458,8 @@ class IrcProtocol(irc.IRCClient):
             self._handle_nickserv_messages(msg)
         else:
             nick = user.split("!")[0]
+            if self.presence is not None:
+                self.presence.set_status([nick], True)
             command = msg.split(None, 1)[0].lower()
             try:
                 self.commands[command](nick, msg)
@@ -92,3 +484,195 @@ class IrcProtocol(irc.IRCClient):
         else:
             # TODO Provide useful feedback to the user.
             pass
+
+
+class IrcFactory(protocol.Factory):
+    """
+    Builds the :class:`IrcProtocol` and keeps track of the connected client.
+
+    Args:
+        nickname (str): The nickname the client uses.
+
+    Attributes:
+        client (IrcProtocol): The connected client, or ``None``.
+        lines_sent (int): The number of lines sent by all the clients this
+            factory has built.
+    """
+
+    protocol = IrcProtocol
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.client = None
+        self.lines_sent = 0
+
+    def buildProtocol(self, addr):
+        client = protocol.Factory.buildProtocol(self, addr)
+        client.nickname = self.nickname
+        return client
+
+
+class IrcPool(service.MultiService):
+    """
+    A pool of IRC connections, each with its own nickname and flood limits.
+
+    Recipients are assigned to connections by consistent hashing, so all the
+    messages to a recipient go through the same connection, in order, and
+    resizing the pool only moves the recipients of the connections that were
+    added or removed. If a recipient's connection is down, its messages go to
+    the next connected connection on the hash ring.
+
+    Args:
+        endpoint (twisted.internet.interfaces.IStreamClientEndpoint): The IRC server.
+        nickname (str): The nickname of the first connection; the others add
+            their index to it.
+        size (int): The number of connections.
+        first_index (int): The index of the first connection. Workers that share
+            the IRC server use different ranges of indexes so their nicknames
+            don't clash.
+        replicas (int): The number of points each connection has on the hash ring.
+        reactor (twisted.internet.interfaces.IReactorTime): The reactor to use.
+
+    Attributes:
+        connections (list of twisted.application.internet.ClientService): The
+            connections in the pool.
+        factories (list of IrcFactory): The factory of each connection.
+        send_rate (float): The number of lines sent per second by the whole pool,
+            averaged over the last ``_RATE_INTERVAL`` seconds.
+    """
+
+    def __init__(self, endpoint, nickname, size=1, first_index=0, replicas=100,
+                 reactor=global_reactor):
+        service.MultiService.__init__(self)
+        self.connections = []
+        self.factories = []
+        for index in range(first_index, first_index + size):
+            factory = IrcFactory(nickname if index == 0 else "{}{}".format(nickname, index))
+            connection = internet.ClientService(endpoint, factory)
+            connection.setServiceParent(self)
+            self.connections.append(connection)
+            self.factories.append(factory)
+
+        self._ring = sorted(
+            (_hash("{}#{}".format(factory.nickname, replica)), index)
+            for index, factory in enumerate(self.factories)
+            for replica in range(replicas)
+        )
+        self._ring_hashes = [h for h, _ in self._ring]
+
+        self.send_rate = 0.0
+        self._lines_sent = 0
+        self._rate_sampler = task.LoopingCall(self._sample_rate)
+        self._rate_sampler.clock = reactor
+
+    def startService(self):
+        service.MultiService.startService(self)
+        self._rate_sampler.start(_RATE_INTERVAL, now=False)
+
+    def stopService(self):
+        if self._rate_sampler.running:
+            self._rate_sampler.stop()
+        return service.MultiService.stopService(self)
+
+    def connection_for(self, recipient):
+        """
+        Find the connection a recipient's messages should be sent through.
+
+        Args:
+            recipient (str): The nick or channel.
+
+        Returns:
+            twisted.application.internet.ClientService: The recipient's connection
+                if it's connected, otherwise the next connected one on the ring.
+                If none of them are connected, the recipient's own connection.
+        """
+        start = bisect.bisect(self._ring_hashes, _hash(recipient)) % len(self._ring)
+        owner = self.connections[self._ring[start][1]]
+        seen = set()
+        for position in range(start, start + len(self._ring)):
+            index = self._ring[position % len(self._ring)][1]
+            if index in seen:
+                continue
+            if self.factories[index].client is not None:
+                return self.connections[index]
+            seen.add(index)
+            if len(seen) == len(self.connections):
+                break
+        return owner
+
+    def whenConnected(self, recipient, failAfterFailures=None):
+        """
+        Get a connected client to send a recipient's messages with.
+
+        Args:
+            recipient (str): The nick or channel.
+            failAfterFailures (int): Passed to
+                :meth:`twisted.application.internet.ClientService.whenConnected`.
+
+        Returns:
+            defer.Deferred: Fires with the :class:`IrcProtocol`.
+        """
+        return self.connection_for(recipient).whenConnected(
+            failAfterFailures=failAfterFailures
+        )
+
+    def probe(self):
+        """
+        Check whether any connection can reach the IRC server.
+
+        Returns:
+            defer.Deferred: Fires once a connection is established, or errbacks
+                if none of them could connect.
+        """
+        d = defer.DeferredList(
+            [c.whenConnected(failAfterFailures=1) for c in self.connections],
+            fireOnOneCallback=True,
+            consumeErrors=True,
+        )
+        d.addCallback(lambda result: None if isinstance(result, tuple) else result[0][1])
+        return d
+
+    def stats(self):
+        """
+        Report the state of the pool.
+
+        Returns:
+            dict: The pool-wide send rate and, for each connection's nickname,
+                whether it's connected and its send queue statistics.
+        """
+        stats = {"send_rate": self.send_rate, "connections": {}}
+        for factory in self.factories:
+            connection_stats = {"connected": factory.client is not None}
+            if factory.client is not None:
+                connection_stats.update(factory.client.stats())
+            stats["connections"][factory.nickname] = connection_stats
+        return stats
+
+    def _sample_rate(self):
+        lines_sent = sum(factory.lines_sent for factory in self.factories)
+        self.send_rate = (lines_sent - self._lines_sent) / _RATE_INTERVAL
+        self._lines_sent = lines_sent
+
+
+#: The number of seconds the pool's send rate is averaged over.
+_RATE_INTERVAL = 10
+
+
+def _fire_all(result, deferreds):
+    """Pass the result of sending a line on to everyone waiting for it."""
+    for d in deferreds:
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+def _destination(target):
+    """The send queue destination of a message target, or of several comma-separated ones."""
+    targets = target.split(",")
+    return targets[0] if len(targets) == 1 else tuple(targets)
+
+
+def _hash(key):
+    """Hash a key onto the consistent hashing ring."""
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
@@ -7,43 +7,81 @@ from twisted.internet import defer, error
 from twisted.mail import smtp
 from fedora_messaging.exceptions import Nack
 
-from .. import config
+from . import formatters
+from .. import config, exceptions
 
 _log = logging.getLogger(__name__)
 
 
 @defer.inlineCallbacks
-def deliver(message):
+def deliver(message, smtp_pool, render_cache):
     """
     Send an email to the given user.
 
     Args:
-        email_address (str): The recipient's email address.
-        message (str): The formatted message, ready for dispatching.
+        message (fedora_messaging.message.Message): The message to send; the
+            recipient is taken from the name of the queue it arrived on.
+        smtp_pool (smtp_pool.SMTPRelayPool): The SMTP relays and their connections
+            to send the email with.
+        render_cache (cache.RenderCache): The cache of rendered messages.
+
+    Raises:
+        exceptions.BackendUnavailable: If the SMTP server couldn't be reached.
+        exceptions.RetryLater: If the email couldn't be sent, but might be if
+            the delivery is attempted again later.
     """
     email_address = message.queue.split('.', 1)[1]
+    email = formatters.single_message_email(email_address, render_cache.get(message))
     try:
-        # TODO handle the mail server being down gracefully
-        yield smtp.sendmail(
-            config.conf["SMTP_SERVER_HOSTNAME"].encode('utf-8'),
+        yield smtp_pool.send(
             config.conf["EMAIL_FROM_ADDRESS"].encode('utf-8'),
             [email_address.encode('utf-8')],
-            str(message).encode('utf-8'),
-            port=config.conf["SMTP_SERVER_PORT"],
-            username=config.conf["SMTP_USERNAME"],
-            password=config.conf["SMTP_PASSWORD"],
-            requireAuthentication=config.conf["SMTP_REQUIRE_AUTHENTICATION"],
-            requireTransportSecurity=config.conf["SMTP_REQUIRE_TLS"],
+            email.as_bytes(),
         )
         _log.info("Email successfully delivered to %s", email_address)
-    except error.ConnectionRefusedError as e:
-        _log.error("Failed to connect to the SMTP server (%s), returning message to queue", str(e))
-        raise Nack()
+    except (error.ConnectError, error.ConnectionClosed) as e:
+        _log.error("Failed to connect to the SMTP server (%s), retrying later", str(e))
+        raise exceptions.BackendUnavailable()
     except smtp.SMTPClientError as e:
         _log.info("Failed to email %s: %s", email_address, str(e))
         if e.code == 550:
             # TODO Mark email as invalid in the database
             pass
         else:
-            # TODO Raise a try-again-later exception
+            raise exceptions.RetryLater()
+
+
+@defer.inlineCallbacks
+def deliver_digest(queue_name, messages, smtp_pool, render_cache):
+    """
+    Send a single email containing several notifications to the given user.
+
+    Args:
+        queue_name (str): The name of the batched queue the messages came from;
+            the recipient is taken from it.
+        messages (list of fedora_messaging.message.Message): The messages to send.
+        smtp_pool (smtp_pool.SMTPRelayPool): The SMTP relays and their connections
+            to send the email with.
+        render_cache (cache.RenderCache): The cache of rendered messages.
+    """
+    email_address = queue_name.split('.', 1)[1]
+    email = formatters.digest_email(
+        email_address, [render_cache.get(message) for message in messages]
+    )
+    try:
+        yield smtp_pool.send(
+            config.conf["EMAIL_FROM_ADDRESS"].encode('utf-8'),
+            [email_address.encode('utf-8')],
+            email.as_bytes(),
+        )
+        _log.info("Digest of %d messages delivered to %s", len(messages), email_address)
+    except (error.ConnectError, error.ConnectionClosed) as e:
+        _log.error("Failed to connect to the SMTP server (%s), returning digest to queue", str(e))
+        raise Nack()
+    except smtp.SMTPClientError as e:
+        _log.info("Failed to email a digest to %s: %s", email_address, str(e))
+        if e.code == 550:
+            # TODO Mark email as invalid in the database
+            pass
+        else:
             raise
@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Share the queues out between several delivery workers.
+
+A single delivery service can only use one CPU core. To use more, several
+workers are run, each consuming a share of the queues. Each worker records a
+heartbeat in the ``delivery_workers`` table of the database, and the workers
+with a recent heartbeat are the members of the group.
+
+Each queue is owned by exactly one member, chosen by rendezvous hashing of the
+queue name: every member hashes the queue name with each member's ID, and the
+member with the highest hash owns the queue. All workers agree on the owner
+without talking to each other, and when a worker joins or leaves (or stops
+sending heartbeats because it crashed) only the queues it owned, or will own,
+move.
+
+Heartbeat times come from each worker's own clock, so the clocks of hosts
+running workers must be kept in sync.
+"""
+import datetime
+import hashlib
+import logging
+
+from twisted.internet import defer, reactor as global_reactor, task
+
+from .. import db
+
+_log = logging.getLogger(__name__)
+
+
+class WorkerMembership(object):
+    """
+    A delivery worker's membership of the group of workers.
+
+    Args:
+        worker_id (str): The ID of this worker; it must be unique and should
+            stay the same when the worker restarts.
+        on_change (callable): Called with the sorted list of member IDs when
+            workers join or leave.
+        database (database.Database): The thread pool to record heartbeats on.
+        heartbeat_interval (int): The number of seconds between heartbeats.
+        timeout (int): The number of seconds without a heartbeat after which a
+            worker is considered to have left.
+        clock (twisted.internet.interfaces.IReactorTime): The clock to use.
+
+    Attributes:
+        members (list of str): The IDs of the workers in the group, sorted.
+    """
+
+    def __init__(self, worker_id, on_change, database, heartbeat_interval=10, timeout=30,
+                 clock=global_reactor):
+        self.worker_id = worker_id
+        self.on_change = on_change
+        self.database = database
+        self.timeout = timeout
+        self.members = [worker_id]
+        self._heartbeat = task.LoopingCall(self._beat)
+        self._heartbeat.clock = clock
+        self._heartbeat_interval = heartbeat_interval
+
+    def join(self):
+        """
+        Record the first heartbeat and find the other members.
+
+        This blocks, so it should be called before the reactor starts.
+
+        Returns:
+            list of str: The members of the group.
+        """
+        self.members = self.database.run_blocking(self._record_heartbeat)
+        _log.info(
+            "Worker %s joined the delivery workers: %s", self.worker_id, ", ".join(self.members)
+        )
+        return self.members
+
+    def start(self):
+        """Start sending heartbeats."""
+        self._heartbeat.start(self._heartbeat_interval, now=False)
+
+    def stop(self):
+        """
+        Stop sending heartbeats and leave the group, so the other workers take
+        over this worker's queues without waiting for it to time out.
+
+        Returns:
+            defer.Deferred: Fires once this worker has left.
+        """
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+        d = self.database.run(self._leave)
+        d.addErrback(
+            lambda f: _log.error("Worker %s failed to leave: %s", self.worker_id, f.value)
+        )
+        return d
+
+    def owns(self, queue_name):
+        """
+        Check whether this worker owns a queue.
+
+        Args:
+            queue_name (str): The name of the queue.
+
+        Returns:
+            bool: True if the queue is this worker's to consume.
+        """
+        return owner(queue_name, self.members) == self.worker_id
+
+    def stats(self):
+        """
+        Report the state of the group.
+
+        Returns:
+            dict: This worker's ID and the IDs of all the members.
+        """
+        return {"worker_id": self.worker_id, "members": list(self.members)}
+
+    @defer.inlineCallbacks
+    def _beat(self):
+        try:
+            members = yield self.database.run(self._record_heartbeat)
+        except Exception as e:
+            _log.error("Worker %s failed to record its heartbeat: %s", self.worker_id, e)
+            return
+        if members != self.members:
+            _log.info(
+                "The delivery workers changed from %s to %s",
+                ", ".join(self.members),
+                ", ".join(members),
+            )
+            self.members = members
+            self.on_change(members)
+
+    def _record_heartbeat(self, session):
+        """Update this worker's heartbeat and list the live workers. This blocks."""
+        now = datetime.datetime.utcnow()
+        worker = session.query(db.DeliveryWorker).get(self.worker_id)
+        if worker is None:
+            session.add(db.DeliveryWorker(id=self.worker_id, heartbeat=now))
+        else:
+            worker.heartbeat = now
+        session.commit()
+        cutoff = now - datetime.timedelta(seconds=self.timeout)
+        members = sorted(
+            worker_id
+            for worker_id, in session.query(db.DeliveryWorker.id).filter(
+                db.DeliveryWorker.heartbeat >= cutoff
+            )
+        )
+        if self.worker_id not in members:
+            # Our own heartbeat was just written; the clocks must disagree
+            members = sorted(members + [self.worker_id])
+        return members
+
+    def _leave(self, session):
+        session.query(db.DeliveryWorker).filter_by(id=self.worker_id).delete()
+
+
+def owner(queue_name, members):
+    """
+    Find the member that owns a queue.
+
+    Args:
+        queue_name (str): The name of the queue.
+        members (list of str): The IDs of the workers.
+
+    Returns:
+        str: The ID of the owner.
+    """
+    return max(members, key=lambda member: _hash(member, queue_name))
+
+
+def _hash(member, queue_name):
+    key = "{}\0{}".format(member, queue_name).encode("utf-8")
+    return hashlib.md5(key).digest()
@@ -0,0 +1,231 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Track which IRC recipients are online.
+
+Most IRC identities are offline most of the time, and a message to an offline
+nick costs as much flood budget as any other only for the server to answer
+``ERR_NOSUCHNICK``. The :class:`PresenceCache` keeps track of the nicks the
+client delivers to so deliveries to offline nicks can be skipped.
+
+If the server supports the ``MONITOR`` extension, it's asked to notify the
+client when monitored nicks sign on and off, so the cache is always current.
+Nicks beyond the server's ``MONITOR`` limit, and all nicks on servers without
+it, are polled with ``ISON``, as many nicks to a line as fit. Replies to
+messages the client sends also keep the cache current: ``ERR_NOSUCHNICK``
+means the nick is offline, and a nick that sends the client a message is
+online.
+"""
+import collections
+import logging
+
+from twisted.internet import reactor as global_reactor, task
+
+_log = logging.getLogger(__name__)
+
+#: The maximum length of a line sent to the server, without the trailing CRLF.
+_MAX_LINE_LENGTH = 510
+
+
+class PresenceCache(object):
+    """
+    The online status of the nicks an IRC client delivers to.
+
+    Args:
+        send (callable): Called with each ``MONITOR`` or ``ISON`` line to send
+            to the server.
+        max_nicks (int): The maximum number of nicks to track. When there are
+            more, the nicks that were delivered to least recently are forgotten.
+        poll_interval (int): The number of seconds between ``ISON`` polls.
+        clock (twisted.internet.interfaces.IReactorTime): The clock to use.
+
+    Attributes:
+        hits (int): The number of lookups of nicks whose status was known.
+        misses (int): The number of lookups of nicks whose status was unknown.
+        monitor_limit (int): The number of nicks the server will ``MONITOR``
+            for the client; 0 if it doesn't support ``MONITOR``.
+    """
+
+    def __init__(self, send, max_nicks=10000, poll_interval=60, clock=global_reactor):
+        self.send = send
+        self.max_nicks = max_nicks
+        self.hits = 0
+        self.misses = 0
+        self.monitor_limit = 0
+        # Map casefolded nicks to True if they're online, False if they're
+        # offline, or None if it's not known yet, least recently delivered to first.
+        self._nicks = collections.OrderedDict()
+        self._monitored = set()
+        self._monitor_pending = []
+        self._monitor_call = None
+        self._clock = clock
+        # The nicks of each ISON sent, in order, waiting for their replies
+        self._ison_pending = collections.deque()
+        self._poller = task.LoopingCall(self.poll)
+        self._poller.clock = clock
+        self._poll_interval = poll_interval
+
+    def start(self):
+        """Start polling, once the client has signed on."""
+        self._poller.start(self._poll_interval, now=False)
+
+    def stop(self):
+        """Stop polling and forget everything, because the connection closed."""
+        if self._poller.running:
+            self._poller.stop()
+        if self._monitor_call is not None and self._monitor_call.active():
+            self._monitor_call.cancel()
+        self._monitor_call = None
+        self._monitor_pending = []
+        self._monitored.clear()
+        self._ison_pending.clear()
+        self._nicks.clear()
+
+    def lookup(self, nick):
+        """
+        Look up whether a nick is online, and start tracking it if it's new.
+
+        Args:
+            nick (str): The nick.
+
+        Returns:
+            bool: True if the nick is online, False if it's offline, or None
+                if it's not known yet.
+        """
+        key = nick.lower()
+        try:
+            online = self._nicks.pop(key)
+        except KeyError:
+            self.misses += 1
+            self._track(key)
+            return None
+        self._nicks[key] = online
+        if online is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return online
+
+    def set_monitor_limit(self, limit):
+        """
+        Record the server's ``MONITOR`` limit and monitor the nicks already tracked.
+
+        Args:
+            limit (int): The number of nicks that can be monitored.
+        """
+        self.monitor_limit = limit
+        for key in self._nicks:
+            if len(self._monitored) + len(self._monitor_pending) >= limit:
+                break
+            if key not in self._monitored:
+                self._monitor(key)
+
+    def set_status(self, nicks, online):
+        """
+        Record that some nicks are online or offline.
+
+        Args:
+            nicks (iterable of str): The nicks.
+            online (bool): Whether they're online.
+        """
+        for nick in nicks:
+            key = nick.lower()
+            if key in self._nicks:
+                self._nicks[key] = online
+
+    def monitor_list_full(self, nicks):
+        """Fall back to polling nicks the server refused to ``MONITOR``."""
+        for nick in nicks:
+            self._monitored.discard(nick.lower())
+        self.monitor_limit = len(self._monitored)
+        _log.info(
+            "The server's MONITOR list is full at %d nicks; polling the rest with ISON",
+            self.monitor_limit,
+        )
+
+    def ison_reply(self, online_nicks):
+        """
+        Record the reply to the oldest ``ISON`` that hasn't been answered.
+
+        Args:
+            online_nicks (list of str): The nicks the server says are online.
+        """
+        if not self._ison_pending:
+            return
+        polled = self._ison_pending.popleft()
+        online = {nick.lower() for nick in online_nicks}
+        self.set_status([nick for nick in polled if nick in online], True)
+        self.set_status([nick for nick in polled if nick not in online], False)
+
+    def poll(self):
+        """Send ``ISON`` for the tracked nicks that aren't monitored."""
+        batch = []
+        length = len("ISON")
+        for key in self._nicks:
+            if key in self._monitored:
+                continue
+            if batch and length + 1 + len(key) > _MAX_LINE_LENGTH:
+                self._ison(batch)
+                batch = []
+                length = len("ISON")
+            batch.append(key)
+            length += 1 + len(key)
+        if batch:
+            self._ison(batch)
+
+    def stats(self):
+        """
+        Report the state of the cache.
+
+        Returns:
+            dict: The number of nicks tracked, online, offline, and monitored,
+                and the number of lookups that hit and missed.
+        """
+        statuses = collections.Counter(self._nicks.values())
+        return {
+            "tracked": len(self._nicks),
+            "online": statuses[True],
+            "offline": statuses[False],
+            "monitored": len(self._monitored),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _track(self, key):
+        self._nicks[key] = None
+        if len(self._nicks) > self.max_nicks:
+            forgotten, _ = self._nicks.popitem(last=False)
+            if forgotten in self._monitored:
+                self._monitored.discard(forgotten)
+                self.send("MONITOR - {}".format(forgotten))
+        if len(self._monitored) + len(self._monitor_pending) < self.monitor_limit:
+            self._monitor(key)
+
+    def _monitor(self, key):
+        """Monitor a nick; nicks added together are sent on as few lines as possible."""
+        self._monitor_pending.append(key)
+        if self._monitor_call is None:
+            self._monitor_call = self._clock.callLater(0, self._send_monitor)
+
+    def _send_monitor(self):
+        self._monitor_call = None
+        pending, self._monitor_pending = self._monitor_pending, []
+        batch = []
+        length = len("MONITOR + ")
+        for key in pending:
+            if key not in self._nicks:
+                continue
+            if batch and length + 1 + len(key) > _MAX_LINE_LENGTH:
+                self.send("MONITOR + " + ",".join(batch))
+                batch = []
+                length = len("MONITOR + ")
+            batch.append(key)
+            self._monitored.add(key)
+            length += 1 + len(key)
+        if batch:
+            self.send("MONITOR + " + ",".join(batch))
+
+    def _ison(self, nicks):
+        self._ison_pending.append(nicks)
+        self.send("ISON " + " ".join(nicks))
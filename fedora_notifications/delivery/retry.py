@@ -0,0 +1,235 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Delayed retries for deliveries that failed for a temporary reason.
+
+Returning a message to its queue with a nack makes the broker redeliver it
+immediately, so an SMTP outage turns into a tight redelivery loop. Instead,
+messages that should be tried again later are published to a retry queue that
+has no consumers. Each retry queue has a message TTL and dead-letters expired
+messages back to the default exchange, which routes them to the queue they
+originally came from. There is one retry queue per delay, and the delay grows
+with each attempt. After the last attempt, the message is parked in a
+dead-letter queue for an administrator to inspect.
+
+The retry queues are selected through a headers exchange, so the AMQP routing
+key of the retried message can be the name of the user queue it returns to.
+"""
+import logging
+
+import pika
+from twisted.internet import defer
+from fedora_messaging.twisted.service import FedoraMessagingService
+
+_log = logging.getLogger(__name__)
+
+#: The exchange used to route messages into the retry queues.
+RETRY_EXCHANGE = "fedora-notifications-retry"
+
+#: The queue messages are parked in once they've used up their attempts.
+DEAD_LETTER_QUEUE = "fedora-notifications-dead-letter"
+
+#: The header holding the number of delivery attempts made so far.
+ATTEMPTS_HEADER = "fedora_notifications_attempts"
+
+#: The header holding the delay, in seconds, of the retry queue to route to.
+DELAY_HEADER = "fedora_notifications_retry_delay"
+
+#: The header holding the topic the message was originally published with.
+TOPIC_HEADER = "fedora_notifications_topic"
+
+#: The header holding the name of the queue the message was delivered from.
+QUEUE_HEADER = "fedora_notifications_queue"
+
+
+class DelayedRetry(object):
+    """
+    Publish failed deliveries to delayed retry queues.
+
+    Args:
+        delays (list of int): The number of seconds to wait before each retry.
+            If there are more attempts than delays, the last delay is reused.
+        max_attempts (int): The number of delivery attempts to make before the
+            message is moved to the dead-letter queue.
+
+    Attributes:
+        amqp_service (fedora_messaging.twisted.service.FedoraMessagingService): The
+            service that declares the retry exchange and queues, and is used to
+            publish retries. It needs to be started by the parent service.
+    """
+
+    def __init__(self, delays, max_attempts):
+        self.delays = sorted(delays)
+        self.max_attempts = max_attempts
+        self.amqp_service = FedoraMessagingService(
+            exchanges=self.exchanges(), queues=self.queues(), bindings=self.bindings()
+        )
+        self.retried = 0
+        self.dead_lettered = 0
+        self._client = None
+        self._channel = None
+
+    def queue_name(self, delay):
+        """The name of the retry queue for the given delay in seconds."""
+        return "{}-{}s".format(RETRY_EXCHANGE, delay)
+
+    def exchanges(self):
+        """list of dict: The exchanges used for retries."""
+        return [{"exchange": RETRY_EXCHANGE, "exchange_type": "headers", "durable": True}]
+
+    def queues(self):
+        """list of dict: The retry queues and the dead-letter queue."""
+        queues = [
+            {
+                "queue": self.queue_name(delay),
+                "durable": True,
+                "arguments": {
+                    "x-message-ttl": delay * 1000,
+                    "x-dead-letter-exchange": "",
+                },
+            }
+            for delay in self.delays
+        ]
+        queues.append({"queue": DEAD_LETTER_QUEUE, "durable": True})
+        return queues
+
+    def bindings(self):
+        """list of dict: The bindings from the retry exchange to each retry queue."""
+        return [
+            {
+                "queue": self.queue_name(delay),
+                "exchange": RETRY_EXCHANGE,
+                "routing_key": "",
+                "arguments": {"x-match": "all", DELAY_HEADER: delay},
+            }
+            for delay in self.delays
+        ]
+
+    def attempts(self, message):
+        """
+        The number of delivery attempts made so far for a message.
+
+        Args:
+            message (fedora_messaging.message.Message): The message.
+
+        Returns:
+            int: The number of earlier attempts.
+        """
+        return (message._properties.headers or {}).get(ATTEMPTS_HEADER, 0)
+
+    def restore_topic(self, message):
+        """
+        Restore the original topic of a message that has been retried.
+
+        The broker delivers retried messages with the queue name as their
+        routing key, which fedora-messaging uses as the topic.
+
+        Args:
+            message (fedora_messaging.message.Message): The message.
+        """
+        topic = (message._properties.headers or {}).get(TOPIC_HEADER)
+        if topic is not None:
+            message.topic = topic
+
+    @defer.inlineCallbacks
+    def retry(self, message, queue=None):
+        """
+        Schedule another delivery attempt, or park the message if it's out of attempts.
+
+        Args:
+            message (fedora_messaging.message.Message): The message that failed to
+                be delivered. Its ``queue`` attribute is where the retry is delivered.
+            queue (str): The queue to deliver the retry to instead, for example
+                the shared queue. The message's own queue is still recorded in
+                its headers.
+
+        Returns:
+            defer.Deferred: Fires when the broker has the message.
+        """
+        attempts = self.attempts(message) + 1
+        headers = dict(message._properties.headers or {})
+        headers[ATTEMPTS_HEADER] = attempts
+        headers[TOPIC_HEADER] = message.topic
+        headers[QUEUE_HEADER] = message.queue
+
+        if attempts >= self.max_attempts:
+            _log.error(
+                "Giving up on message %s for %s after %d attempts; moving it to %s",
+                message.id,
+                message.queue,
+                attempts,
+                DEAD_LETTER_QUEUE,
+            )
+            exchange, routing_key = "", DEAD_LETTER_QUEUE
+            self.dead_lettered += 1
+        else:
+            delay = self.delays[min(attempts, len(self.delays)) - 1]
+            _log.info(
+                "Retrying message %s for %s in %d seconds (attempt %d of %d)",
+                message.id,
+                message.queue,
+                delay,
+                attempts + 1,
+                self.max_attempts,
+            )
+            headers[DELAY_HEADER] = delay
+            exchange, routing_key = RETRY_EXCHANGE, queue or message.queue
+            self.retried += 1
+
+        yield self._publish(message, headers, exchange, routing_key)
+
+    @defer.inlineCallbacks
+    def dead_letter(self, message):
+        """
+        Park a message in the dead-letter queue without any more attempts.
+
+        Args:
+            message (fedora_messaging.message.Message): The message that can't
+                be delivered.
+
+        Returns:
+            defer.Deferred: Fires when the broker has the message.
+        """
+        headers = dict(message._properties.headers or {})
+        headers[TOPIC_HEADER] = message.topic
+        headers[QUEUE_HEADER] = message.queue
+        yield self._publish(message, headers, "", DEAD_LETTER_QUEUE)
+        self.dead_lettered += 1
+
+    @defer.inlineCallbacks
+    def _publish(self, message, headers, exchange, routing_key):
+        """Publish a copy of a message with new headers."""
+        properties = pika.BasicProperties(
+            content_type=message._properties.content_type,
+            content_encoding=message._properties.content_encoding,
+            delivery_mode=2,
+            headers=headers,
+            message_id=message.id,
+        )
+        channel = yield self._get_channel()
+        yield channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=message._encoded_body,
+            properties=properties,
+        )
+
+    def stats(self):
+        """
+        Report how many messages have been retried or given up on.
+
+        Returns:
+            dict: The number of messages sent to the retry queues and to the
+                dead-letter queue.
+        """
+        return {"retried": self.retried, "dead_lettered": self.dead_lettered}
+
+    @defer.inlineCallbacks
+    def _get_channel(self):
+        """Get an open channel on the current connection for publishing."""
+        client = yield self.amqp_service.getFactory().whenConnected()
+        if client is not self._client or not self._channel or not self._channel.is_open:
+            self._channel = yield client.channel()
+            self._client = client
+        defer.returnValue(self._channel)
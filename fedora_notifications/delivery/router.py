@@ -0,0 +1,177 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Route messages to the queues that subscribe to them, without the broker.
+
+Normally each user queue has its own bindings and the broker copies every
+message into each matching queue, so the number of queues and bindings grows
+with the number of users. In the shared mode (see :ref:`conf-delivery-mode`),
+the delivery service consumes a single queue that receives all the traffic,
+and the :class:`HeaderRouter` works out which user queues each message is for.
+
+The router takes the same bindings as the broker would, as produced by
+:meth:`.db.Queue.bindings`, and indexes them:
+
+* Header bindings are indexed by their header key, such as
+  ``fedora_messaging_user_jcline``. A header binding exists for each severity
+  at or above the one the user picked, or there's a single binding to the
+  exchange for that severity (see :ref:`conf-severity-exchanges`), so the router
+  just keeps the lowest severity as a floor.
+* Topic bindings are indexed by topic. Topics with AMQP wildcards (``*`` and
+  ``#``) are kept apart and matched against each message.
+"""
+import collections
+
+from ..db import models
+
+
+class HeaderRouter(object):
+    """
+    An inverted index from message headers and topics to queue names.
+
+    Attributes:
+        routed (int): The number of messages routed.
+        deliveries (int): The number of queues the messages were routed to.
+    """
+
+    def __init__(self):
+        self.routed = 0
+        self.deliveries = 0
+        # Map header keys to {queue name: lowest severity}
+        self._headers = collections.defaultdict(dict)
+        # Map topics without wildcards to queue names
+        self._topics = collections.defaultdict(set)
+        # Map topics with wildcards to their words and queue names
+        self._patterns = {}
+        # Map queue names to their header keys and topics, to remove them
+        self._queues = {}
+
+    def __contains__(self, queue_name):
+        return queue_name in self._queues
+
+    def __len__(self):
+        return len(self._queues)
+
+    def add(self, queue_name, bindings):
+        """
+        Route messages to a queue, replacing its bindings if it's already known.
+
+        Args:
+            queue_name (str): The name of the queue.
+            bindings (list of dict): The queue's bindings; header bindings are
+                on ``amq.match`` or a severity exchange, and topic bindings on
+                ``amq.topic``.
+        """
+        self.remove(queue_name)
+        keys, topics = set(), set()
+        for binding in bindings:
+            if binding["exchange"] == "amq.topic":
+                topic = binding["routing_key"]
+                topics.add(topic)
+                words = topic.split(".")
+                if "*" in words or "#" in words:
+                    self._patterns.setdefault(topic, (words, set()))[1].add(queue_name)
+                else:
+                    self._topics[topic].add(queue_name)
+                continue
+            arguments = dict(binding["arguments"])
+            arguments.pop("x-match", None)
+            severity = arguments.pop("fedora_messaging_severity", None)
+            if severity is None:
+                severity = models.exchange_severity(binding["exchange"]) or 0
+            for key in arguments:
+                keys.add(key)
+                floors = self._headers[key]
+                floors[queue_name] = min(severity, floors.get(queue_name, severity))
+        self._queues[queue_name] = (keys, topics)
+
+    def remove(self, queue_name):
+        """
+        Stop routing messages to a queue.
+
+        Args:
+            queue_name (str): The name of the queue.
+        """
+        keys, topics = self._queues.pop(queue_name, ((), ()))
+        for key in keys:
+            self._headers[key].pop(queue_name, None)
+            if not self._headers[key]:
+                del self._headers[key]
+        for topic in topics:
+            if topic in self._patterns:
+                self._patterns[topic][1].discard(queue_name)
+                if not self._patterns[topic][1]:
+                    del self._patterns[topic]
+            else:
+                self._topics[topic].discard(queue_name)
+                if not self._topics[topic]:
+                    del self._topics[topic]
+
+    def route(self, message):
+        """
+        Find the queues a message is for.
+
+        Args:
+            message (fedora_messaging.message.Message): The message.
+
+        Returns:
+            set of str: The names of the queues.
+        """
+        queue_names = set(self._topics.get(message.topic, ()))
+        if self._patterns:
+            topic_words = message.topic.split(".")
+            for words, queues in self._patterns.values():
+                if _topic_matches(words, topic_words):
+                    queue_names.update(queues)
+        headers = message._properties.headers or {}
+        for key, value in headers.items():
+            if value is not True or key not in self._headers:
+                continue
+            for queue_name, floor in self._headers[key].items():
+                if message.severity >= floor:
+                    queue_names.add(queue_name)
+        self.routed += 1
+        self.deliveries += len(queue_names)
+        return queue_names
+
+    def stats(self):
+        """
+        Report the size of the index and how much it's been used.
+
+        Returns:
+            dict: The number of queues, header keys, and topics indexed, and
+                the number of messages routed and queues they were routed to.
+        """
+        return {
+            "queues": len(self._queues),
+            "header_keys": len(self._headers),
+            "topics": len(self._topics) + len(self._patterns),
+            "routed": self.routed,
+            "deliveries": self.deliveries,
+        }
+
+
+def _topic_matches(words, topic_words):
+    """
+    Check whether a topic matches an AMQP topic pattern.
+
+    Args:
+        words (list of str): The words of the pattern; ``*`` matches one word
+            and ``#`` matches zero or more.
+        topic_words (list of str): The words of the topic.
+
+    Returns:
+        bool: True if the topic matches.
+    """
+    # matches[j] is whether the words so far match the first j topic words
+    matches = [True] + [False] * len(topic_words)
+    for word in words:
+        if word == "#":
+            for j in range(1, len(matches)):
+                matches[j] = matches[j] or matches[j - 1]
+        else:
+            for j in range(len(matches) - 1, 0, -1):
+                matches[j] = matches[j - 1] and (word == "*" or word == topic_words[j - 1])
+            matches[0] = False
+    return matches[-1]
@@ -9,16 +9,36 @@ via email or IRC.
 
 .. _Twisted: https://twistedmatrix.com/
 """
-from twisted.internet import reactor, endpoints, protocol, defer
+import collections
+import copy
+import os
+
+from twisted.internet import reactor, endpoints, defer, error, task
 from twisted.application import service, internet
 from twisted.logger import Logger
 
 from fedora_messaging.twisted.service import FedoraMessagingService
 from fedora_messaging.twisted.factory import FedoraMessagingFactory
+from fedora_messaging.exceptions import Drop, Nack
 import pika
 
-from . import irc, mail
-from .. import config, db, messages
+from . import (
+    batch,
+    breaker,
+    cache,
+    connections,
+    database,
+    flow,
+    irc,
+    mail,
+    membership,
+    retry,
+    router,
+    smtp_pool,
+    spool,
+    topology,
+)
+from .. import config, db, exceptions, messages
 
 _log = Logger()
 
@@ -33,66 +53,205 @@ class DeliveryService(service.MultiService):
     is responsible for sending out the messages pushed to it.
 
     Attributes:
-        irc_producer (FedoraMessagingService): An AMQP client that subscribes to
-            all IRC queues and pushes them to the IRC client for delivery.
-        irc_client (internet.ClientService): The Twisted IRC client service which
-            is responsible for sending the messages to users. This service runs
+        irc_pool (irc.IrcPool): The IRC client connections which are responsible
+            for sending the messages to users. Each connection runs
             :class:`irc.IrcProtocol` and the :func:`irc.IrcProtocol.deliver` method
             is what is ultimately responsible for delivery.
-        email_producer (FedoraMEssagingService): An AMQP client that subscribes to
-            all IRC queues and pushes them to the SMTP client for delivery. When
-            a message arrives it calls :func:`mail.deliver`.
+        smtp_pool (smtp_pool.SMTPRelayPool): The SMTP relays, and their persistent
+            connections, used to send email notifications.
+        email_limiter (flow.DeliveryLimiter): Caps the number of emails being
+            sent at once; consumers wait for a slot when the cap is reached.
+        retry_producer (FedoraMessagingService): An AMQP client that declares the
+            delayed retry queues and publishes to them.
+        retrier (retry.DelayedRetry): Sends deliveries that failed temporarily
+            to the delayed retry queues.
+        irc_breaker (breaker.CircuitBreaker): Holds IRC deliveries, and so the
+            consumers of the IRC queues, while the IRC server is unreachable.
+        email_breaker (breaker.CircuitBreaker): Holds email deliveries, and so the
+            consumers of the email queues, while the SMTP server is unreachable.
+        batch_producer (FedoraMessagingService): An AMQP client that declares all
+            batched queues, but doesn't consume from them.
+        digest_scheduler (batch.DigestScheduler): Drains the batched queues when
+            they are due and sends their contents as digests.
+        render_cache (cache.RenderCache): Rendered messages, shared by every
+            delivery of the same message.
+        spool (spool.Spool): If spooling is enabled, the local spool the consumers
+            write messages to and the backends are fed from.
+        consumers (dict): Maps each enabled delivery type ("irc" or "email") to
+            the :class:`connections.ConsumerConnections` consuming its queues.
+        membership (membership.WorkerMembership): If this service is one of
+            several workers, its membership of the group; it only consumes the
+            queues it owns. ``None`` if it consumes every queue.
+        router (router.HeaderRouter): In the shared delivery mode, the index
+            used to route messages from the shared queue to the user queues
+            that subscribe to them. ``None`` if each user queue is consumed.
+        shared_producer (FedoraMessagingService): In the shared delivery mode,
+            an AMQP client that consumes the shared queue once every queue has
+            been loaded into the router.
+
+    The queues are loaded from the database in pages once the service starts,
+    and each page is consumed as soon as it's loaded; :meth:`whenReady` waits
+    for the last page.
+
+    Args:
+        worker_id (str): The ID of this worker, if the queues are shared between
+            several workers. Defaults to the ``WORKER_ID`` setting.
+        worker_index (int): The index of this worker, which keeps the IRC
+            nicknames of the workers distinct. Defaults to the ``WORKER_INDEX``
+            setting.
     """
 
     name = "FedoraNotificationService"
 
-    def get_queues(self, delivery_type):
-        queues = db.Queue.query.filter_by(
-            delivery_type=delivery_type, batch=None
-        ).all()
-        bindings = []
-        for q in queues:
-            bindings += q.bindings()
-        db.Session.remove()
+    def get_smtp_relays(self):
+        """
+        Load the SMTP relay settings.
 
-        return [q.arguments() for q in queues], bindings
+        Returns:
+            list of dict: The configured relays, or the single SMTP server if no
+                relays are configured.
+        """
+        if config.conf["SMTP_RELAYS"]:
+            return config.conf["SMTP_RELAYS"]
+        return [
+            {
+                "hostname": config.conf["SMTP_SERVER_HOSTNAME"],
+                "port": config.conf["SMTP_SERVER_PORT"],
+                "username": config.conf["SMTP_USERNAME"],
+                "password": config.conf["SMTP_PASSWORD"],
+                "require_authentication": config.conf["SMTP_REQUIRE_AUTHENTICATION"],
+                "require_tls": config.conf["SMTP_REQUIRE_TLS"],
+            }
+        ]
 
-    def __init__(self):
+    def __init__(self, worker_id=None, worker_index=None):
         service.MultiService.__init__(self)
-        self.email_producer = None
-        self.irc_producer = None
-        self.irc_client = None
-
-        # Map queue names to service instances
-        self._queues = {}
-        self._irc_queues = {}
-        self._email_queues = {}
-        self._irc_services = []
-        self._email_services = []
+        self.irc_pool = None
+        self.smtp_pool = None
+        self.email_limiter = None
+        self.retry_producer = None
+        self.retrier = None
+        self.router = None
+        self.shared_producer = None
+        self.irc_breaker = None
+        self.email_breaker = None
+        self.batch_producer = None
+        self.digest_scheduler = None
+        self.render_cache = cache.RenderCache(config.conf["RENDER_CACHE_SIZE"])
+        self.spool = None
+        self.consumers = {}
+        self.membership = None
+        # The names of every non-batched queue of each delivery type, and the
+        # batch interval of every batched queue, whichever worker owns them
+        self._all_queues = {}
+        self._batch_intervals = {}
+        # Progress loading the queues at startup, and the Deferreds waiting for it
+        self._startup = {"ready": False, "queues": 0, "pages": 0, "started": None}
+        self._loading = False
+        self._deleted_while_loading = set()
+        self._declaring = []
+        self._ready_waiters = []
 
         db.initialize(config.conf)
+        self.database = database.Database(config.conf["DATABASE_THREADS"])
+
+        worker_id = worker_id or config.conf["WORKER_ID"]
+        if worker_index is None:
+            worker_index = config.conf["WORKER_INDEX"]
+        if worker_id:
+            self.membership = membership.WorkerMembership(
+                worker_id,
+                self._reshard,
+                self.database,
+                heartbeat_interval=config.conf["WORKER_HEARTBEAT_INTERVAL"],
+                timeout=config.conf["WORKER_TIMEOUT"],
+            )
+            self.membership.join()
+
+        if config.conf["SPOOL_ENABLED"]:
+            spool_directory = config.conf["SPOOL_DIRECTORY"]
+            if worker_id:
+                spool_directory = os.path.join(spool_directory, worker_id)
+            self.spool = spool.Spool(
+                spool_directory,
+                self._dispatch_spooled,
+                segment_size=config.conf["SPOOL_SEGMENT_SIZE"],
+                sync_interval=config.conf["SPOOL_SYNC_INTERVAL"] / 1000.0,
+                max_in_flight=config.conf["SPOOL_MAX_IN_FLIGHT"],
+                retry_interval=config.conf["SPOOL_RETRY_INTERVAL"],
+                max_attempts=config.conf["SPOOL_MAX_ATTEMPTS"],
+                dead_letter=self._dead_letter_spooled,
+            )
 
         if config.conf["IRC_ENABLED"]:
-            queues, bindings = self.get_queues(db.DeliveryType.irc)
-            consumers = {q["queue"]: self._dispatch_irc for q in queues}
-            producer = FedoraMessagingService(
-                queues=queues, bindings=bindings, consumers=consumers)
-            producer.setName("irc-{}".format(len(self._irc_services)))
-            self._irc_services.append(producer)
-            for queue in queues:
-                self._queues[queue["queue"]] = producer
-            self.addService(producer)
+            self.consumers["irc"] = connections.ConsumerConnections(
+                "irc", self, config.conf["CONSUMERS_PER_CONNECTION"]
+            )
+            self.irc_breaker = breaker.CircuitBreaker(
+                "IRC",
+                probe=lambda: self.irc_pool.probe(),
+                failure_threshold=config.conf["BREAKER_FAILURE_THRESHOLD"],
+                reset_timeout=config.conf["BREAKER_RESET_TIMEOUT"],
+            )
 
         if config.conf["EMAIL_ENABLED"]:
-            queues, bindings = self.get_queues(db.DeliveryType.email)
-            consumers = {q["queue"]: mail.deliver for q in queues}
-            producer = FedoraMessagingService(
-                queues=queues, bindings=bindings, consumers=consumers)
-            producer.setName("email-{}".format(len(self._email_services)))
-            self._email_services.append(producer)
-            for queue in queues:
-                self._queues[queue["queue"]] = producer
-            self.addService(producer)
+            self.smtp_pool = smtp_pool.SMTPRelayPool(
+                [self._smtp_relay(relay) for relay in self.get_smtp_relays()],
+                retry_interval=config.conf["SMTP_RELAY_RETRY_INTERVAL"],
+            )
+            self.email_limiter = flow.DeliveryLimiter("Email", config.conf["EMAIL_MAX_IN_FLIGHT"])
+            self.email_breaker = breaker.CircuitBreaker(
+                "Email",
+                probe=self.smtp_pool.probe,
+                failure_threshold=config.conf["BREAKER_FAILURE_THRESHOLD"],
+                reset_timeout=config.conf["BREAKER_RESET_TIMEOUT"],
+            )
+            self.consumers["email"] = connections.ConsumerConnections(
+                "email", self, config.conf["CONSUMERS_PER_CONNECTION"]
+            )
+
+        if (
+            config.conf["EMAIL_ENABLED"]
+            or config.conf["DELIVERY_MODE"] == "shared"
+            or (config.conf["IRC_ENABLED"] and config.conf["IRC_OFFLINE_POLICY"] == "park")
+        ):
+            self.retrier = retry.DelayedRetry(
+                config.conf["RETRY_DELAYS"], config.conf["RETRY_MAX_ATTEMPTS"]
+            )
+            self.retry_producer = self.retrier.amqp_service
+            self.retry_producer.setName("retry-0")
+            self.addService(self.retry_producer)
+
+        if config.conf["DELIVERY_MODE"] == "shared":
+            shared_queue = config.conf["SHARED_QUEUE"]
+            self.router = router.HeaderRouter()
+            self.shared_producer = FedoraMessagingService(
+                queues=[{"queue": shared_queue, "durable": True, "arguments": {}}],
+                bindings=[
+                    dict(binding, queue=shared_queue)
+                    for binding in config.conf["SHARED_QUEUE_BINDINGS"]
+                ],
+                consumers={shared_queue: self._route_shared},
+            )
+            self.shared_producer.setName("shared-0")
+            self.addService(self.shared_producer)
+
+        digest_dispatchers = {}
+        if "irc" in self.consumers:
+            digest_dispatchers["irc"] = self._dispatch_irc_digest
+        if "email" in self.consumers:
+            digest_dispatchers["email"] = self._dispatch_email_digest
+        if digest_dispatchers:
+            # The batched queues are declared as they're loaded
+            self.batch_producer = FedoraMessagingService()
+            self.batch_producer.setName("batch-0")
+            self.addService(self.batch_producer)
+            self.digest_scheduler = batch.DigestScheduler(
+                self.batch_producer,
+                digest_dispatchers,
+                max_messages=config.conf["BATCH_MAX_MESSAGES"],
+                concurrency=config.conf["BATCH_CONCURRENCY"],
+            )
 
         amqp_endpoint = endpoints.clientFromString(
             reactor, 'tcp:localhost:5672'
@@ -102,68 +261,772 @@ class DeliveryService(service.MultiService):
             "queue": "fedora-notifications-control-queue",
             "durable": True,
         }
+        control_bindings = []
+        if self.membership:
+            # Every worker needs to hear about every queue, so each has its own
+            # control queue rather than competing for messages on a shared one.
+            control_queue = {
+                "queue": "fedora-notifications-control-queue.{}".format(worker_id),
+                "durable": False,
+                "auto_delete": True,
+            }
+            control_bindings = [
+                {
+                    "queue": control_queue["queue"],
+                    "exchange": "amq.topic",
+                    "routing_key": messages.QueueCreated.topic,
+                }
+            ]
         factory = FedoraMessagingFactory(
             params,
             queues=[control_queue],
+            bindings=control_bindings,
         )
         factory.consume(self._manage_service, control_queue["queue"])
+        self._control_factory = factory
         self.amqp_service = internet.ClientService(amqp_endpoint, factory)
         self.addService(self.amqp_service)
-        # TODO set up a listener for messages about new queues.
-        # Then we need an API to poke a message service to start a new subscription
-        # or stop an existing one.
 
-        if self._irc_services:
+        if "irc" in self.consumers:
             irc_endpoint = endpoints.clientFromString(
                 reactor, config.conf["IRC_ENDPOINT"]
             )
-            irc_factory = protocol.Factory.forProtocol(irc.IrcProtocol)
-            self.irc_client = internet.ClientService(irc_endpoint, irc_factory)
-            self.addService(self.irc_client)
+            self.irc_pool = irc.IrcPool(
+                irc_endpoint,
+                config.conf["IRC_NICK"],
+                size=config.conf["IRC_CONNECTIONS"],
+                first_index=worker_index * config.conf["IRC_CONNECTIONS"],
+            )
+            self.addService(self.irc_pool)
+
+    def _owns(self, queue_name):
+        """Check whether this worker is responsible for a queue."""
+        return self.membership is None or self.membership.owns(queue_name)
+
+    def _reshard(self, members):
+        """Take on the queues this worker now owns and let go of the rest."""
+        for queue_type, consumers in self.consumers.items():
+            if self.router is not None:
+                # Every worker routes to every queue from the shared queue
+                break
+            callback = self._queue_callback(queue_type)
+            for queue_name in self._all_queues.get(queue_type, ()):
+                owned = self._owns(queue_name)
+                if owned and queue_name not in consumers:
+                    consumers.add(queue_name, callback)
+                elif not owned and queue_name in consumers:
+                    consumers.remove(queue_name)
+        if self.digest_scheduler:
+            for queue_name, minutes in self._batch_intervals.items():
+                owned = self._owns(queue_name)
+                if owned and queue_name not in self.digest_scheduler:
+                    self.digest_scheduler.add(queue_name, minutes)
+                elif not owned and queue_name in self.digest_scheduler:
+                    self.digest_scheduler.remove(queue_name)
+        _log.info(
+            "Rebalanced the queues over {n} workers; this worker consumes {q} queues",
+            n=len(members),
+            q=sum(c.stats()["queues"] for c in self.consumers.values()),
+        )
+
+    def _queue_callback(self, queue_type):
+        """The consumer callback for the queues of a delivery type."""
+        if queue_type == "irc":
+            return self._consumer(self._dispatch_irc)
+        return self._consumer(self._dispatch_email)
+
+    def whenReady(self):
+        """
+        Wait until every queue that existed at startup is being consumed.
+
+        Returns:
+            defer.Deferred: Fires once the queues have been loaded.
+        """
+        if self._startup["ready"]:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._ready_waiters.append(d)
+        return d
+
+    @defer.inlineCallbacks
+    def _load_queues(self):
+        """
+        Load the queues from the database a page at a time, and start consuming
+        each page while the next one loads.
+
+        Queues are handed to the consumer connections a connection's worth at a
+        time, so each connection is created with its full set of queues.
+        """
+        delivery_types = [db.DeliveryType.from_string(t) for t in self.consumers]
+        per_connection = config.conf["CONSUMERS_PER_CONNECTION"]
+        pending = {queue_type: [] for queue_type in self.consumers}
+        after = None
+        self._startup["started"] = reactor.seconds()
+        if config.conf["SEVERITY_EXCHANGES"]:
+            # The queues' header bindings are to these exchanges
+            try:
+                yield topology.declare_severity_exchanges(self._control_factory)
+            except Exception as e:
+                _log.error("Failed to declare the severity exchanges: {e}", e=e)
+        _log.info("Loading the queues from the database")
+        while self._loading:
+            try:
+                last, page = yield self.database.run(
+                    database.get_queues,
+                    delivery_types,
+                    after,
+                    config.conf["QUEUE_LOAD_PAGE_SIZE"],
+                    self.router is not None,
+                )
+            except Exception as e:
+                _log.error(
+                    "Failed to load the queues ({e}); trying again in {s} seconds",
+                    e=e,
+                    s=config.conf["QUEUE_LOAD_RETRY_INTERVAL"],
+                )
+                yield task.deferLater(
+                    reactor, config.conf["QUEUE_LOAD_RETRY_INTERVAL"], lambda: None
+                )
+                continue
+            if not self._loading:
+                break
+            if last is None:
+                for queue_type, queues in pending.items():
+                    if queues:
+                        self._declaring.append(self._consume_loaded(queue_type, queues))
+                results = yield defer.DeferredList(self._declaring, consumeErrors=True)
+                for success, result in results:
+                    if not success:
+                        _log.error("Failed to declare some of the queues: {e}", e=result.value)
+                self._loaded()
+                break
+            after = last
+            self._load_page(page, pending)
+            for queue_type, queues in pending.items():
+                while len(queues) >= per_connection:
+                    self._declaring.append(
+                        self._consume_loaded(queue_type, queues[:per_connection])
+                    )
+                    del queues[:per_connection]
+            self._startup["queues"] += len(page)
+            self._startup["pages"] += 1
+            _log.info(
+                "Loaded {n} queues in {s:.1f} seconds",
+                n=self._startup["queues"],
+                s=reactor.seconds() - self._startup["started"],
+            )
+
+    def _load_page(self, page, pending):
+        """
+        Record a page of queues, schedule the batched ones this worker owns, and
+        add the others it owns to the queues waiting for a consumer connection,
+        or to the router in the shared delivery mode.
+
+        Args:
+            page (list of QueueRecord): The queues.
+            pending (dict): Maps delivery types to the lists of their queues
+                waiting for a consumer connection.
+        """
+        batched = []
+        for queue in page:
+            queue_name = queue.arguments["queue"]
+            queue_type = queue_name.split('.', 1)[0]
+            if queue_name in self._deleted_while_loading:
+                continue
+            if queue.batch is not None:
+                if self.digest_scheduler is None or queue_name in self._batch_intervals:
+                    continue
+                self._batch_intervals[queue_name] = queue.batch
+                if self._owns(queue_name):
+                    batched.append(queue)
+                    self.digest_scheduler.add(queue_name, queue.batch)
+            else:
+                known = self._all_queues.setdefault(queue_type, set())
+                if queue_name in known:
+                    # It was created while the queues were loading
+                    continue
+                known.add(queue_name)
+                if self.router is not None:
+                    self.router.add(queue_name, queue.bindings)
+                elif self._owns(queue_name):
+                    pending[queue_type].append(queue)
+        if batched:
+            self._declaring.append(self._declare_batched(batched))
+
+    def _wants(self, queue_type, queue_name):
+        """Check a loaded queue still exists, is owned, and isn't consumed yet."""
+        return (
+            queue_name in self._all_queues.get(queue_type, ())
+            and queue_name not in self.consumers[queue_type]
+            and self._owns(queue_name)
+        )
+
+    @defer.inlineCallbacks
+    def _consume_loaded(self, queue_type, queues):
+        """
+        Start consuming loaded queues on a new connection.
+
+        Queues that were deleted, or that this worker stopped owning or already
+        started consuming, since they were loaded are skipped.
+
+        Args:
+            queue_type (str): The delivery type of the queues.
+            queues (list of QueueRecord): The queues.
+        """
+        queues = [q for q in queues if self._wants(queue_type, q.arguments["queue"])]
+        rebind = yield self._bindings_to_declare(queues)
+        queues = [q for q in queues if self._wants(queue_type, q.arguments["queue"])]
+        arguments, bindings, applied = self._declarations(queues, rebind)
+        consumers = self.consumers[queue_type]
+        yield consumers.load(arguments, bindings, self._queue_callback(queue_type))
+        yield self.database.run(database.set_applied_topology, applied)
+        intact = collections.defaultdict(list)
+        for queue in queues:
+            if queue.id not in rebind:
+                intact[consumers.producer(queue.arguments["queue"]).factory].append(queue.id)
+        for factory, queue_ids in intact.items():
+            self._remember_bindings(factory, queue_ids)
+
+    @defer.inlineCallbacks
+    def _declare_batched(self, queues):
+        """Declare batched queues, and have them declared again whenever the broker reconnects."""
+        rebind = yield self._bindings_to_declare(queues)
+        arguments, bindings, applied = self._declarations(queues, rebind)
+        factory = self.batch_producer.factory
+        factory.queues.extend(arguments)
+        factory.bindings.extend(bindings)
+        client = yield factory.whenConnected()
+        yield client.declare_queues(arguments)
+        yield client.bind_queues(bindings)
+        yield self.database.run(database.set_applied_topology, applied)
+        self._remember_bindings(factory, [q.id for q in queues if q.id not in rebind])
+
+    @defer.inlineCallbacks
+    def _bindings_to_declare(self, queues):
+        """
+        Find the loaded queues whose bindings need to be declared.
+
+        Those are the queues whose bindings changed since they were last
+        declared, and the queues that no longer exist on the broker. If the
+        broker can't be asked which queues exist, all of them are included.
+
+        Args:
+            queues (list of QueueRecord): The queues.
+
+        Returns:
+            defer.Deferred: Fires with a dictionary mapping the IDs of the queues
+                whose bindings need declaring to their bindings.
+        """
+        rebind = {q.id: q.bindings for q in queues if q.changed}
+        unchanged = {q.arguments["queue"]: q.id for q in queues if not q.changed}
+        if unchanged:
+            try:
+                missing = yield topology.missing_queues(self._control_factory, list(unchanged))
+            except Exception as e:
+                _log.warn(
+                    "Unable to check which queues exist ({e}); declaring all their bindings",
+                    e=e,
+                )
+                missing = list(unchanged)
+            if missing:
+                missing_ids = [unchanged[queue_name] for queue_name in missing]
+                reloaded = yield self.database.run(database.get_bindings, missing_ids)
+                for queue_id in missing_ids:
+                    rebind[queue_id] = reloaded.get(queue_id, [])
+        defer.returnValue(rebind)
+
+    @staticmethod
+    def _declarations(queues, rebind):
+        """
+        Declare queues, with their bindings if they need them.
+
+        The queues are declared in full rather than passively even if their
+        bindings aren't: the declarations are repeated whenever the connection
+        is re-established, and a queue that expired while it was down has to
+        be declared again rather than fail the connection's whole setup.
+
+        Args:
+            queues (list of QueueRecord): The queues.
+            rebind (dict): Maps the IDs of the queues whose bindings need
+                declaring to their bindings.
+
+        Returns:
+            tuple: The queue arguments, the bindings, and a dictionary mapping
+                the IDs of queues whose bindings are declared to the
+                fingerprint of those bindings.
+        """
+        arguments, bindings, applied = [], [], {}
+        for queue in queues:
+            arguments.append(queue.arguments)
+            if queue.id in rebind:
+                bindings += rebind[queue.id]
+                applied[queue.id] = queue.topology
+        return arguments, bindings, applied
+
+    def _remember_bindings(self, factory, queue_ids):
+        """
+        Add the bindings of queues that weren't bound at startup to the bindings
+        their connection declares when it's re-established, in the background.
+
+        A queue that expires while its connection is down is declared again when
+        the connection comes back, and needs its bindings too.
+
+        Args:
+            factory (FedoraMessagingFactory): The factory of the connection the
+                queues are declared on.
+            queue_ids (list of uuid.UUID): The IDs of the queues.
+
+        Returns:
+            defer.Deferred: Fires once the bindings have been added.
+        """
+        if not queue_ids:
+            return defer.succeed(None)
+
+        def remember(bindings):
+            for queue_bindings in bindings.values():
+                factory.bindings.extend(queue_bindings)
+
+        d = self.database.run(database.get_bindings, queue_ids)
+        d.addCallback(remember)
+        d.addErrback(
+            lambda f: _log.error(
+                "Failed to load the bindings of {n} queues; they won't be bound again "
+                "if their connection is lost: {e}",
+                n=len(queue_ids),
+                e=f.value,
+            )
+        )
+        return d
+
+    def _loaded(self):
+        """Record that every queue has been loaded and wake up anything waiting for it."""
+        self._loading = False
+        self._deleted_while_loading.clear()
+        self._declaring = []
+        self._startup["ready"] = True
+        _log.info(
+            "Loaded all {n} queues in {s:.1f} seconds; the delivery service is ready",
+            n=self._startup["queues"],
+            s=reactor.seconds() - self._startup["started"],
+        )
+        if self.shared_producer:
+            # Messages are only routed once every queue is known
+            self.shared_producer.startService()
+        waiters, self._ready_waiters = self._ready_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _smtp_relay(self, relay):
+        """Create an SMTP relay, with its own connection pool, from its settings."""
+        pool = smtp_pool.SMTPConnectionPool(
+            relay["hostname"],
+            port=relay.get("port", 25),
+            size=config.conf["SMTP_POOL_SIZE"],
+            username=relay.get("username"),
+            password=relay.get("password"),
+            require_authentication=relay.get("require_authentication", False),
+            require_tls=relay.get("require_tls", False),
+            idle_timeout=config.conf["SMTP_POOL_IDLE_TIMEOUT"],
+            health_check_interval=config.conf["SMTP_POOL_HEALTH_CHECK_INTERVAL"],
+        )
+        return smtp_pool.SMTPRelay(pool, weight=relay.get("weight", 1))
+
+    def _consumer(self, dispatch):
+        """
+        The AMQP consumer callback for a backend.
+
+        Args:
+            dispatch (callable): The backend's dispatch method.
+
+        Returns:
+            callable: The spool, if spooling is enabled, otherwise ``dispatch``.
+        """
+        if self.spool:
+            return self._spool_message
+        return dispatch
+
+    @defer.inlineCallbacks
+    def _spool_message(self, message):
+        """
+        Consumer callback that writes the message to the spool.
+
+        The message is acknowledged once it's safely on disk; if it can't be
+        spooled, it's returned to the queue.
+        """
+        try:
+            yield self.spool.append(message)
+        except Exception as e:
+            _log.error(
+                "Unable to spool message {id} ({e}), returning it to the queue",
+                id=message.id,
+                e=e,
+            )
+            raise Nack()
+
+    def _dispatch_spooled(self, message):
+        """Hand a message from the spool to the backend for its queue."""
+        queue_type = message.queue.split('.', 1)[0]
+        if queue_type == "irc" and self.irc_pool:
+            return self._dispatch_irc(message)
+        elif queue_type == "email" and self.smtp_pool:
+            return self._dispatch_email(message)
+        _log.warn(
+            "Dropping spooled message {id} for {q}; its delivery method is disabled",
+            id=message.id,
+            q=message.queue,
+        )
+        raise Drop()
+
+    def _dead_letter_spooled(self, message):
+        """Park a spooled message the spool has given up on in the dead-letter queue."""
+        if self.retrier is None:
+            _log.warn(
+                "Discarding spooled message {id} for {q}; there is no dead-letter queue",
+                id=message.id,
+                q=message.queue,
+            )
+            return None
+        return self.retrier.dead_letter(message)
 
     @defer.inlineCallbacks
     def _dispatch_irc(self, message):
-        """Callback for the IRC backend that waits for a connected client."""
-        client = yield self.irc_client.whenConnected()
-        yield client.deliver(message)
+        """
+        Callback for the IRC backend that waits for the recipient's connection.
+
+        The message is acknowledged once it has been written to the IRC server,
+        and the delivery waits while the connection's outbound buffer is full,
+        or while the IRC circuit breaker is open. If the IRC server can't be
+        reached or the connection closes before the message is written, the
+        message is returned to the queue and the failure counts towards opening
+        the IRC circuit breaker. If the recipient is offline and the offline
+        policy is "park", the message is sent to the delayed retry queues.
+        """
+        yield self.irc_breaker.allow()
+        recipient = message.queue.split('.', 1)[1]
+        try:
+            client = yield self.irc_pool.whenConnected(recipient, failAfterFailures=1)
+        except Exception as e:
+            _log.warn("Unable to connect to IRC ({e}), returning message to queue", e=e)
+            self.irc_breaker.record_failure()
+            raise Nack()
+        self.irc_breaker.record_success()
+        try:
+            yield self._deliver_irc(client, message)
+        except error.ConnectionClosed as e:
+            _log.warn(
+                "The IRC connection closed before message {id} was sent ({e}), "
+                "returning it to the queue",
+                id=message.id,
+                e=e,
+            )
+            self.irc_breaker.record_failure()
+            raise Nack()
+
+    @defer.inlineCallbacks
+    def _dispatch_email(self, message):
+        """
+        Callback for the email backend that sends using the SMTP connection pool.
+
+        The delivery waits while the email circuit breaker is open, and for a
+        slot if the email in-flight limit is reached. If it fails temporarily,
+        the message is sent to a delayed retry queue, unless the SMTP server is
+        unreachable often enough to open the email circuit breaker, in which
+        case it's returned to the queue and waits for the breaker when it's
+        delivered again.
+        """
+        self.retrier.restore_topic(message)
+        yield self.email_breaker.allow()
+        try:
+            yield self.email_limiter.run(
+                mail.deliver, message, self.smtp_pool, self.render_cache
+            )
+        except exceptions.BackendUnavailable:
+            self.email_breaker.record_failure()
+            if self.email_breaker.state == breaker.OPEN:
+                raise Nack()
+            yield self._retry(message)
+        except exceptions.RetryLater:
+            self.email_breaker.record_success()
+            yield self._retry(message)
+        else:
+            self.email_breaker.record_success()
+
+    @defer.inlineCallbacks
+    def _retry(self, message):
+        """Send a message to the delayed retry queues, or back to its queue if that fails."""
+        try:
+            yield self.retrier.retry(
+                message, queue=config.conf["SHARED_QUEUE"] if self.router else None
+            )
+        except Exception as e:
+            _log.error(
+                "Unable to schedule a retry of {id}, returning it to the queue: {e}",
+                id=message.id,
+                e=e,
+            )
+            raise Nack()
+
+    @defer.inlineCallbacks
+    def _route_shared(self, message):
+        """
+        Consumer callback for the shared queue that delivers a message to every
+        queue that subscribes to it.
+
+        A retried message is only delivered to the queue it failed for. If a
+        delivery fails temporarily, it's retried for that queue alone, so the
+        other recipients don't get the message twice.
+        """
+        self.retrier.restore_topic(message)
+        target = (message._properties.headers or {}).get(retry.QUEUE_HEADER)
+        if target is not None:
+            queue_names = [target] if target in self.router else []
+        else:
+            queue_names = self.router.route(message)
+        dispatchers = {"irc": self._dispatch_irc, "email": self._dispatch_email}
+        deliveries = []
+        for queue_name in queue_names:
+            queue_type = queue_name.split('.', 1)[0]
+            if queue_type not in self.consumers:
+                continue
+            recipient_message = copy.copy(message)
+            recipient_message.queue = queue_name
+            d = defer.maybeDeferred(self._consumer(dispatchers[queue_type]), recipient_message)
+            d.addErrback(self._shared_delivery_failed, recipient_message)
+            deliveries.append(d)
+        yield defer.gatherResults(deliveries, consumeErrors=True)
+
+    def _shared_delivery_failed(self, failure, message):
+        """Retry a delivery from the shared queue to one of its recipients."""
+        if failure.check(Drop):
+            _log.info("Dropping message {id} for {q}", id=message.id, q=message.queue)
+            return None
+        if not failure.check(Nack):
+            _log.error(
+                "Failed to deliver message {id} to {q}: {e}",
+                id=message.id,
+                q=message.queue,
+                e=failure.value,
+            )
+        return self._retry(message)
+
+    def _route_to(self, queue_type, queue_name):
+        """Load the bindings of a new queue and add it to the router."""
+
+        def add(bindings):
+            if bindings is not None and queue_name in self._all_queues.get(queue_type, ()):
+                self.router.add(queue_name, bindings)
+
+        d = self.database.run(database.get_queue_bindings, queue_name)
+        d.addCallback(add)
+        d.addErrback(
+            lambda f: _log.error("Failed to load the bindings of {q}: {e}", q=queue_name, e=f.value)
+        )
+        return d
+
+    @defer.inlineCallbacks
+    def _dispatch_irc_digest(self, queue_name, messages):
+        """
+        Digest callback for the IRC backend.
+
+        The messages are delivered together, so the client can coalesce them
+        onto as few lines as possible.
+        """
+        yield self.irc_breaker.allow()
+        client = yield self.irc_pool.whenConnected(queue_name.split('.', 1)[1])
+        deliveries = [self._deliver_irc(client, message) for message in messages]
+        yield defer.gatherResults(deliveries, consumeErrors=True)
+
+    @defer.inlineCallbacks
+    def _deliver_irc(self, client, message):
+        """
+        Deliver a message with an IRC client, sending it to the delayed retry
+        queues if the recipient is offline and the offline policy is "park".
+        """
+        if self.retrier is not None:
+            self.retrier.restore_topic(message)
+        try:
+            yield client.deliver(message, self.render_cache.get(message).summary)
+        except exceptions.RetryLater:
+            yield self._retry(message)
+
+    @defer.inlineCallbacks
+    def _dispatch_email_digest(self, queue_name, messages):
+        """Digest callback for the email backend that sends a single email."""
+        yield self.email_breaker.allow()
+        yield self.email_limiter.run(
+            mail.deliver_digest, queue_name, messages, self.smtp_pool, self.render_cache
+        )
 
     def _manage_service(self, message):
         _log.info("{q}", q=str(message))
         if isinstance(message, messages.QueueCreated):
-            queue_type = message.queue_name.split('.', 1)[0]
-            if queue_type == "irc":
-                producer = self._irc_services[0]
-                producer.getFactory().consume(self._dispatch_irc, message.queue_name)
-                self._queues[message.queue_name] = producer
-            elif queue_type == "email":
-                producer = self._email_services[0]
-                producer.getFactory().consume(mail.deliver, message.queue_name)
-                self._queues[message.queue_name] = producer
+            return self._queue_created(message)
         elif isinstance(message, messages.QueueDeleted):
             queue_type = message.queue_name.split('.', 1)[0]
-            if queue_type == "irc":
-                producer = self._irc_services[0]
-                producer.getFactory().cancel(message.queue_name)
-                del self._queues[message.queue_name]
-            elif queue_type == "email":
-                producer = self._email_services[0]
-                producer.getFactory().cancel(message.queue_name)
-                del self._queues[message.queue_name]
+            if self._loading:
+                self._deleted_while_loading.add(message.queue_name)
+            self._all_queues.get(queue_type, set()).discard(message.queue_name)
+            if self.router is not None:
+                self.router.remove(message.queue_name)
+            if self._batch_intervals.pop(message.queue_name, None) is not None:
+                if message.queue_name in self.digest_scheduler:
+                    self.digest_scheduler.remove(message.queue_name)
+                return
+            if queue_type in self.consumers and message.queue_name in self.consumers[queue_type]:
+                self.consumers[queue_type].remove(message.queue_name)
+        elif isinstance(message, messages.QueueUpdated):
+            return self._update_bindings(message)
+
+    @defer.inlineCallbacks
+    def _queue_created(self, message):
+        """Start consuming a new queue, or schedule its digests if it's batched."""
+        queue_type = message.queue_name.split('.', 1)[0]
+        if self.digest_scheduler and queue_type in self.digest_scheduler.dispatchers:
+            minutes = yield self.database.run(database.get_batch_interval, message.queue_name)
+            if minutes is not None:
+                self._batch_intervals[message.queue_name] = minutes
+                if self._owns(message.queue_name):
+                    self.digest_scheduler.add(message.queue_name, minutes)
+                return
+        if queue_type in self.consumers:
+            self._all_queues.setdefault(queue_type, set()).add(message.queue_name)
+            if self.router is not None:
+                self._route_to(queue_type, message.queue_name)
+            elif self._owns(message.queue_name):
+                self.consumers[queue_type].add(
+                    message.queue_name, self._queue_callback(queue_type)
+                )
+
+    def _update_bindings(self, message):
+        """
+        Apply the bindings added to and removed from a queue this worker is
+        responsible for, without declaring it again or interrupting its consumer.
+
+        Args:
+            message (messages.QueueUpdated): The binding changes.
+
+        Returns:
+            defer.Deferred: Fires once the changes have been applied, or
+                ``None`` if there's nothing to do.
+        """
+        queue_name = message.queue_name
+        queue_type = queue_name.split('.', 1)[0]
+        if queue_name in self._batch_intervals:
+            if not self._owns(queue_name):
+                return None
+            factory = self.batch_producer.factory
+        elif self.router is not None:
+            if queue_name not in self.router:
+                return None
+            return self._route_to(queue_type, queue_name)
+        elif queue_type in self.consumers and queue_name in self.consumers[queue_type]:
+            factory = self.consumers[queue_type].producer(queue_name).factory
+        else:
+            # It's not loaded yet, so it will be declared with the new bindings
+            return None
+        d = topology.update_bindings(factory, message.added, message.removed)
+        d.addCallback(
+            lambda _: self.database.run(
+                database.advance_applied_topology,
+                queue_name,
+                message.previous_topology,
+                message.topology,
+            )
+        )
+        d.addErrback(
+            lambda f: _log.error(
+                "Failed to update the bindings of {q}: {e}", q=queue_name, e=f.value
+            )
+        )
+        return d
+
+    def stats(self):
+        """
+        Report the state of the delivery backends.
+
+        Returns:
+            dict: A dictionary of statistics for each active component.
+        """
+        stats = {"render_cache": self.render_cache.stats(), "database": self.database.stats()}
+        if self.irc_pool:
+            stats["irc"] = self.irc_pool.stats()
+        if self.email_limiter:
+            stats["email"] = self.email_limiter.stats()
+        if self.smtp_pool:
+            stats["smtp_relays"] = self.smtp_pool.stats()
+        if self.retrier:
+            stats["retries"] = self.retrier.stats()
+        if self.irc_breaker:
+            stats["irc_breaker"] = self.irc_breaker.stats()
+        if self.email_breaker:
+            stats["email_breaker"] = self.email_breaker.stats()
+        if self.digest_scheduler:
+            stats["digests"] = self.digest_scheduler.stats()
+        if self.spool:
+            stats["spool"] = self.spool.stats()
+        stats["consumers"] = {
+            queue_type: consumers.stats() for queue_type, consumers in self.consumers.items()
+        }
+        if self.membership:
+            stats["membership"] = self.membership.stats()
+        if self.router:
+            stats["router"] = self.router.stats()
+        stats["startup"] = {
+            "ready": self._startup["ready"],
+            "queues_loaded": self._startup["queues"],
+            "pages": self._startup["pages"],
+        }
+        return stats
 
     def startService(self):
         """Called by Twisted to start the service."""
+        self.database.start()
+        if self.spool:
+            self.spool.start()
+        if self.membership:
+            self.membership.start()
         self.amqp_service.startService()
-        if self.irc_client:
-            self.irc_client.startService()
-        for serv in self._irc_services + self._email_services:
-            serv.startService()
+        if self.irc_pool:
+            self.irc_pool.startService()
+        if self.smtp_pool:
+            self.smtp_pool.start()
+        if self.retry_producer:
+            self.retry_producer.startService()
+        for consumers in self.consumers.values():
+            consumers.start()
+        if self.batch_producer:
+            self.batch_producer.startService()
+            self.digest_scheduler.start()
+        self._loading = True
+        self._load_queues().addErrback(
+            lambda f: _log.failure("Failed to load the queues", failure=f)
+        )
 
     def stopService(self):
         """Called by Twisted to stop the service."""
+        self._loading = False
         self.amqp_service.stopService()
-        if self.irc_client:
-            self.irc_client.stopService()
-        if self.irc_producer:
-            self.irc_producer.stopService()
-        if self.email_producer:
-            self.email_producer.stopService()
+        for circuit_breaker in (self.irc_breaker, self.email_breaker):
+            if circuit_breaker:
+                circuit_breaker.stop()
+        if self.irc_pool:
+            self.irc_pool.stopService()
+        if self.digest_scheduler:
+            self.digest_scheduler.stop()
+            self.batch_producer.stopService()
+        if self.smtp_pool:
+            self.smtp_pool.stop()
+        if self.retry_producer:
+            self.retry_producer.stopService()
+        if self.shared_producer:
+            self.shared_producer.stopService()
+        for consumers in self.consumers.values():
+            consumers.stop()
+        deferreds = []
+        if self.membership:
+            deferreds.append(self.membership.stop())
+        if self.spool:
+            deferreds.append(self.spool.stop())
+        d = defer.gatherResults(deferreds)
+        d.addBoth(lambda result: self.database.stop() or result)
+        return d
@@ -0,0 +1,659 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+A pool of persistent SMTP client connections.
+
+:func:`twisted.mail.smtp.sendmail` opens a new connection for every message, so
+each notification pays for the TCP handshake, EHLO, STARTTLS, and AUTH. The
+:class:`SMTPConnectionPool` keeps a bounded number of authenticated sessions
+open and sends many messages over each of them, issuing an RSET in between.
+If a session that was already established is lost while it's sending a
+message, the message is tried once more on a new connection.
+
+An :class:`SMTPRelayPool` spreads messages over several relays, each with its
+own connection pool, and fails over when a relay can't be reached.
+"""
+import collections
+import logging
+from io import BytesIO
+
+from twisted.internet import defer, error, protocol, reactor as global_reactor, task
+from twisted.mail import smtp
+
+_log = logging.getLogger(__name__)
+
+
+#: A message waiting to be sent by the pool, and whether it's being sent again
+#: because the session it was first sent over was lost.
+_Job = collections.namedtuple("_Job", ("from_addr", "to_addrs", "data", "deferred", "retried"))
+
+
+class SessionLost(error.ConnectionLost):
+    """
+    An established SMTP session was lost while sending a message, and so was
+    the new session the message was tried again on.
+    """
+
+
+class PooledESMTPSender(smtp.ESMTPSender):
+    """
+    An ESMTP client that stays connected between messages.
+
+    Twisted's client asks :meth:`getMailFrom` for the next message after each
+    RSET and disconnects when there isn't one. Rather than disconnecting, this
+    client parks itself in its pool until it is handed another message with
+    :meth:`send` or its idle timeout expires.
+
+    Attributes:
+        pool (SMTPConnectionPool): The pool this connection belongs to.
+        idle (bool): ``True`` if the connection is authenticated and waiting
+            for a message.
+        ready (bool): ``True`` once the connection has completed the EHLO,
+            STARTTLS, and AUTH exchanges.
+        last_used (float): When the connection last became idle, in seconds
+            according to the pool's reactor.
+    """
+
+    def __init__(self, *args, **kwargs):
+        smtp.ESMTPSender.__init__(self, *args, **kwargs)
+        self.pool = None
+        self.idle = False
+        self.ready = False
+        self.last_used = None
+        self._job = None
+        self._error = None
+
+    def send(self, job):
+        """
+        Send a message over this connection.
+
+        Args:
+            job (_Job): The message to send. Its Deferred fires when the server
+                accepts or rejects the message.
+        """
+        self.idle = False
+        self._job = job
+        self.setTimeout(self.pool.idle_timeout)
+        self.smtpState_from(250, b"")
+
+    def check_health(self):
+        """Send a NOOP over an idle connection to make sure the session still works."""
+        if not self.idle:
+            return
+        self.idle = False
+        self.sendLine(b"NOOP")
+        self._expected = smtp.SUCCESS
+        self._okresponse = lambda code, resp: self._go_idle()
+        self._failresponse = self._drop
+
+    def smtpState_from(self, code, resp):
+        """Start the next message, or go idle if there isn't one."""
+        self.ready = True
+        if self._job is None:
+            self._go_idle()
+        else:
+            smtp.ESMTPSender.smtpState_from(self, code, resp)
+
+    def getMailFrom(self):
+        return self._job.from_addr
+
+    def getMailTo(self):
+        return self._job.to_addrs
+
+    def getMailData(self):
+        return BytesIO(self._job.data)
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        """Fire the current message's Deferred with the server's verdict."""
+        job, self._job = self._job, None
+        if code not in smtp.SUCCESS:
+            errlog = []
+            for addr, acode, aresp in addresses:
+                if acode not in smtp.SUCCESS:
+                    errlog.append(addr + b": " + b"%03d" % acode + b" " + aresp)
+            errlog.append(log.str())
+            job.deferred.errback(
+                smtp.SMTPDeliveryError(code, resp, b"\n".join(errlog), addresses)
+            )
+        else:
+            job.deferred.callback((numOk, addresses))
+
+    def sendError(self, exc):
+        """Fail the current message, if any, and close the connection."""
+        self._error = exc
+        self.idle = False
+        job, self._job = self._job, None
+        smtp.SMTPClient.sendError(self, exc)
+        if job is not None:
+            self._job_failed(job, exc)
+
+    def timeoutConnection(self):
+        """Politely QUIT idle sessions; treat a silent server as an error otherwise."""
+        if self.idle:
+            _log.debug("Closing SMTP connection after %s idle seconds", self.pool.idle_timeout)
+            self.idle = False
+            self._disconnectFromServer()
+        else:
+            smtp.ESMTPSender.timeoutConnection(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.ESMTPSender.connectionLost(self, reason)
+        self.idle = False
+        job, self._job = self._job, None
+        if job is not None:
+            self._job_failed(job, reason.value)
+        self.pool._client_lost(self, self._error or reason.value)
+
+    def quit(self):
+        """Close the session; in-progress messages are allowed to finish."""
+        if self.idle:
+            self.idle = False
+            self._disconnectFromServer()
+
+    def _job_failed(self, job, reason):
+        """Fail the current message because the session broke."""
+        if self.ready:
+            self.pool._session_lost(job, reason)
+        else:
+            # Only a message being retried is handed to a new connection, so
+            # this is the relay failing to set up the new session.
+            job.deferred.errback(reason)
+
+    def _go_idle(self):
+        self.idle = True
+        self.last_used = self.pool.reactor.seconds()
+        # The server shouldn't say anything while we're idle, except perhaps to
+        # announce it's closing the connection (421).
+        self._expected = []
+        self._failresponse = self._drop
+        self.setTimeout(self.pool.idle_timeout)
+        self.pool._client_idle(self)
+
+    def _drop(self, code, resp):
+        self.idle = False
+        self.transport.loseConnection()
+
+
+class _PoolClientFactory(protocol.ClientFactory):
+    """
+    Builds a :class:`PooledESMTPSender` for a single pooled connection.
+
+    Args:
+        pool (SMTPConnectionPool): The pool the connection belongs to.
+        job (_Job): A message the connection sends as soon as its session is
+            established, before it takes messages from the pool.
+    """
+
+    protocol = PooledESMTPSender
+
+    def __init__(self, pool, job=None):
+        self.pool = pool
+        self.job = job
+
+    def buildProtocol(self, addr):
+        pool = self.pool
+        client = self.protocol(
+            pool.username, pool.password, None, smtp.DNSNAME, 10, hostname=pool.hostname
+        )
+        client.heloFallback = True
+        client.requireAuthentication = pool.require_authentication
+        client.requireTransportSecurity = pool.require_tls
+        client.factory = self
+        client.pool = pool
+        client.callLater = pool.reactor.callLater
+        client._job = self.job
+        pool._client_connected(client)
+        return client
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool._connection_failed(reason.value)
+        if self.job is not None:
+            self.job.deferred.errback(reason.value)
+
+
+class SMTPConnectionPool(object):
+    """
+    A bounded pool of persistent SMTP sessions to a single relay.
+
+    Connections are opened on demand, up to ``size`` of them, and are closed
+    after they have been idle for ``idle_timeout`` seconds. Idle connections
+    are checked with a NOOP every ``health_check_interval`` seconds so broken
+    sessions are discarded before a message is handed to them. A lost
+    connection is simply replaced the next time there's a message to send,
+    except that a message the lost session was sending is tried again right
+    away on a new connection. If that session is lost as well, the message
+    fails with :class:`SessionLost`.
+
+    Args:
+        hostname (str): The SMTP server's hostname.
+        port (int): The SMTP server's port.
+        size (int): The maximum number of concurrent connections.
+        username (str): The username to authenticate with, if any.
+        password (str): The password to authenticate with, if any.
+        require_authentication (bool): Whether authentication is required.
+        require_tls (bool): Whether STARTTLS is required.
+        idle_timeout (int): Seconds a connection may be idle (or a server may
+            be silent while sending) before it is closed.
+        health_check_interval (int): Seconds between NOOPs on idle connections;
+            0 disables health checks.
+        reactor (twisted.internet.interfaces.IReactorTCP): The reactor to use.
+    """
+
+    def __init__(
+        self,
+        hostname,
+        port=25,
+        size=1,
+        username=None,
+        password=None,
+        require_authentication=False,
+        require_tls=False,
+        idle_timeout=60,
+        health_check_interval=30,
+        reactor=global_reactor,
+    ):
+        if isinstance(username, str):
+            username = username.encode("utf-8")
+        if isinstance(password, str):
+            password = password.encode("utf-8")
+        self.hostname = hostname
+        self.port = port
+        self.size = size
+        self.username = username
+        self.password = password
+        self.require_authentication = require_authentication
+        self.require_tls = require_tls
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.reactor = reactor
+
+        self._clients = set()
+        self._idle = collections.deque()
+        self._pending = collections.deque()
+        self._connecting = 0
+        self._probes = []
+        self._health_check = task.LoopingCall(self.check_health)
+        self._health_check.clock = reactor
+
+    def start(self):
+        """Start the periodic health check of idle connections."""
+        if self.health_check_interval and not self._health_check.running:
+            self._health_check.start(self.health_check_interval, now=False)
+
+    def stop(self):
+        """Close all idle connections and fail any messages that haven't been sent."""
+        if self._health_check.running:
+            self._health_check.stop()
+        self._fail_pending(error.ConnectionClosed("The SMTP connection pool was stopped"))
+        for client in list(self._clients):
+            client.quit()
+
+    def send(self, from_addr, to_addrs, data):
+        """
+        Send a message over a pooled connection.
+
+        Args:
+            from_addr (bytes): The envelope sender.
+            to_addrs (list of bytes): The envelope recipients.
+            data (bytes): The message, including headers.
+
+        Returns:
+            defer.Deferred: Fires with a ``(numOk, addresses)`` tuple, like
+                :func:`twisted.mail.smtp.sendmail`, or errbacks with an
+                :class:`twisted.mail.smtp.SMTPClientError` or connection error.
+                The error is a :class:`SessionLost` if the server was reached
+                but the sessions the message was sent over were lost.
+        """
+        d = defer.Deferred()
+        self._pending.append(_Job(from_addr, to_addrs, data, d, False))
+        self._dispatch()
+        return d
+
+    def probe(self):
+        """
+        Check whether the server is accepting sessions.
+
+        If no session is established, a new connection is opened and, if it's
+        successful, it's added to the pool.
+
+        Returns:
+            defer.Deferred: Fires once a session is established, or errbacks
+                with the reason the connection failed.
+        """
+        if any(c.ready for c in self._clients):
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._probes.append(d)
+        if not self._connecting:
+            self._connect()
+        return d
+
+    def check_health(self):
+        """Send a NOOP on every idle connection."""
+        for client in list(self._idle):
+            client.check_health()
+
+    def stats(self):
+        """
+        Report the state of the pool.
+
+        Returns:
+            dict: The number of open, idle, and connecting connections, along
+                with the number of messages waiting for a connection.
+        """
+        return {
+            "connections": len(self._clients),
+            "idle": len(self._idle),
+            "connecting": self._connecting,
+            "pending": len(self._pending),
+        }
+
+    def _dispatch(self):
+        """Hand pending messages to idle connections, opening more if allowed."""
+        while self._pending and self._idle:
+            client = self._idle.popleft()
+            if client.idle:
+                client.send(self._pending.popleft())
+        waiting = len(self._pending) - self._connecting
+        while waiting > 0 and len(self._clients) + self._connecting < self.size:
+            self._connect()
+            waiting -= 1
+
+    def _connect(self, job=None):
+        self._connecting += 1
+        _log.debug("Opening a new connection to %s:%d", self.hostname, self.port)
+        self.reactor.connectTCP(self.hostname, self.port, _PoolClientFactory(self, job))
+
+    def _client_connected(self, client):
+        self._connecting -= 1
+        self._clients.add(client)
+
+    def _client_idle(self, client):
+        if client not in self._idle:
+            self._idle.append(client)
+        probes, self._probes = self._probes, []
+        for d in probes:
+            d.callback(None)
+        self._dispatch()
+
+    def _client_lost(self, client, reason):
+        self._clients.discard(client)
+        try:
+            self._idle.remove(client)
+        except ValueError:
+            pass
+        if client.ready:
+            self._dispatch()
+        else:
+            # The session never got past the handshake; unless another connection
+            # can pick up the slack, the waiting messages won't be sent either.
+            self._connection_failed(reason, connecting=False)
+
+    def _session_lost(self, job, reason):
+        """Send a message again on a new connection after its session was lost, once."""
+        if job.retried:
+            job.deferred.errback(SessionLost(str(reason)))
+            return
+        _log.info(
+            "Lost the session to %s:%d while sending a message (%s); trying again",
+            self.hostname,
+            self.port,
+            reason,
+        )
+        self._connect(job._replace(retried=True))
+
+    def _connection_failed(self, reason, connecting=True):
+        if connecting:
+            self._connecting -= 1
+        _log.warning("Unable to connect to %s:%d: %s", self.hostname, self.port, reason)
+        if not any(c.ready for c in self._clients) and not self._connecting:
+            self._fail_pending(reason)
+
+    def _fail_pending(self, reason):
+        pending, self._pending = self._pending, collections.deque()
+        for job in pending:
+            job.deferred.errback(reason)
+        probes, self._probes = self._probes, []
+        for d in probes:
+            d.errback(reason)
+
+
+#: Errors that mean a relay couldn't be reached, or its sessions couldn't be
+#: set up, rather than that it refused a message.
+_RELAY_ERRORS = (
+    error.ConnectError,
+    error.ConnectionClosed,
+    error.DNSLookupError,
+    smtp.SMTPConnectError,
+)
+
+#: The weight of the newest sample in a relay's average latency.
+_LATENCY_SMOOTHING = 0.1
+
+#: The number of seconds a relay's throughput is averaged over.
+_THROUGHPUT_WINDOW = 60
+
+
+class SMTPRelay(object):
+    """
+    A relay in an :class:`SMTPRelayPool`, and its delivery statistics.
+
+    Args:
+        pool (SMTPConnectionPool): The connections to the relay.
+        weight (int): The relay's share of the traffic relative to the others.
+
+    Attributes:
+        in_flight (int): The number of messages being sent through the relay.
+        sent (int): The number of messages the relay has accepted or rejected.
+        failed (int): The number of times the relay couldn't be reached.
+        down_until (float): When the relay can be used again after a failure.
+        latency (float): A moving average of the time, in seconds, it takes the
+            relay to accept a message.
+    """
+
+    def __init__(self, pool, weight=1):
+        self.pool = pool
+        self.weight = weight
+        self.name = "{}:{}".format(pool.hostname, pool.port)
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.down_until = 0
+        self.latency = None
+        self.last_chosen = 0
+        self._sent_per_second = collections.deque()
+
+    def record_sent(self, now, latency):
+        """Record a message the relay responded to, and how long it took."""
+        self.sent += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += _LATENCY_SMOOTHING * (latency - self.latency)
+        second = int(now)
+        if self._sent_per_second and self._sent_per_second[-1][0] == second:
+            self._sent_per_second[-1][1] += 1
+        else:
+            self._sent_per_second.append([second, 1])
+        self._expire(now)
+
+    def throughput(self, now):
+        """The average number of messages sent per second over the last minute."""
+        self._expire(now)
+        return sum(count for _, count in self._sent_per_second) / _THROUGHPUT_WINDOW
+
+    def stats(self, now):
+        """
+        Report the relay's state and performance.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            dict: Whether the relay is up, its weight, its message counts, its
+                throughput and latency, and its connection pool's statistics.
+        """
+        stats = {
+            "up": self.down_until <= now,
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "throughput": self.throughput(now),
+            "latency": self.latency,
+        }
+        stats.update(self.pool.stats())
+        return stats
+
+    def _expire(self, now):
+        while self._sent_per_second and self._sent_per_second[0][0] <= now - _THROUGHPUT_WINDOW:
+            self._sent_per_second.popleft()
+
+
+class SMTPRelayPool(object):
+    """
+    Send email through several SMTP relays.
+
+    Each message goes to the relay with the fewest messages in flight relative
+    to its weight; ties go to the relay that was chosen least recently, so
+    idle relays are used in weighted round-robin order. If a relay can't be
+    reached, it's taken out of rotation for ``retry_interval`` seconds and the
+    message is sent through another relay. If the relay was reached but lost
+    the session while sending (see :class:`SessionLost`), the message is sent
+    through another relay, but the relay stays in rotation. A relay that
+    refuses a message hasn't failed: the refusal is passed on to the caller.
+
+    This has the same interface as :class:`SMTPConnectionPool`.
+
+    Args:
+        relays (list of SMTPRelay): The relays to send through.
+        retry_interval (int): The number of seconds a relay that couldn't be
+            reached is left out of rotation.
+        reactor (twisted.internet.interfaces.IReactorTime): The reactor to use.
+    """
+
+    def __init__(self, relays, retry_interval=30, reactor=global_reactor):
+        self.relays = relays
+        self.retry_interval = retry_interval
+        self.reactor = reactor
+        self._chosen = 0
+
+    def start(self):
+        """Start the relays' connection pools."""
+        for relay in self.relays:
+            relay.pool.start()
+
+    def stop(self):
+        """Stop the relays' connection pools."""
+        for relay in self.relays:
+            relay.pool.stop()
+
+    @defer.inlineCallbacks
+    def send(self, from_addr, to_addrs, data):
+        """
+        Send a message through the best available relay, failing over to the
+        others if it can't be reached.
+
+        Args:
+            from_addr (bytes): The envelope sender.
+            to_addrs (list of bytes): The envelope recipients.
+            data (bytes): The message, including headers.
+
+        Returns:
+            defer.Deferred: Fires with a ``(numOk, addresses)`` tuple, or errbacks
+                like :meth:`SMTPConnectionPool.send`. If no relay could be
+                reached, it errbacks with a
+                :class:`twisted.internet.error.ConnectError`.
+        """
+        tried = set()
+        reason = "all relays are out of rotation"
+        while True:
+            relay = self._choose(tried)
+            if relay is None:
+                raise error.ConnectError(
+                    string="No SMTP relay is available; {}".format(reason)
+                )
+            tried.add(relay)
+            relay.in_flight += 1
+            started = self.reactor.seconds()
+            try:
+                result = yield relay.pool.send(from_addr, to_addrs, data)
+            except SessionLost as e:
+                _log.warning("Lost the session to SMTP relay %s: %s", relay.name, e)
+                reason = "{} lost the session with {}".format(relay.name, e)
+                continue
+            except _RELAY_ERRORS as e:
+                self._relay_failed(relay, e)
+                reason = "{} failed with {}".format(relay.name, e)
+                continue
+            except smtp.SMTPClientError:
+                relay.record_sent(self.reactor.seconds(), self.reactor.seconds() - started)
+                raise
+            finally:
+                relay.in_flight -= 1
+            relay.record_sent(self.reactor.seconds(), self.reactor.seconds() - started)
+            defer.returnValue(result)
+
+    def probe(self):
+        """
+        Check whether any relay is accepting sessions.
+
+        Relays that respond are put back into rotation.
+
+        Returns:
+            defer.Deferred: Fires once a relay has established a session, or
+                errbacks if none of them could.
+        """
+        d = defer.DeferredList(
+            [relay.pool.probe() for relay in self.relays],
+            fireOnOneCallback=True,
+            consumeErrors=True,
+        )
+
+        def _probed(result):
+            if isinstance(result, tuple):
+                # The (result, index) of the first relay to respond
+                self.relays[result[1]].down_until = 0
+                return None
+            # Every relay failed; report the first relay's reason
+            return result[0][1]
+
+        d.addCallback(_probed)
+        return d
+
+    def check_health(self):
+        """Send a NOOP on every idle connection to every relay."""
+        for relay in self.relays:
+            relay.pool.check_health()
+
+    def stats(self):
+        """
+        Report the state of the relays.
+
+        Returns:
+            dict: Map each relay's ``host:port`` to its statistics.
+        """
+        now = self.reactor.seconds()
+        return {relay.name: relay.stats(now) for relay in self.relays}
+
+    def _choose(self, exclude):
+        """Pick the relay for the next message, or ``None`` if none is available."""
+        now = self.reactor.seconds()
+        candidates = [r for r in self.relays if r.down_until <= now and r not in exclude]
+        if not candidates:
+            return None
+        relay = min(candidates, key=lambda r: ((r.in_flight + 1) / r.weight, r.last_chosen))
+        self._chosen += 1
+        relay.last_chosen = self._chosen
+        return relay
+
+    def _relay_failed(self, relay, reason):
+        relay.failed += 1
+        relay.down_until = self.reactor.seconds() + self.retry_interval
+        _log.warning(
+            "SMTP relay %s is unavailable (%s); taking it out of rotation for %d seconds",
+            relay.name,
+            reason,
+            self.retry_interval,
+        )
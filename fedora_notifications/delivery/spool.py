@@ -0,0 +1,564 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+A disk-backed spool of messages waiting to be delivered.
+
+Without a spool, a message stays unacknowledged in the broker until the IRC or
+SMTP server has accepted it, so a long backend outage means huge numbers of
+unacknowledged messages and a redelivery storm when the service restarts. With
+the spool enabled, the consumers append each message to a local write-ahead log
+and acknowledge it as soon as it's safely on disk; a drain loop then reads the
+log and feeds the messages to the backends.
+
+The log is a directory of append-only segment files. Each record is a header
+holding the record's length and CRC-32, followed by the JSON-encoded message.
+Appends are written immediately, but the ``fsync`` is batched: every append
+made within ``sync_interval`` seconds of the first is made durable by a single
+``fsync`` in a worker thread, and their Deferreds fire together. Segments are
+read back through ``mmap``.
+
+The position of the oldest record that hasn't been delivered is checkpointed to
+a cursor file about once a second, and segments entirely before it are deleted.
+When the service starts, everything after the cursor is delivered again, so
+delivery is at-least-once: messages delivered shortly before a crash may be
+delivered twice.
+
+A message that fails is appended again along with the number of attempts made
+so far. Once it has used up its attempts, or if the SMTP server rejects it
+permanently, it's handed to the ``dead_letter`` callable instead, so a message
+that can never be delivered doesn't cycle through the spool forever.
+"""
+import collections
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+import pika
+from twisted.internet import defer, reactor as global_reactor, task, threads
+from twisted.mail import smtp
+from twisted.python import failure
+from fedora_messaging import message as fm_message
+from fedora_messaging.exceptions import Drop, ValidationError
+
+_log = logging.getLogger(__name__)
+
+#: The header of each record: the length of the record's payload and its CRC-32.
+_HEADER = struct.Struct(">II")
+
+#: The name of the file that holds the position of the oldest undelivered record.
+_CURSOR_FILE = "cursor"
+
+#: The suffix of segment files; segments are named after their sequence number.
+_SEGMENT_SUFFIX = ".seg"
+
+#: The number of seconds between writes of the cursor file.
+_CHECKPOINT_INTERVAL = 1
+
+
+class Spool(object):
+    """
+    A write-ahead log of messages and the loop that delivers them.
+
+    Messages are delivered by the ``dispatch`` callable, which is called with the
+    message and may return a Deferred. Like a fedora-messaging consumer callback,
+    it may raise :class:`fedora_messaging.exceptions.Drop` to discard the message.
+    Any other exception, including :class:`fedora_messaging.exceptions.Nack`, means
+    the backend couldn't take the message: it's appended to the spool again and
+    the drain loop pauses for ``retry_interval`` seconds. After ``max_attempts``
+    failures, or a :class:`twisted.mail.smtp.SMTPDeliveryError` with a permanent
+    (5xx) code, the message is passed to ``dead_letter`` instead, or discarded
+    if there's no ``dead_letter`` callable.
+
+    Args:
+        directory (str): The directory to keep the segments in. It's created if
+            it doesn't exist.
+        dispatch (callable): Called with each spooled message to deliver it.
+        segment_size (int): The size in bytes at which a new segment is started.
+        sync_interval (float): The number of seconds to wait for more appends
+            before making them durable with a single ``fsync``.
+        max_in_flight (int): The maximum number of messages being delivered at once.
+        retry_interval (int): The number of seconds to pause delivery for after a
+            delivery fails.
+        max_attempts (int): The number of times to try delivering a message.
+        dead_letter (callable): Called with each message that is given up on;
+            it may return a Deferred.
+        reactor (twisted.internet.interfaces.IReactorTime): The reactor to use.
+
+    Attributes:
+        appended (int): The number of messages appended to the spool.
+        delivered (int): The number of spooled messages delivered.
+        dropped (int): The number of spooled messages discarded.
+        dead_lettered (int): The number of spooled messages given up on and
+            passed to ``dead_letter``.
+    """
+
+    def __init__(self, directory, dispatch, segment_size=64 * 1024 * 1024, sync_interval=0.05,
+                 max_in_flight=100, retry_interval=30, max_attempts=10, dead_letter=None,
+                 reactor=global_reactor):
+        self.directory = directory
+        self.dispatch = dispatch
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.max_in_flight = max_in_flight
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.dead_letter = dead_letter
+        self.reactor = reactor
+        self.appended = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.dead_lettered = 0
+
+        self._running = False
+        self._paused = False
+        self._resume_call = None
+
+        # The segment being appended to, and segments that have been rolled
+        # over but still need an fsync before they're closed.
+        self._write_seq = None
+        self._write_fd = None
+        self._write_offset = 0
+        self._rolled_fds = []
+        # Appends waiting for the next fsync, and the (segment, offset) up to
+        # which the log is known to be on disk.
+        self._sync_waiters = []
+        self._sync_call = None
+        self._syncing = None
+        self._durable = (0, 0)
+
+        # The position of the next record to deliver.
+        self._read_seq = None
+        self._read_offset = 0
+        self._read_map = None
+        self._in_flight = 0
+        # [segment, end offset, done] for records read but not yet completed,
+        # in log order; the cursor advances past them once they're done.
+        self._pending = collections.deque()
+        self._first_seq = None
+        self._cursor = None
+        self._saved_cursor = None
+        self._checkpoint = task.LoopingCall(self._write_cursor)
+        self._checkpoint.clock = reactor
+
+    def start(self):
+        """
+        Open the spool, recovering from an unclean shutdown if necessary, and
+        start delivering whatever it holds.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        cursor = self._read_cursor()
+        segments = self._segments()
+        for seq in segments:
+            if seq < cursor[0]:
+                os.remove(self._path(seq))
+        segments = [seq for seq in segments if seq >= cursor[0]]
+
+        if segments:
+            if segments[0] != cursor[0]:
+                cursor = (segments[0], 0)
+            self._write_seq = segments[-1]
+            self._write_offset = self._recover(self._write_seq)
+        else:
+            cursor = (cursor[0], 0)
+            self._write_seq = cursor[0]
+            self._write_offset = 0
+        self._write_fd = self._open(self._write_seq)
+        self._durable = (self._write_seq, self._write_offset)
+        self._first_seq = cursor[0]
+        self._cursor = self._saved_cursor = cursor
+        self._read_seq, self._read_offset = cursor
+        if cursor < self._durable:
+            _log.info(
+                "Replaying the spool in %s from segment %d, offset %d",
+                self.directory,
+                cursor[0],
+                cursor[1],
+            )
+
+        self._running = True
+        self._checkpoint.start(_CHECKPOINT_INTERVAL, now=False)
+        self._drain()
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """
+        Stop delivering messages and close the spool.
+
+        Appends that are waiting to be synced are synced first. Deliveries in
+        progress aren't waited for; they'll be delivered again on the next start.
+
+        Returns:
+            defer.Deferred: Fires when the spool is closed.
+        """
+        if not self._running:
+            return
+        self._running = False
+        if self._resume_call is not None and self._resume_call.active():
+            self._resume_call.cancel()
+        if self._checkpoint.running:
+            self._checkpoint.stop()
+        if self._syncing is not None:
+            yield self._syncing
+        if self._sync_call is not None and self._sync_call.active():
+            self._sync_call.cancel()
+        self._sync_call = None
+        if self._sync_waiters:
+            yield self._sync()
+        self._write_cursor()
+        os.close(self._write_fd)
+        self._write_fd = None
+        self._unmap()
+
+    def append(self, message):
+        """
+        Write a message to the spool.
+
+        Args:
+            message (fedora_messaging.message.Message): The message to spool. Its
+                ``queue`` attribute is preserved.
+
+        Returns:
+            defer.Deferred: Fires once the message is durably on disk.
+        """
+        return self._append(message, 0)
+
+    def _append(self, message, attempts):
+        """Write a message and the number of attempts made to deliver it to the spool."""
+        if self._write_fd is None:
+            return defer.fail(RuntimeError("The spool is not open"))
+        payload = _encode(message, attempts)
+        record = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        if self._write_offset and self._write_offset + len(record) > self.segment_size:
+            self._roll()
+        try:
+            os.write(self._write_fd, record)
+        except OSError:
+            # Don't leave a partial record behind
+            os.ftruncate(self._write_fd, self._write_offset)
+            return defer.fail()
+        self._write_offset += len(record)
+        self.appended += 1
+
+        d = defer.Deferred()
+        self._sync_waiters.append(d)
+        if self._sync_call is None and self._syncing is None:
+            self._sync_call = self.reactor.callLater(self.sync_interval, self._sync)
+        return d
+
+    def stats(self):
+        """
+        Report the state of the spool.
+
+        Returns:
+            dict: The number of messages appended, delivered, dropped, and
+                dead-lettered, the number being delivered, the number of
+                segments on disk, and whether delivery is paused.
+        """
+        return {
+            "appended": self.appended,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "dead_lettered": self.dead_lettered,
+            "in_flight": self._in_flight,
+            "segments": self._write_seq - self._first_seq + 1 if self._running else 0,
+            "paused": self._paused,
+        }
+
+    def _path(self, seq):
+        return os.path.join(self.directory, "{:016d}{}".format(seq, _SEGMENT_SUFFIX))
+
+    def _segments(self):
+        """The sequence numbers of the segments on disk, in order."""
+        return sorted(
+            int(name[: -len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(_SEGMENT_SUFFIX)
+        )
+
+    def _open(self, seq):
+        return os.open(self._path(seq), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def _roll(self):
+        """Start a new segment; the current one is closed once it has been synced."""
+        self._rolled_fds.append(self._write_fd)
+        self._write_seq += 1
+        self._write_offset = 0
+        self._write_fd = self._open(self._write_seq)
+
+    def _recover(self, seq):
+        """
+        Find the end of the last complete record in a segment, and truncate
+        anything after it: a record that was being written when the service
+        stopped uncleanly.
+
+        Returns:
+            int: The length of the valid part of the segment.
+        """
+        path = self._path(seq)
+        size = os.path.getsize(path)
+        offset = 0
+        if size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                while offset + _HEADER.size <= size:
+                    length, crc = _HEADER.unpack_from(m, offset)
+                    end = offset + _HEADER.size + length
+                    if end > size or zlib.crc32(m[offset + _HEADER.size:end]) != crc:
+                        break
+                    offset = end
+        if offset != size:
+            _log.warning(
+                "Discarding %d bytes of incomplete records from the end of %s",
+                size - offset,
+                path,
+            )
+            os.truncate(path, offset)
+        return offset
+
+    def _sync(self):
+        """Make all the appends so far durable and fire their Deferreds."""
+        self._sync_call = None
+        waiters, self._sync_waiters = self._sync_waiters, []
+        rolled, self._rolled_fds = self._rolled_fds, []
+        durable = (self._write_seq, self._write_offset)
+        # New segments need the directory synced, too, so they don't vanish
+        directory = self.directory if rolled else None
+        self._syncing = threads.deferToThread(_fsync, rolled + [self._write_fd], directory)
+        self._syncing.addBoth(self._synced, waiters, rolled, durable)
+        return self._syncing
+
+    def _synced(self, result, waiters, rolled, durable):
+        self._syncing = None
+        for fd in rolled:
+            os.close(fd)
+        if isinstance(result, failure.Failure):
+            _log.error("Failed to sync the spool in %s: %s", self.directory, result.value)
+            for d in waiters:
+                d.errback(result)
+        else:
+            self._durable = durable
+            for d in waiters:
+                d.callback(None)
+            self._drain()
+        if self._sync_waiters and self._sync_call is None:
+            self._sync_call = self.reactor.callLater(self.sync_interval, self._sync)
+
+    def _map(self, end):
+        """Get a map of the segment being read that covers at least ``end`` bytes."""
+        if self._read_map is None or len(self._read_map) < end:
+            self._unmap()
+            with open(self._path(self._read_seq), "rb") as f:
+                self._read_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._read_map
+
+    def _unmap(self):
+        if self._read_map is not None:
+            self._read_map.close()
+            self._read_map = None
+
+    def _read(self):
+        """
+        Read the next durable record.
+
+        Returns:
+            tuple: The record's segment, the offset of its end, and its payload,
+                or ``None`` if there are no more durable records.
+        """
+        while (self._read_seq, self._read_offset) < self._durable:
+            if self._read_seq < self._durable[0]:
+                # Earlier segments are complete; move on once this one is read
+                if self._read_offset >= len(self._map(self._read_offset + 1)):
+                    self._unmap()
+                    self._read_seq += 1
+                    self._read_offset = 0
+                    continue
+            start = self._read_offset + _HEADER.size
+            length, crc = _HEADER.unpack_from(self._map(start), self._read_offset)
+            end = start + length
+            payload = self._map(end)[start:end]
+            self._read_offset = end
+            if zlib.crc32(payload) != crc:
+                _log.error("Skipping a corrupt record in %s", self._path(self._read_seq))
+                continue
+            return self._read_seq, end, payload
+        return None
+
+    def _drain(self):
+        """Start delivering spooled messages, up to the in-flight limit."""
+        while self._running and not self._paused and self._in_flight < self.max_in_flight:
+            record = self._read()
+            if record is None:
+                return
+            seq, end, payload = record
+            entry = [seq, end, False]
+            self._pending.append(entry)
+            try:
+                message, attempts = _decode(payload)
+            except (ValueError, KeyError, ValidationError) as e:
+                _log.error("Dropping an unreadable message from the spool: %s", e)
+                self.dropped += 1
+                self._done(entry)
+                continue
+            self._in_flight += 1
+            d = defer.maybeDeferred(self.dispatch, message)
+            d.addBoth(self._delivered, entry, message, attempts + 1)
+
+    def _delivered(self, result, entry, message, attempts):
+        self._in_flight -= 1
+        if not isinstance(result, failure.Failure):
+            self.delivered += 1
+            self._done(entry)
+        elif result.check(Drop):
+            _log.info("Dropping message %s for %s", message.id, message.queue)
+            self.dropped += 1
+            self._done(entry)
+        elif result.check(smtp.SMTPDeliveryError) and result.value.code >= 500:
+            _log.error(
+                "Message %s to %s was rejected permanently (%r)",
+                message.id,
+                message.queue,
+                result.value,
+            )
+            self._give_up(entry, message)
+        elif attempts >= self.max_attempts:
+            _log.error(
+                "Giving up on message %s to %s after %d attempts (%r)",
+                message.id,
+                message.queue,
+                attempts,
+                result.value,
+            )
+            self._give_up(entry, message)
+        else:
+            _log.warning(
+                "Failed to deliver message %s to %s (%r); pausing delivery for %d seconds",
+                message.id,
+                message.queue,
+                result.value,
+                self.retry_interval,
+            )
+            self._pause()
+            # The record is only done once its replacement is safely on disk
+            d = self._append(message, attempts)
+            d.addCallbacks(
+                lambda _: self._done(entry),
+                lambda f: _log.error(
+                    "Failed to respool message %s: %s", message.id, f.getErrorMessage()
+                ),
+            )
+        self._drain()
+
+    def _give_up(self, entry, message):
+        """Pass a message that won't be delivered to ``dead_letter``, or discard it."""
+        if self.dead_letter is None:
+            self.dropped += 1
+            self._done(entry)
+            return
+
+        def _dead_lettered(result):
+            if isinstance(result, failure.Failure):
+                _log.error(
+                    "Failed to dead-letter message %s; discarding it: %s",
+                    message.id,
+                    result.getErrorMessage(),
+                )
+                self.dropped += 1
+            else:
+                self.dead_lettered += 1
+            self._done(entry)
+
+        defer.maybeDeferred(self.dead_letter, message).addBoth(_dead_lettered)
+
+    def _done(self, entry):
+        """Mark a record as handled and advance the cursor past any handled records."""
+        entry[2] = True
+        while self._pending and self._pending[0][2]:
+            seq, end, _ = self._pending.popleft()
+            self._cursor = (seq, end)
+
+    def _pause(self):
+        if not self._paused:
+            self._paused = True
+            self._resume_call = self.reactor.callLater(self.retry_interval, self._resume)
+
+    def _resume(self):
+        self._resume_call = None
+        self._paused = False
+        self._drain()
+
+    def _read_cursor(self):
+        """The position saved in the cursor file, or the start of the first segment."""
+        try:
+            with open(os.path.join(self.directory, _CURSOR_FILE)) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except FileNotFoundError:
+            segments = self._segments()
+            return (segments[0] if segments else 1), 0
+
+    def _write_cursor(self):
+        """Save the cursor and delete the segments that are entirely before it."""
+        if self._cursor == self._saved_cursor:
+            return
+        path = os.path.join(self.directory, _CURSOR_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write("{} {}\n".format(*self._cursor))
+        os.replace(path + ".tmp", path)
+        self._saved_cursor = self._cursor
+        for seq in range(self._first_seq, self._cursor[0]):
+            os.remove(self._path(seq))
+        self._first_seq = self._cursor[0]
+
+
+def _fsync(fds, directory=None):
+    """Flush files, and optionally a directory, to disk. This blocks, so it's run in a thread."""
+    for fd in fds:
+        os.fsync(fd)
+    if directory is not None:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def _encode(message, attempts):
+    """
+    Serialize a message, including the queue it arrived on and the number of
+    attempts made to deliver it, for the spool.
+    """
+    return json.dumps(
+        {
+            "id": message.id,
+            "attempts": attempts,
+            "topic": message.topic,
+            "queue": message.queue,
+            "headers": message._properties.headers,
+            "content_encoding": message._properties.content_encoding,
+            "body": message._encoded_body.decode("utf-8"),
+        },
+        default=str,
+    ).encode("utf-8")
+
+
+def _decode(payload):
+    """
+    Rebuild a message serialized by :func:`_encode`.
+
+    Returns:
+        tuple: The message and the number of attempts made to deliver it.
+    """
+    record = json.loads(payload.decode("utf-8"))
+    properties = pika.BasicProperties(
+        content_type="application/json",
+        content_encoding=record["content_encoding"],
+        headers=record["headers"],
+        message_id=record["id"],
+    )
+    message = fm_message.get_message(record["topic"], properties, record["body"].encode("utf-8"))
+    message.queue = record["queue"]
+    return message, record.get("attempts", 0)
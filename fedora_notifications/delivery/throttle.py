@@ -0,0 +1,241 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Flood control for the IRC client.
+
+IRC servers disconnect clients that send too fast. Servers typically let a
+client send a burst of lines, then hold it to a sustained rate, and charge
+long lines more than short ones. The :class:`TokenBucket` models this: the
+bucket refills at the sustained rate up to the burst size, and each line costs
+one token plus a fraction of a token per byte.
+
+The :class:`FairSendQueue` sends lines as fast as the bucket allows. Lines
+are queued by destination and the destinations take turns, so a user with a
+thousand pending notifications doesn't hold up everyone else. Lines to the
+same destination are still sent in order.
+"""
+import collections
+
+from twisted.internet import defer, reactor as global_reactor
+
+
+#: The weight of the newest line in the queue's average time to wire.
+_TIME_TO_WIRE_SMOOTHING = 0.05
+
+
+class TokenBucket(object):
+    """
+    A token bucket.
+
+    Args:
+        capacity (float): The maximum number of tokens the bucket holds; this is
+            the largest burst that can be sent at once.
+        rate (float): The number of tokens added to the bucket per second.
+        clock (twisted.internet.interfaces.IReactorTime): The clock to use.
+
+    Attributes:
+        tokens (float): The number of tokens in the bucket when it was last updated.
+    """
+
+    def __init__(self, capacity, rate, clock=global_reactor):
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.tokens = capacity
+        self._updated = clock.seconds()
+
+    def delay(self, cost):
+        """
+        The number of seconds until something costing ``cost`` tokens can be sent.
+
+        Something that costs more than the bucket can hold may be sent once the
+        bucket is full; the bucket then goes into debt.
+
+        Args:
+            cost (float): The cost in tokens.
+
+        Returns:
+            float: The number of seconds to wait, or 0 if it can be sent now.
+        """
+        self._refill()
+        needed = min(cost, self.capacity) - self.tokens
+        if needed <= 0:
+            return 0
+        return needed / self.rate
+
+    def consume(self, cost):
+        """Take ``cost`` tokens from the bucket."""
+        self._refill()
+        self.tokens -= cost
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class FairSendQueue(object):
+    """
+    Queue lines for sending and send them as fast as the flood limits allow.
+
+    Lines without a destination (registration, PONG, and other protocol
+    commands) are sent before any queued messages. Lines with a destination
+    are sent in round-robin order across destinations.
+
+    A line to several destinations, such as a PRIVMSG to several nicks, is
+    queued for each of them. It takes a turn from every one of them, and isn't
+    sent until the lines queued for any of them before it have been.
+
+    Args:
+        send (callable): Called with each line when it's time to send it.
+        burst (float): The number of lines that can be sent back to back.
+        rate (float): The sustained number of lines per second.
+        byte_cost (float): The additional cost, in lines, of each byte of a line.
+        clock (twisted.internet.interfaces.IReactorTime): The clock to use.
+
+    Attributes:
+        depth (int): The number of lines waiting to be sent.
+        sent (int): The number of lines sent.
+        time_to_wire (float): A moving average of the number of seconds lines
+            wait in the queue before they're sent.
+    """
+
+    def __init__(self, send, burst, rate, byte_cost, clock=global_reactor):
+        self.send = send
+        self.byte_cost = byte_cost
+        self.clock = clock
+        self.bucket = TokenBucket(burst, rate, clock)
+        self.depth = 0
+        self.sent = 0
+        self.time_to_wire = 0.0
+        self._priority = collections.deque()
+        # Destinations in the order they get their next turn
+        self._queues = collections.OrderedDict()
+        self._call = None
+        # Set while lines are being sent, so lines queued by the send or by a
+        # tracked line's callbacks are picked up by the same loop
+        self._pumping = False
+
+    def put(self, line, destination=None, track=False):
+        """
+        Queue a line for sending.
+
+        Args:
+            line (str): The line to send.
+            destination (str or tuple of str): The nick or channel the line is
+                for, or a tuple of them if it's for several, if any.
+            track (bool): Whether to return a Deferred that fires when the line
+                has been sent.
+
+        Returns:
+            defer.Deferred: If ``track`` is set, fires once the line has been
+                written to the connection, or errbacks if it's discarded with
+                :meth:`clear`. Otherwise ``None``.
+        """
+        d = defer.Deferred() if track else None
+        if destination is None:
+            destinations = ()
+        elif isinstance(destination, tuple):
+            destinations = destination
+        else:
+            destinations = (destination,)
+        entry = (line, d, self.clock.seconds(), destinations)
+        if not destinations:
+            self._priority.append(entry)
+        for name in destinations:
+            self._queues.setdefault(name, collections.deque()).append(entry)
+        self.depth += 1
+        if self._call is None and not self._pumping:
+            self._pump()
+        return d
+
+    def clear(self, reason):
+        """
+        Discard all queued lines, for example because the connection was lost.
+
+        Args:
+            reason (twisted.python.failure.Failure): The reason; tracked lines
+                errback with it.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        entries = list(self._priority)
+        for destination, lines in self._queues.items():
+            # A line to several destinations is only counted once
+            entries.extend(entry for entry in lines if entry[3][0] == destination)
+        self._priority.clear()
+        self._queues.clear()
+        self.depth = 0
+        for _, d, _, _ in entries:
+            if d is not None:
+                d.errback(reason)
+
+    def stats(self):
+        """
+        Report the state of the queue.
+
+        Returns:
+            dict: The number of lines queued, the number of destinations with
+                lines queued, the number of lines sent, the average time lines
+                spend queued, and the tokens available.
+        """
+        self.bucket._refill()
+        return {
+            "queued": self.depth,
+            "destinations": len(self._queues),
+            "sent": self.sent,
+            "time_to_wire": self.time_to_wire,
+            "tokens": self.bucket.tokens,
+        }
+
+    def _pump(self):
+        """Send queued lines until the bucket runs dry, then wait for it to refill."""
+        self._call = None
+        self._pumping = True
+        try:
+            while self.depth:
+                entry = self._priority[0] if self._priority else self._next_entry()
+                line, d, queued_at, _ = entry
+                cost = 1 + len(line.encode("utf-8")) * self.byte_cost
+                delay = self.bucket.delay(cost)
+                if delay:
+                    self._call = self.clock.callLater(delay, self._pump)
+                    return
+                self.bucket.consume(cost)
+                self._pop(entry)
+                self.sent += 1
+                self.time_to_wire += _TIME_TO_WIRE_SMOOTHING * (
+                    self.clock.seconds() - queued_at - self.time_to_wire
+                )
+                self.send(line)
+                if d is not None:
+                    d.callback(None)
+        finally:
+            self._pumping = False
+
+    def _next_entry(self):
+        """
+        The next line of the first destination in round-robin order whose next
+        line isn't waiting for earlier lines to its other destinations.
+
+        There always is one: the oldest of the destinations' next lines is the
+        next line of each of its destinations.
+        """
+        for lines in self._queues.values():
+            entry = lines[0]
+            if all(self._queues[name][0] is entry for name in entry[3]):
+                return entry
+
+    def _pop(self, entry):
+        """Remove the line that was just sent, and move its destinations to the back."""
+        self.depth -= 1
+        if not entry[3]:
+            self._priority.popleft()
+            return
+        for destination in entry[3]:
+            lines = self._queues.pop(destination)
+            lines.popleft()
+            if lines:
+                self._queues[destination] = lines
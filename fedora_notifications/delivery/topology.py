@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Avoid declaring queues and bindings the broker already has.
+
+Declaring a queue and its bindings takes a round trip to the broker for the
+queue and one for each binding, and a header binding is up to four AMQP
+bindings. Each queue records a fingerprint of its bindings, and the fingerprint
+the delivery service last declared (see :meth:`.db.Queue.fingerprint`). At
+startup, the queues whose fingerprints match are checked one at a time with a
+passive declare, which doesn't touch their bindings. Those that still exist are
+declared without their bindings; those that don't, for example because they
+expired while the service was down, are declared again with their bindings.
+
+Once the queues are consumed, the bindings that were skipped are loaded in the
+background and added to the bindings of each queue's connection. Queues also
+expire if a connection is down for long enough, and the connection declares
+its queues and bindings again in full whenever it's re-established.
+
+When a user changes their subscriptions while the service is running, only the
+bindings that were added or removed are applied, with :func:`update_bindings`.
+"""
+import logging
+
+from twisted.internet import defer
+import pika
+
+from ..db import models
+
+_log = logging.getLogger(__name__)
+
+
+@defer.inlineCallbacks
+def missing_queues(factory, queue_names):
+    """
+    Find out which queues don't exist on the broker.
+
+    Args:
+        factory (FedoraMessagingFactory): The factory of a connection to use.
+        queue_names (list of str): The names of the queues to check.
+
+    Returns:
+        defer.Deferred: Fires with the list of names of queues that don't exist.
+    """
+    missing = []
+    client = yield factory.whenConnected()
+    channel = yield client.channel()
+    try:
+        for queue_name in queue_names:
+            try:
+                yield channel.queue_declare(queue=queue_name, passive=True)
+            except pika.exceptions.ChannelClosed:
+                # The broker closes the channel when the queue doesn't exist
+                missing.append(queue_name)
+                channel = yield client.channel()
+    finally:
+        try:
+            channel.close()
+        except pika.exceptions.AMQPError:
+            pass
+    if missing:
+        _log.info("%d of %d queues need to be declared again", len(missing), len(queue_names))
+    defer.returnValue(missing)
+
+
+@defer.inlineCallbacks
+def update_bindings(factory, added, removed):
+    """
+    Bind and unbind a queue without declaring it again or touching its consumer.
+
+    The connection's own list of bindings is updated too, so the new bindings
+    are declared if it reconnects.
+
+    Args:
+        factory (FedoraMessagingFactory): The factory of the connection the
+            queue is declared on.
+        added (list of dict): The bindings to add.
+        removed (list of dict): The bindings to remove.
+
+    Returns:
+        defer.Deferred: Fires once the broker has applied the changes.
+    """
+    factory.bindings = [b for b in factory.bindings if b not in removed] + [
+        b for b in added if b not in factory.bindings
+    ]
+    client = yield factory.whenConnected()
+    if added:
+        yield client.bind_queues(added)
+    if not removed:
+        return
+    channel = yield client.channel()
+    try:
+        for binding in removed:
+            yield channel.queue_unbind(
+                queue=binding["queue"],
+                exchange=binding["exchange"],
+                routing_key=binding["routing_key"],
+                arguments=binding["arguments"],
+            )
+    finally:
+        try:
+            channel.close()
+        except pika.exceptions.AMQPError:
+            pass
+
+
+@defer.inlineCallbacks
+def declare_severity_exchanges(factory):
+    """
+    Declare the severity exchanges and bind them to ``amq.match``.
+
+    Args:
+        factory (FedoraMessagingFactory): The factory of a connection to use.
+
+    Returns:
+        defer.Deferred: Fires once the exchanges and bindings are declared.
+    """
+    client = yield factory.whenConnected()
+    yield client.declare_exchanges(models.severity_exchanges())
+    channel = yield client.channel()
+    try:
+        for binding in models.severity_exchange_bindings():
+            yield channel.exchange_bind(**binding)
+    finally:
+        try:
+            channel.close()
+        except pika.exceptions.AMQPError:
+            pass
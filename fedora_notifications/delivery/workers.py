@@ -0,0 +1,94 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""
+Run the delivery service as several worker processes.
+
+Each worker is a separate process with its own reactor, so the workers can use
+a CPU core each. They share the queues out between themselves as described in
+:mod:`.membership`. If a worker exits unexpectedly, the others take over its
+queues once its heartbeat times out, and it's restarted.
+"""
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+
+from twisted.internet import reactor
+from twisted.logger import globalLogBeginner, STDLibLogObserver
+
+from .. import config
+
+_log = logging.getLogger(__name__)
+
+#: The number of seconds between checks that the workers are still running.
+_SUPERVISE_INTERVAL = 1
+
+
+def run(worker_id=None, worker_index=None):
+    """
+    Run the delivery service in this process until it's told to stop.
+
+    Args:
+        worker_id (str): The ID of the worker, or ``None`` to use the
+            ``WORKER_ID`` setting.
+        worker_index (int): The index of the worker, or ``None`` to use the
+            ``WORKER_INDEX`` setting.
+    """
+    # Imported here so the service's module is only loaded in the workers
+    from .service import DeliveryService
+
+    globalLogBeginner.beginLoggingTo([STDLibLogObserver()], redirectStandardIO=False)
+    delivery_service = DeliveryService(worker_id=worker_id, worker_index=worker_index)
+    reactor.callWhenRunning(delivery_service.startService)
+    reactor.addSystemEventTrigger("before", "shutdown", delivery_service.stopService)
+    reactor.run()
+
+
+def supervise(count):
+    """
+    Run several workers, restarting any that exit, until this process is told to stop.
+
+    The workers are named after the host and their index, so a restarted
+    worker takes over its predecessor's spool.
+
+    Args:
+        count (int): The number of workers.
+    """
+    context = multiprocessing.get_context("spawn")
+    prefix = config.conf["WORKER_ID"] or socket.gethostname()
+    workers = {}
+    stopping = []
+
+    def start(index):
+        worker_id = "{}-{}".format(prefix, index)
+        process = context.Process(target=run, args=(worker_id, index), name=worker_id)
+        process.start()
+        _log.info("Started delivery worker %s (pid %d)", worker_id, process.pid)
+        workers[index] = process
+
+    def stop(signum, frame):
+        if not stopping:
+            _log.info("Stopping %d delivery workers", len(workers))
+            stopping.append(signum)
+            for process in workers.values():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(count):
+        start(index)
+    while workers:
+        time.sleep(_SUPERVISE_INTERVAL)
+        for index, process in list(workers.items()):
+            if process.is_alive():
+                continue
+            del workers[index]
+            if not stopping:
+                _log.warning(
+                    "Delivery worker %s exited with status %s; restarting it",
+                    process.name,
+                    process.exitcode,
+                )
+                start(index)
@@ -4,3 +4,17 @@ class FedoraNotificationError(Exception):
 
 class ConfigurationError(FedoraNotificationError):
     """A configuration-related error."""
+
+
+class RetryLater(FedoraNotificationError):
+    """
+    Raised by a delivery backend when a delivery failed for what is likely a
+    temporary reason and should be attempted again after a delay.
+    """
+
+
+class BackendUnavailable(RetryLater):
+    """
+    Raised by a delivery backend when the service it delivers through, such as
+    the SMTP server, can't be reached at all.
+    """
@@ -49,3 +49,64 @@ class QueueDeleted(Message):
     @property
     def queue_name(self):
         return self._body["name"]
+
+
+class QueueUpdated(Message):
+    """
+    Sent to the delivery service when the bindings of a queue change in the database.
+
+    It carries the exact bindings added and removed, so the delivery service
+    can bind and unbind them without declaring the queue again.
+    """
+    body_schema = {
+        "id": "http://fedoraproject.org/message-schema/fedora-notifications#queue-updated",
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "description": "Message sent by the web front-end when a user changes a queue's bindings",
+        "type": "object",
+        "properties": {
+            "name": {
+                "description": "The name of the queue that was updated",
+                "type": "string",
+            },
+            "added": {
+                "description": "The AMQP bindings added to the queue",
+                "type": "array",
+                "items": {"type": "object"},
+            },
+            "removed": {
+                "description": "The AMQP bindings removed from the queue",
+                "type": "array",
+                "items": {"type": "object"},
+            },
+            "topology": {
+                "description": "The fingerprint of the queue's bindings after the change",
+                "type": "string",
+            },
+            "previous_topology": {
+                "description": "The fingerprint of the queue's bindings before the change",
+                "type": ["string", "null"],
+            },
+        },
+        "required": ["name", "added", "removed"],
+    }
+    topic = "fedora-notifications-control-queue"
+
+    @property
+    def queue_name(self):
+        return self._body["name"]
+
+    @property
+    def added(self):
+        return self._body["added"]
+
+    @property
+    def removed(self):
+        return self._body["removed"]
+
+    @property
+    def topology(self):
+        return self._body.get("topology")
+
+    @property
+    def previous_topology(self):
+        return self._body.get("previous_topology")
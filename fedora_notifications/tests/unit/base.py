@@ -0,0 +1,96 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Base classes and helpers for the unit tests."""
+import contextlib
+import unittest
+from unittest import mock
+
+from fedora_messaging import message
+from sqlalchemy import event
+
+from fedora_notifications import config, db, messages
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Run each test against a new in-memory SQLite database.
+
+    Messages the database event listeners publish are captured in
+    :attr:`publish` rather than sent to a broker.
+    """
+
+    def setUp(self):
+        self.engine = db.initialize(dict(config.DEFAULTS, DATABASE_URL="sqlite://"))
+        db.Base.metadata.create_all(self.engine)
+        self.session = db.Session()
+        publish = mock.patch("fedora_notifications.db.events.api.publish")
+        self.publish = publish.start()
+        self.addCleanup(publish.stop)
+        # The message classes are registered by entry points, which only exist
+        # once the package is installed. Load the registry first, or it's
+        # loaded inside the patch and left empty once the patch is undone.
+        message.load_message_classes()
+        registry = mock.patch.dict(
+            message._class_to_schema_name,
+            {
+                messages.QueueCreated: "fn_queue_created",
+                messages.QueueDeleted: "fn_queue_deleted",
+                messages.QueueUpdated: "fn_queue_updated",
+            },
+        )
+        registry.start()
+        self.addCleanup(registry.stop)
+
+    def tearDown(self):
+        db.Session.remove()
+        self.engine.dispose()
+
+    def published(self, cls):
+        """The messages of a class that were published, in order."""
+        return [
+            call[0][0] for call in self.publish.call_args_list if isinstance(call[0][0], cls)
+        ]
+
+    @contextlib.contextmanager
+    def count_queries(self):
+        """Count the SQL statements executed in the block into the yielded list."""
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            yield statements
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count)
+
+
+def add_queue(session, username, delivery_type, identity, topics=(), headers=(), batch=None):
+    """
+    Add a queue with some bindings, creating its user if needed.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session.
+        username (str): The name of the user.
+        delivery_type (db.DeliveryType): The delivery type.
+        identity (str): The queue's identity.
+        topics (list of str): The topics of its topic bindings.
+        headers (list of tuple): The key names and severities of its header bindings.
+        batch (int): The batch interval, if any.
+
+    Returns:
+        db.Queue: The queue.
+    """
+    if session.query(db.User).get(username) is None:
+        session.add(db.User(name=username))
+    queue = db.Queue(
+        username=username, delivery_type=delivery_type, identity=identity, batch=batch
+    )
+    for topic in topics:
+        queue.topic_bindings.append(db.TopicBinding(topic=topic))
+    for key_name, severity in headers:
+        queue.header_bindings.append(db.HeaderBinding(key_name=key_name, severity=severity))
+    session.add(queue)
+    return queue
@@ -0,0 +1,138 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.db.events`."""
+from unittest import mock
+
+from fedora_messaging import exceptions as fml_exceptions
+
+from fedora_notifications import db, messages
+from fedora_notifications.tests.unit.base import DatabaseTestCase, add_queue
+
+
+class QueueLifecycleTests(DatabaseTestCase):
+    """Tests for the announcements of created and deleted queues."""
+
+    def test_created(self):
+        queue = add_queue(self.session, "jcline", db.DeliveryType.irc, "jcline", ["a.b"])
+        self.session.flush()
+        self.publish.assert_not_called()
+        self.session.commit()
+        self.assertEqual(
+            [queue.name], [m.queue_name for m in self.published(messages.QueueCreated)]
+        )
+        self.assertEqual([], self.published(messages.QueueUpdated))
+
+    def test_deleted(self):
+        queue = add_queue(self.session, "jcline", db.DeliveryType.irc, "jcline", ["a.b"])
+        self.session.commit()
+        self.session.delete(queue)
+        self.session.commit()
+        self.assertEqual(
+            [queue.name], [m.queue_name for m in self.published(messages.QueueDeleted)]
+        )
+        self.assertEqual([], self.published(messages.QueueUpdated))
+
+    def test_created_and_deleted(self):
+        """A queue deleted in the transaction that created it is never announced."""
+        queue = add_queue(self.session, "jcline", db.DeliveryType.irc, "jcline")
+        self.session.flush()
+        self.session.delete(queue)
+        self.session.commit()
+        self.publish.assert_not_called()
+
+    def test_replaced(self):
+        queue = add_queue(self.session, "jcline", db.DeliveryType.irc, "jcline")
+        self.session.commit()
+        self.session.delete(queue)
+        self.session.flush()
+        add_queue(self.session, "jcline", db.DeliveryType.irc, "jcline", batch=30)
+        self.session.commit()
+        announced = [type(call[0][0]) for call in self.publish.call_args_list[1:]]
+        self.assertEqual([messages.QueueDeleted, messages.QueueCreated], announced)
+
+    def test_rolled_back(self):
+        add_queue(self.session, "jcline", db.DeliveryType.irc, "jcline")
+        self.session.flush()
+        self.session.rollback()
+        self.session.commit()
+        self.publish.assert_not_called()
+
+    def test_publish_failed(self):
+        self.publish.side_effect = fml_exceptions.ConnectionException(reason="down")
+        add_queue(self.session, "jcline", db.DeliveryType.irc, "jcline")
+        add_queue(self.session, "jcline", db.DeliveryType.email, "jcline@example.com")
+        with mock.patch("fedora_notifications.db.events._log") as log:
+            self.session.commit()
+        self.assertEqual(2, self.publish.call_count)
+        self.assertEqual(2, log.error.call_count)
+
+
+class BindingChangeTests(DatabaseTestCase):
+    """Tests for the announcements of changed bindings."""
+
+    def setUp(self):
+        super(BindingChangeTests, self).setUp()
+        self.queue = add_queue(
+            self.session,
+            "jcline",
+            db.DeliveryType.irc,
+            "jcline",
+            topics=["a.b", "c.d"],
+            headers=[("fedora_messaging_user_jcline", 20)],
+        )
+        self.session.commit()
+        self.publish.reset_mock()
+
+    def test_added_and_removed(self):
+        previous = self.queue.topology
+        self.queue.topic_bindings.append(db.TopicBinding(topic="e.f"))
+        self.session.delete(self.queue.topic_bindings[0])
+        self.session.commit()
+
+        (updated,) = self.published(messages.QueueUpdated)
+        self.assertEqual(self.queue.name, updated.queue_name)
+        self.assertEqual(["e.f"], [b["routing_key"] for b in updated.added])
+        self.assertEqual(["a.b"], [b["routing_key"] for b in updated.removed])
+        self.assertEqual(previous, updated.previous_topology)
+        self.assertEqual(self.queue.topology, updated.topology)
+        self.assertNotEqual(previous, self.queue.topology)
+
+    def test_combined_across_flushes(self):
+        """A binding added and removed again before the commit isn't announced."""
+        binding = db.TopicBinding(topic="e.f")
+        self.queue.topic_bindings.append(binding)
+        self.session.flush()
+        self.session.delete(binding)
+        self.session.commit()
+        self.publish.assert_not_called()
+
+    def test_header_binding(self):
+        """Raising a header binding's severity floor unbinds the lower severities."""
+        self.queue.header_bindings[0].severity = 30
+        self.session.commit()
+        (updated,) = self.published(messages.QueueUpdated)
+        self.assertEqual([], updated.added)
+        self.assertTrue(updated.removed)
+
+    def test_unrelated_change(self):
+        topology = self.queue.topology
+        self.queue.batch = 60
+        self.session.commit()
+        self.publish.assert_not_called()
+        self.assertEqual(topology, self.queue.topology)
+
+    def test_rolled_back(self):
+        self.queue.topic_bindings.append(db.TopicBinding(topic="e.f"))
+        self.session.flush()
+        self.session.rollback()
+        self.session.commit()
+        self.publish.assert_not_called()
+
+    def test_publish_failed(self):
+        self.publish.side_effect = fml_exceptions.PublishException(reason="rejected")
+        self.queue.topic_bindings.append(db.TopicBinding(topic="e.f"))
+        with mock.patch("fedora_notifications.db.events._log") as log:
+            self.session.commit()
+        self.assertEqual(1, log.error.call_count)
+        self.assertEqual(4, len(self.queue.topic_bindings) + len(self.queue.header_bindings))
@@ -0,0 +1,124 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.db.queries`."""
+from fedora_notifications import db
+from fedora_notifications.db import queries
+from fedora_notifications.tests.unit.base import DatabaseTestCase, add_queue
+
+
+class QueueQueryTests(DatabaseTestCase):
+    """
+    The queue queries load everything they return with a fixed number of
+    queries, however many queues there are.
+    """
+
+    def setUp(self):
+        super(QueueQueryTests, self).setUp()
+        for i in range(20):
+            add_queue(
+                self.session,
+                "user{}".format(i % 4),
+                db.DeliveryType.irc if i % 2 else db.DeliveryType.email,
+                "id{}".format(i),
+                topics=["org.fedoraproject.prod.topic{}".format(i)],
+                headers=[("fedora_messaging_user_user{}".format(i % 4), 20)],
+                batch=30 if i % 5 == 0 else None,
+            )
+        self.session.commit()
+        db.Session.remove()
+        self.types = [db.DeliveryType.irc, db.DeliveryType.email]
+
+    def _applied(self):
+        """Record every queue's bindings as declared."""
+        for queue in db.Queue.query:
+            queue.applied_topology = queue.topology
+        db.Session.commit()
+        db.Session.remove()
+
+    def test_query_class(self):
+        self.assertIsInstance(db.Queue.query, queries.QueueQuery)
+
+    def test_consumable_changed(self):
+        """A page of queues whose bindings changed loads them in 4 queries."""
+        with self.count_queries() as statements:
+            page = db.Queue.query.consumable(self.types, limit=10)
+            bindings = [q.bindings for q in page]
+        self.assertEqual(4, len(statements))
+        self.assertEqual(10, len(page))
+        self.assertTrue(all(isinstance(q, queries.QueueRecord) for q in page))
+        self.assertTrue(all(q.changed for q in page))
+        self.assertTrue(all(len(b) == 4 for b in bindings))
+
+    def test_consumable_unchanged(self):
+        """A page of queues whose bindings were already declared takes 1 query."""
+        self._applied()
+        with self.count_queries() as statements:
+            page = db.Queue.query.consumable(self.types)
+        self.assertEqual(1, len(statements))
+        self.assertEqual(20, len(page))
+        self.assertTrue(all(q.bindings is None and not q.changed for q in page))
+
+    def test_consumable_with_bindings(self):
+        """The bindings of unbatched queues can be loaded, still in 4 queries."""
+        self._applied()
+        with self.count_queries() as statements:
+            page = db.Queue.query.consumable(self.types, with_bindings=True)
+        self.assertEqual(4, len(statements))
+        self.assertEqual(16, len([q for q in page if q.bindings is not None]))
+
+    def test_consumable_pages(self):
+        """Pages follow on from each other in ID order, one query each."""
+        self._applied()
+        seen, after = [], None
+        with self.count_queries() as statements:
+            while True:
+                page = db.Queue.query.consumable(self.types, after=after, limit=6)
+                if not page:
+                    break
+                seen += [q.id for q in page]
+                after = page[-1].id
+        self.assertEqual(5, len(statements))
+        self.assertEqual(sorted(seen), seen)
+        self.assertEqual(20, len(set(seen)))
+
+    def test_by_delivery_type(self):
+        """Queues can be filtered by delivery type."""
+        with self.count_queries() as statements:
+            queues = db.Queue.query.by_delivery_type([db.DeliveryType.irc]).all()
+        self.assertEqual(1, len(statements))
+        self.assertEqual(10, len(queues))
+
+    def test_for_user(self):
+        """A user's queues come with their bindings in 3 queries."""
+        with self.count_queries() as statements:
+            bindings = [q.bindings() for q in db.Queue.query.for_user("user1")]
+        self.assertEqual(3, len(statements))
+        self.assertEqual(5, len(bindings))
+
+    def test_bindings_by_id(self):
+        """The bindings of many queues are loaded in 3 queries."""
+        ids = [q.id for q in db.Queue.query]
+        db.Session.remove()
+        with self.count_queries() as statements:
+            bindings = db.Queue.query.bindings_by_id(ids)
+        self.assertEqual(3, len(statements))
+        self.assertEqual(set(ids), set(bindings))
+
+    def test_by_name(self):
+        """A queue is found by name, with its bindings in 3 queries."""
+        with self.count_queries() as statements:
+            queue = db.Queue.query.by_name("irc.id1").with_bindings().one()
+            bindings = queue.bindings()
+        self.assertEqual(3, len(statements))
+        self.assertEqual("irc.id1", queue.name)
+        self.assertEqual(4, len(bindings))
+
+    def test_summaries(self):
+        """Summaries don't load bindings and take 1 query."""
+        with self.count_queries() as statements:
+            summaries = db.Queue.query.summaries()
+        self.assertEqual(1, len(statements))
+        self.assertEqual(20, len(summaries))
+        summary = [s for s in summaries if s.identity == "id5"][0]
+        self.assertEqual(("irc.id5", db.DeliveryType.irc, "id5", 30), tuple(summary))
@@ -0,0 +1,182 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.batch`."""
+from unittest import mock
+
+from fedora_messaging import exceptions as fml_exceptions, message
+from pika import spec
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from fedora_notifications.delivery import batch
+
+
+class FakeChannel(object):
+    """An AMQP channel that serves messages from a list."""
+
+    def __init__(self, queues):
+        self.queues = queues
+        self.acked = []
+        self.nacked = []
+        self.closed = False
+        self._tag = 0
+
+    def basic_get(self, queue, auto_ack):
+        if not self.queues.get(queue):
+            return defer.succeed(None)
+        self._tag += 1
+        body, properties = self.queues[queue].pop(0)
+        method = spec.Basic.GetOk(delivery_tag=self._tag, routing_key="org.example.topic")
+        return defer.succeed((self, method, properties, body))
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.acked.append((delivery_tag, multiple))
+        return defer.succeed(None)
+
+    def basic_nack(self, delivery_tag, multiple, requeue):
+        self.nacked.append((delivery_tag, multiple, requeue))
+        return defer.succeed(None)
+
+    def close(self):
+        self.closed = True
+
+
+def publish(queues, queue_name, count):
+    for i in range(count):
+        msg = message.Message(topic="org.example.topic", body={"index": i})
+        queues.setdefault(queue_name, []).append((msg._encoded_body, msg._properties))
+
+
+class DigestSchedulerTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.queues = {}
+        self.channel = FakeChannel(self.queues)
+        client = mock.Mock()
+        client.channel.side_effect = lambda: defer.succeed(self.channel)
+        self.amqp_service = mock.Mock()
+        self.amqp_service.getFactory.return_value.whenConnected.side_effect = lambda: (
+            defer.succeed(client)
+        )
+        self.dispatch = mock.Mock(return_value=None)
+        self.scheduler = batch.DigestScheduler(
+            self.amqp_service, {"email": self.dispatch}, max_messages=5, reactor=self.clock
+        )
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.stop)
+
+    def digests(self):
+        return [
+            (queue_name, [m._body["index"] for m in messages])
+            for (queue_name, messages), _ in self.dispatch.call_args_list
+        ]
+
+    def test_drained_when_due(self):
+        publish(self.queues, "email.1", 3)
+        self.scheduler.add("email.1", 30, first_due=60)
+        self.clock.advance(59)
+        self.dispatch.assert_not_called()
+
+        self.clock.advance(1)
+        self.assertEqual([("email.1", [0, 1, 2])], self.digests())
+        self.assertEqual([(3, True)], self.channel.acked)
+        self.assertTrue(self.channel.closed)
+        self.assertEqual({"scheduled": 1, "draining": 0}, self.scheduler.stats())
+
+    def test_rescheduled_after_interval(self):
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(0)
+        publish(self.queues, "email.1", 1)
+        self.clock.advance(30 * 60 - 1)
+        self.dispatch.assert_not_called()
+        self.clock.advance(1)
+        self.assertEqual([("email.1", [0])], self.digests())
+
+    def test_empty_queue(self):
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(0)
+        self.dispatch.assert_not_called()
+        self.assertEqual([], self.channel.acked)
+
+    def test_due_in_order(self):
+        for name, due in (("email.3", 30), ("email.1", 10), ("email.2", 20)):
+            publish(self.queues, name, 1)
+            self.scheduler.add(name, 30, first_due=due)
+        self.clock.pump([10, 10, 10])
+        self.assertEqual(["email.1", "email.2", "email.3"], [q for q, _ in self.digests()])
+
+    def test_remaining_messages_sent_right_away(self):
+        publish(self.queues, "email.1", 7)
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertEqual([("email.1", [0, 1, 2, 3, 4]), ("email.1", [5, 6])], self.digests())
+        self.assertEqual([(5, True), (7, True)], self.channel.acked)
+
+    def test_nack_requeues(self):
+        publish(self.queues, "email.1", 2)
+        self.dispatch.side_effect = fml_exceptions.Nack()
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(0)
+        self.assertEqual([(2, True, True)], self.channel.nacked)
+        self.assertEqual([], self.channel.acked)
+
+    def test_error_requeues(self):
+        publish(self.queues, "email.1", 2)
+        self.dispatch.side_effect = ValueError("Oops")
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(0)
+        self.assertEqual([(2, True, True)], self.channel.nacked)
+
+    def test_drop_acks(self):
+        publish(self.queues, "email.1", 2)
+        self.dispatch.side_effect = fml_exceptions.Drop()
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(0)
+        self.assertEqual([(2, True)], self.channel.acked)
+
+    def test_invalid_message_dropped(self):
+        publish(self.queues, "email.1", 2)
+        self.queues["email.1"].insert(0, (b"not json", message.Message()._properties))
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(0)
+        self.assertEqual([("email.1", [0, 1])], self.digests())
+        self.assertEqual([(3, True)], self.channel.acked)
+
+    def test_removed(self):
+        publish(self.queues, "email.1", 1)
+        self.scheduler.add("email.1", 30, first_due=10)
+        self.scheduler.remove("email.1")
+        self.assertNotIn("email.1", self.scheduler)
+        self.clock.advance(10)
+        self.dispatch.assert_not_called()
+
+    def test_replaced(self):
+        publish(self.queues, "email.1", 1)
+        self.scheduler.add("email.1", 30, first_due=10)
+        self.scheduler.add("email.1", 60, first_due=20)
+        self.clock.advance(10)
+        self.dispatch.assert_not_called()
+        self.clock.advance(10)
+        self.assertEqual([("email.1", [0])], self.digests())
+
+    def test_no_channel(self):
+        self.amqp_service.getFactory.return_value.whenConnected.side_effect = lambda: (
+            defer.fail(fml_exceptions.ConnectionException(reason="down"))
+        )
+        publish(self.queues, "email.1", 1)
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(0)
+        self.dispatch.assert_not_called()
+        self.assertEqual({"scheduled": 1, "draining": 0}, self.scheduler.stats())
+
+    def test_not_drained_when_stopped(self):
+        self.scheduler.stop()
+        publish(self.queues, "email.1", 1)
+        self.scheduler.add("email.1", 30, first_due=0)
+        self.clock.advance(60)
+        self.dispatch.assert_not_called()
+        self.scheduler.start()
+        self.clock.advance(0)
+        self.assertEqual([("email.1", [0])], self.digests())
@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.breaker`."""
+from unittest import mock
+
+from fedora_messaging.exceptions import Nack
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from fedora_notifications import exceptions
+from fedora_notifications.delivery import breaker, service
+
+
+class CircuitBreakerTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.probe = mock.Mock(return_value=defer.succeed(None))
+        self.breaker = breaker.CircuitBreaker(
+            "Test", self.probe, failure_threshold=2, reset_timeout=30, reactor=self.clock
+        )
+
+    def _open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_closed_allows(self):
+        """Deliveries go ahead immediately while the breaker is closed."""
+        self.assertTrue(self.breaker.allow().called)
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+
+    def test_success_resets_failures(self):
+        """Failures must be consecutive to open the breaker."""
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+        self.assertEqual(1, self.breaker.failures)
+
+    def test_opens_at_threshold(self):
+        """The breaker opens after the threshold of consecutive failures."""
+        self._open()
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.assertEqual(1, self.breaker.times_opened)
+
+    def test_open_holds_deliveries(self):
+        """Deliveries wait while the breaker is open, without a probe having run."""
+        self._open()
+        d = self.breaker.allow()
+        self.assertFalse(d.called)
+        self.assertEqual(1, self.breaker.stats()["waiting"])
+        self.clock.advance(29)
+        self.assertFalse(d.called)
+        self.probe.assert_not_called()
+
+    def test_failures_while_open_ignored(self):
+        """Deliveries that were in progress when the breaker opened don't count."""
+        self._open()
+        self.breaker.record_failure()
+        self.assertEqual(0, self.breaker.failures)
+        self.assertEqual(1, self.breaker.times_opened)
+
+    def test_failed_probe_stays_open(self):
+        """A failed probe keeps deliveries waiting and schedules another probe."""
+        self.probe.return_value = defer.fail(Exception("still down"))
+        self._open()
+        d = self.breaker.allow()
+        self.clock.advance(30)
+        self.assertEqual(1, self.probe.call_count)
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.assertFalse(d.called)
+        self.probe.return_value = defer.succeed(None)
+        self.clock.advance(30)
+        self.assertEqual(2, self.probe.call_count)
+        self.assertTrue(d.called)
+
+    def test_probe_half_opens(self):
+        """A successful probe half-opens the breaker and releases the deliveries."""
+        self._open()
+        waiting = [self.breaker.allow(), self.breaker.allow()]
+        self.clock.advance(30)
+        self.assertEqual(breaker.HALF_OPEN, self.breaker.state)
+        self.assertTrue(all(d.called for d in waiting))
+        self.assertEqual(0, self.breaker.stats()["waiting"])
+        self.assertTrue(self.breaker.allow().called)
+
+    def test_half_open_success_closes(self):
+        """A successful delivery while half-open closes the breaker."""
+        self._open()
+        self.clock.advance(30)
+        self.breaker.record_success()
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+
+    def test_half_open_failure_reopens(self):
+        """A single failure while half-open opens the breaker again."""
+        self._open()
+        self.clock.advance(30)
+        self.breaker.record_failure()
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.assertEqual(2, self.breaker.times_opened)
+        self.assertFalse(self.breaker.allow().called)
+
+    def test_stop(self):
+        """Stopping the breaker cancels the scheduled probe."""
+        self._open()
+        self.breaker.stop()
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.clock.advance(30)
+        self.probe.assert_not_called()
+
+
+class EmailBreakerTests(unittest.SynchronousTestCase):
+    """Tests for how email deliveries use the email circuit breaker."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.service = service.DeliveryService.__new__(service.DeliveryService)
+        self.service.email_breaker = breaker.CircuitBreaker(
+            "Email",
+            lambda: defer.succeed(None),
+            failure_threshold=1,
+            reset_timeout=30,
+            reactor=self.clock,
+        )
+        self.service.retrier = mock.Mock()
+        self.service.router = None
+        self.service.email_limiter = mock.Mock()
+        self.service.smtp_pool = mock.Mock()
+        self.service.render_cache = mock.Mock()
+        self.message = mock.Mock()
+
+    def test_held_while_open(self):
+        """An email waits while the breaker is open and is sent once it half-opens."""
+        self.service.email_limiter.run.return_value = defer.succeed(None)
+        self.service.email_breaker.record_failure()
+        d = self.service._dispatch_email(self.message)
+        self.assertNoResult(d)
+        self.service.email_limiter.run.assert_not_called()
+        self.clock.advance(30)
+        self.successResultOf(d)
+        self.assertEqual(1, self.service.email_limiter.run.call_count)
+        self.assertEqual(breaker.CLOSED, self.service.email_breaker.state)
+
+    def test_unavailable_opens_and_nacks(self):
+        """An email that finds the backend unavailable opens the breaker and is returned."""
+        self.service.email_limiter.run.return_value = defer.fail(
+            exceptions.BackendUnavailable()
+        )
+        d = self.service._dispatch_email(self.message)
+        self.assertEqual(breaker.OPEN, self.service.email_breaker.state)
+        self.failureResultOf(d, Nack)
@@ -0,0 +1,192 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.irc`."""
+from unittest import mock
+
+from fedora_messaging import message
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from fedora_notifications import config, exceptions
+from fedora_notifications.delivery import irc, presence, throttle
+
+
+def make_message(recipient="jcline"):
+    msg = message.Message(topic="org.example.topic", body={})
+    msg.queue = "irc." + recipient
+    return msg
+
+
+class IrcProtocolTestCase(unittest.SynchronousTestCase):
+    """Connect an :class:`irc.IrcProtocol` to a transport with a fake clock."""
+
+    settings = {}
+
+    def setUp(self):
+        self.clock = task.Clock()
+        settings = dict(
+            config.DEFAULTS,
+            IRC_COALESCE_WINDOW=3,
+            IRC_FANOUT_WINDOW=0,
+            IRC_OFFLINE_POLICY="send",
+            IRC_SEND_BURST=100,
+        )
+        settings.update(self.settings)
+        for patcher in (
+            mock.patch.object(config, "conf", settings),
+            mock.patch.object(irc, "global_reactor", self.clock),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.factory = irc.IrcFactory("notifications")
+        self.client = self.factory.buildProtocol(None)
+        self.client.send_queue = throttle.FairSendQueue(
+            self.client._send, burst=100, rate=10, byte_cost=0, clock=self.clock
+        )
+        if self.client.presence is not None:
+            self.client.presence = presence.PresenceCache(self.client.sendLine, clock=self.clock)
+        self.transport = proto_helpers.StringTransport()
+        self.client.makeConnection(self.transport)
+        self.transport.clear()
+
+    def lines(self):
+        lines = self.transport.value().decode("utf-8").splitlines()
+        self.transport.clear()
+        return lines
+
+    def lose_connection(self):
+        self.client.connectionLost(failure.Failure(error.ConnectionLost()))
+
+
+class CoalesceTests(IrcProtocolTestCase):
+    def test_first_sent_right_away(self):
+        self.successResultOf(self.client.deliver(make_message(), "one"))
+        self.assertEqual(["PRIVMSG jcline :one"], self.lines())
+
+    def test_burst_waits_for_its_line(self):
+        self.client.deliver(make_message(), "one")
+        second = self.client.deliver(make_message(), "two")
+        third = self.client.deliver(make_message(), "three")
+        self.lines()
+        self.assertNoResult(second)
+        self.assertNoResult(third)
+        self.assertEqual(2, self.client.buffered)
+
+        self.clock.advance(self.client.coalesce_window)
+        self.assertEqual(["PRIVMSG jcline :two | three"], self.lines())
+        self.successResultOf(second)
+        self.successResultOf(third)
+        self.assertEqual(2, self.client.coalesced)
+        self.assertEqual(1, self.client.lines_saved)
+
+    def test_burst_failed_on_disconnect(self):
+        """Coalesced notifications aren't acknowledged if they were never sent."""
+        self.client.deliver(make_message(), "one")
+        second = self.client.deliver(make_message(), "two")
+        self.lose_connection()
+        self.failureResultOf(second, error.ConnectionLost)
+        self.assertEqual(0, self.client.buffered)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_closed_while_queued(self):
+        """A burst whose line is queued but unsent when the connection closes fails."""
+        self.client.send_queue.bucket = throttle.TokenBucket(1, 0.1, self.clock)
+        self.client.deliver(make_message(), "one")
+        second = self.client.deliver(make_message(), "two")
+        self.clock.advance(self.client.coalesce_window)
+        self.assertNoResult(second)
+        self.lose_connection()
+        self.failureResultOf(second, error.ConnectionLost)
+
+
+class ParkTests(IrcProtocolTestCase):
+    settings = {"IRC_OFFLINE_POLICY": "park", "IRC_COALESCE_WINDOW": 0}
+
+    def test_unknown_sent(self):
+        self.successResultOf(self.client.deliver(make_message(), "one"))
+        self.assertEqual(["PRIVMSG jcline :one"], self.lines())
+
+    def test_offline_retried_later(self):
+        self.client.presence.lookup("jcline")
+        self.client.irc_ERR_NOSUCHNICK("server", ["notifications", "jcline", "No such nick"])
+        self.failureResultOf(self.client.deliver(make_message(), "one"), exceptions.RetryLater)
+        self.assertEqual([], self.lines())
+        self.assertEqual(1, self.client.stats()["presence"]["lines_saved"])
+
+        self.client.presence.poll()
+        self.client.irc_RPL_ISON("server", ["notifications", "JCline"])
+        self.successResultOf(self.client.deliver(make_message(), "two"))
+        self.assertEqual(["ISON jcline", "PRIVMSG jcline :two"], self.lines())
+
+    def test_channel_always_sent(self):
+        self.client.presence.lookup("#fedora")
+        self.client.presence.set_status(["#fedora"], False)
+        self.successResultOf(self.client.deliver(make_message("#fedora"), "one"))
+        self.assertEqual(["PRIVMSG #fedora :one"], self.lines())
+
+
+class DropTests(IrcProtocolTestCase):
+    settings = {"IRC_OFFLINE_POLICY": "drop"}
+
+    def test_offline_dropped(self):
+        self.client.presence.lookup("jcline")
+        self.client.presence.set_status(["jcline"], False)
+        self.successResultOf(self.client.deliver(make_message(), "one"))
+        self.assertEqual([], self.lines())
+        self.assertEqual(1, self.client.offline_lines_saved)
+
+
+class FanOutTests(IrcProtocolTestCase):
+    settings = {"IRC_FANOUT_WINDOW": 500, "IRC_COALESCE_WINDOW": 0}
+
+    def setUp(self):
+        super(FanOutTests, self).setUp()
+        self.client.irc_RPL_ISUPPORT(
+            "server", ["notifications", "TARGMAX=PRIVMSG:3", "are supported by this server"]
+        )
+
+    def test_first_sent_right_away(self):
+        self.successResultOf(self.client.deliver(make_message("a"), "hello"))
+        self.assertEqual(["PRIVMSG a :hello"], self.lines())
+        self.clock.advance(self.client.fanout_window)
+        self.assertEqual([], self.lines())
+        self.assertEqual({}, self.client._fanouts)
+
+    def test_grouped(self):
+        self.client.deliver(make_message("a"), "hello")
+        deliveries = [self.client.deliver(make_message(n), "hello") for n in "bcde"]
+        self.assertEqual(["PRIVMSG a :hello"], self.lines())
+        self.assertEqual(4, self.client.buffered)
+        for d in deliveries:
+            self.assertNoResult(d)
+
+        self.clock.advance(self.client.fanout_window)
+        self.assertEqual(["PRIVMSG b,c,d :hello", "PRIVMSG e :hello"], self.lines())
+        for d in deliveries:
+            self.successResultOf(d)
+        self.assertEqual(2, self.client.fanout_lines_saved)
+
+    def test_turn_per_target(self):
+        """The line to several targets is sent after the lines queued for each of them."""
+        self.client.send_queue.bucket = throttle.TokenBucket(1, 1, self.clock)
+        self.client.send_queue.bucket.tokens = 0
+        self.client.deliver(make_message("b"), "other")
+        self.client.deliver(make_message("a"), "hello")
+        self.client.deliver(make_message("b"), "hello")
+        self.client.deliver(make_message("c"), "hello")
+        self.clock.advance(self.client.fanout_window)
+        self.assertEqual(3, self.client.send_queue.stats()["destinations"])
+        self.clock.pump([1] * 3)
+        self.assertEqual(
+            ["PRIVMSG b :other", "PRIVMSG a :hello", "PRIVMSG b,c :hello"], self.lines()
+        )
+
+    def test_disconnected(self):
+        self.client.deliver(make_message("a"), "hello")
+        d = self.client.deliver(make_message("b"), "hello")
+        self.lose_connection()
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual([], self.clock.getDelayedCalls())
@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.presence`."""
+from twisted.internet import task
+from twisted.trial import unittest
+
+from fedora_notifications.delivery import presence
+
+
+class PresenceCacheTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.cache = presence.PresenceCache(
+            self.sent.append, max_nicks=3, poll_interval=60, clock=self.clock
+        )
+        self.cache.start()
+        self.addCleanup(self.cache.stop)
+
+    def test_unknown_then_polled(self):
+        self.assertIsNone(self.cache.lookup("jcline"))
+        self.assertIsNone(self.cache.lookup("Abompard"))
+        self.clock.advance(60)
+        self.assertEqual(["ISON jcline abompard"], self.sent)
+
+        self.cache.ison_reply(["JCline"])
+        self.assertTrue(self.cache.lookup("jcline"))
+        self.assertFalse(self.cache.lookup("abompard"))
+        self.assertEqual(
+            {"tracked": 2, "online": 1, "offline": 1, "monitored": 0, "hits": 2, "misses": 2},
+            self.cache.stats(),
+        )
+
+    def test_ison_replies_in_order(self):
+        self.cache.lookup("a")
+        self.cache.poll()
+        self.cache.lookup("b")
+        self.cache.poll()
+        self.cache.ison_reply([])
+        self.cache.ison_reply(["b"])
+        self.cache.ison_reply(["a"])
+        self.assertFalse(self.cache.lookup("a"))
+        self.assertTrue(self.cache.lookup("b"))
+
+    def test_ison_split(self):
+        cache = presence.PresenceCache(self.sent.append, clock=self.clock)
+        nicks = ["nick{:0>26}".format(i) for i in range(40)]
+        for nick in nicks:
+            cache.lookup(nick)
+        cache.poll()
+        self.assertEqual(3, len(self.sent))
+        self.assertTrue(all(len(line) <= presence._MAX_LINE_LENGTH for line in self.sent))
+        self.assertEqual(nicks, [n for line in self.sent for n in line.split()[1:]])
+
+    def test_monitor(self):
+        self.cache.lookup("a")
+        self.cache.set_monitor_limit(2)
+        self.cache.lookup("b")
+        self.cache.lookup("c")
+        self.clock.advance(0)
+        self.assertEqual(["MONITOR + a,b"], self.sent)
+        self.cache.poll()
+        self.assertEqual("ISON c", self.sent[-1])
+
+        self.cache.set_status(["A"], False)
+        self.cache.set_status(["b"], True)
+        self.assertFalse(self.cache.lookup("a"))
+        self.assertTrue(self.cache.lookup("b"))
+        self.assertEqual(2, self.cache.stats()["monitored"])
+
+    def test_monitor_list_full(self):
+        self.cache.set_monitor_limit(3)
+        self.cache.lookup("a")
+        self.cache.lookup("b")
+        self.clock.advance(0)
+        self.cache.monitor_list_full(["b"])
+        self.assertEqual(1, self.cache.monitor_limit)
+        self.cache.poll()
+        self.assertEqual(["MONITOR + a,b", "ISON b"], self.sent)
+
+    def test_least_recent_forgotten(self):
+        self.cache.set_monitor_limit(3)
+        for nick in ("a", "b", "c"):
+            self.cache.lookup(nick)
+        self.clock.advance(0)
+        self.cache.lookup("a")
+        self.cache.lookup("d")
+        self.assertEqual(["MONITOR + a,b,c", "MONITOR - b"], self.sent)
+        self.clock.advance(0)
+        self.assertEqual("MONITOR + d", self.sent[-1])
+        self.assertEqual(3, self.cache.stats()["tracked"])
+
+    def test_untracked_status_ignored(self):
+        self.cache.set_status(["jcline"], True)
+        self.assertEqual(0, self.cache.stats()["tracked"])
+        self.assertIsNone(self.cache.lookup("jcline"))
+
+    def test_stop(self):
+        self.cache.set_monitor_limit(3)
+        self.cache.lookup("jcline")
+        self.cache.stop()
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual(0, self.cache.stats()["tracked"])
+        self.cache.ison_reply(["jcline"])
+        self.assertEqual([], self.sent)
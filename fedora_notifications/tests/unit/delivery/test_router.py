@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.router`."""
+from fedora_messaging import message
+from twisted.trial import unittest
+
+from fedora_notifications.db import models
+from fedora_notifications.delivery import router
+
+
+def topic_binding(queue_name, topic):
+    return {"queue": queue_name, "exchange": "amq.topic", "routing_key": topic}
+
+
+def make_message(topic="org.example.topic", user=None, severity=message.INFO):
+    headers = {"fedora_messaging_user_{}".format(user): True} if user else {}
+    return message.Message(topic=topic, body={}, headers=headers, severity=severity)
+
+
+class TopicMatchesTests(unittest.SynchronousTestCase):
+    def assertMatches(self, pattern, topic, expected=True):
+        self.assertEqual(
+            expected,
+            router._topic_matches(pattern.split("."), topic.split(".")),
+            "{} {} {}".format(pattern, "should match" if expected else "shouldn't match", topic),
+        )
+
+    def test_exact(self):
+        self.assertMatches("org.fedoraproject.prod.bodhi", "org.fedoraproject.prod.bodhi")
+        self.assertMatches("org.fedoraproject.prod.bodhi", "org.fedoraproject.prod.koji", False)
+        self.assertMatches("org.fedoraproject", "org.fedoraproject.prod", False)
+
+    def test_star(self):
+        self.assertMatches("org.*.prod", "org.fedoraproject.prod")
+        self.assertMatches("*.*", "a.b")
+        self.assertMatches("org.*.prod", "org.prod", False)
+        self.assertMatches("org.*.prod", "org.a.b.prod", False)
+        self.assertMatches("org.*", "org", False)
+
+    def test_hash(self):
+        self.assertMatches("#", "org.fedoraproject.prod")
+        self.assertMatches("org.#", "org")
+        self.assertMatches("org.#", "org.fedoraproject.prod.bodhi")
+        self.assertMatches("#.bodhi", "org.fedoraproject.prod.bodhi")
+        self.assertMatches("org.#.bodhi", "org.bodhi")
+        self.assertMatches("org.#.bodhi", "org.a.b.bodhi")
+        self.assertMatches("org.#.bodhi", "org.a.b.koji", False)
+        self.assertMatches("org.#", "com.fedoraproject", False)
+
+    def test_mixed(self):
+        self.assertMatches("*.#.prod.*", "org.prod.bodhi")
+        self.assertMatches("*.#.prod.*", "org.a.b.prod.bodhi")
+        self.assertMatches("*.#.prod.*", "prod.bodhi", False)
+        self.assertMatches("#.*", "org")
+        self.assertMatches("#.#", "a.b.c")
+
+
+class HeaderRouterTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.router = router.HeaderRouter()
+
+    def test_topics(self):
+        self.router.add("irc.a", [topic_binding("irc.a", "org.example.topic")])
+        self.router.add("irc.b", [topic_binding("irc.b", "org.example.#")])
+        self.router.add("irc.c", [topic_binding("irc.c", "org.other.*")])
+        self.assertEqual({"irc.a", "irc.b"}, self.router.route(make_message()))
+        self.assertEqual({"irc.b"}, self.router.route(make_message("org.example.other")))
+        self.assertEqual(set(), self.router.route(make_message("com.example.topic")))
+
+    def test_header_severity_floor(self):
+        self.router.add(
+            "irc.a",
+            models.header_bindings(
+                "irc.a", "fedora_messaging_user_jcline", message.WARNING, tiered=False
+            ),
+        )
+        self.assertEqual(
+            {"irc.a"}, self.router.route(make_message(user="jcline", severity=message.ERROR))
+        )
+        self.assertEqual(
+            {"irc.a"}, self.router.route(make_message(user="jcline", severity=message.WARNING))
+        )
+        self.assertEqual(set(), self.router.route(make_message(user="jcline")))
+        self.assertEqual(set(), self.router.route(make_message(user="someone", severity=50)))
+
+    def test_severity_exchange_bindings(self):
+        self.router.add(
+            "irc.a",
+            models.header_bindings(
+                "irc.a", "fedora_messaging_user_jcline", message.WARNING, tiered=True
+            ),
+        )
+        self.assertEqual(
+            {"irc.a"}, self.router.route(make_message(user="jcline", severity=message.WARNING))
+        )
+        self.assertEqual(set(), self.router.route(make_message(user="jcline")))
+
+    def test_replace_bindings(self):
+        self.router.add("irc.a", [topic_binding("irc.a", "org.example.topic")])
+        self.router.add("irc.a", [topic_binding("irc.a", "org.example.other")])
+        self.assertEqual(set(), self.router.route(make_message()))
+        self.assertEqual({"irc.a"}, self.router.route(make_message("org.example.other")))
+        self.assertEqual(1, len(self.router))
+
+    def test_remove(self):
+        bindings = [topic_binding("irc.a", "org.example.topic"), topic_binding("irc.a", "org.#")]
+        bindings += models.header_bindings("irc.a", "fedora_messaging_user_jcline", 10, False)
+        self.router.add("irc.a", bindings)
+        self.router.add("irc.b", [topic_binding("irc.b", "org.#")])
+        self.router.remove("irc.a")
+        self.router.remove("irc.unknown")
+        self.assertNotIn("irc.a", self.router)
+        self.assertEqual({"irc.b"}, self.router.route(make_message(user="jcline")))
+        self.assertEqual(
+            {"queues": 1, "header_keys": 0, "topics": 1, "routed": 1, "deliveries": 1},
+            self.router.stats(),
+        )
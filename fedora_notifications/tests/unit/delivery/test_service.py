@@ -0,0 +1,126 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.service`."""
+import uuid
+from unittest import mock
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from fedora_notifications import exceptions
+from fedora_notifications.db.queries import QueueRecord
+from fedora_notifications.delivery import database, service
+
+
+def record(name, changed=False):
+    bindings = [{"queue": name, "exchange": "amq.topic", "routing_key": name}]
+    return QueueRecord(
+        uuid.uuid4(), {"queue": name, "durable": True}, bindings, None, "fp-" + name, changed
+    )
+
+
+class FakeFactory(object):
+    def __init__(self):
+        self.bindings = []
+
+
+class DeclarationTests(unittest.SynchronousTestCase):
+    """Tests for how the queues loaded at startup are declared."""
+
+    def setUp(self):
+        self.service = service.DeliveryService.__new__(service.DeliveryService)
+        self.service._control_factory = mock.Mock()
+        self.factory = FakeFactory()
+        consumers = mock.Mock()
+        consumers.load.return_value = defer.succeed(None)
+        consumers.producer.return_value.factory = self.factory
+        self.service.consumers = {"email": consumers}
+        self.service._all_queues = {}
+        self.service.membership = None
+        self.service.spool = None
+        self.queues = [record("email.a"), record("email.b", changed=True), record("email.c")]
+        self.stored = {q.id: q.bindings for q in self.queues}
+        self.service.database = mock.Mock()
+        self.service.database.run.side_effect = self._run_callable
+        missing = mock.patch.object(
+            service.topology, "missing_queues", return_value=defer.succeed([])
+        )
+        self.missing_queues = missing.start()
+        self.addCleanup(missing.stop)
+
+    def _run_callable(self, func, *args):
+        if func is database.get_bindings:
+            return defer.succeed({i: self.stored[i] for i in args[0]})
+        return defer.succeed(None)
+
+    def test_declarations_never_passive(self):
+        rebind = {self.queues[1].id: self.queues[1].bindings}
+        arguments, bindings, applied = self.service._declarations(self.queues, rebind)
+        self.assertEqual([q.arguments for q in self.queues], arguments)
+        self.assertFalse(any("passive" in a for a in arguments))
+        self.assertEqual(self.queues[1].bindings, bindings)
+        self.assertEqual({self.queues[1].id: "fp-email.b"}, applied)
+
+    def test_missing_queue_rebound(self):
+        self.missing_queues.return_value = defer.succeed(["email.c"])
+        rebind = self.successResultOf(self.service._bindings_to_declare(self.queues))
+        self.assertEqual(
+            {q.id: q.bindings for q in self.queues[1:]},
+            rebind,
+        )
+
+    def test_existence_check_failed(self):
+        """If the broker can't be asked which queues exist, every queue is bound."""
+        self.missing_queues.return_value = defer.fail(RuntimeError("no channel"))
+        rebind = self.successResultOf(self.service._bindings_to_declare(self.queues))
+        self.assertEqual({q.id: q.bindings for q in self.queues}, rebind)
+
+    def test_consume_loaded(self):
+        self.service._all_queues = {"email": {"email.a", "email.b", "email.c"}}
+        self.service.consumers["email"].__contains__ = mock.Mock(return_value=False)
+        self.successResultOf(self.service._consume_loaded("email", self.queues))
+
+        arguments, bindings, _ = self.service.consumers["email"].load.call_args[0]
+        self.assertEqual([q.arguments for q in self.queues], arguments)
+        self.assertEqual(self.queues[1].bindings, bindings)
+        # The intact queues' bindings are declared again if the connection is lost
+        self.assertEqual(self.queues[0].bindings + self.queues[2].bindings, self.factory.bindings)
+        self.service.database.run.assert_any_call(
+            database.set_applied_topology, {self.queues[1].id: "fp-email.b"}
+        )
+
+    def test_remember_bindings_failed(self):
+        self.service.database.run.side_effect = lambda *a: defer.fail(RuntimeError("db down"))
+        self.successResultOf(self.service._remember_bindings(self.factory, [self.queues[0].id]))
+        self.assertEqual([], self.factory.bindings)
+
+
+class IrcDeliveryTests(unittest.SynchronousTestCase):
+    """Tests for how IRC deliveries are handed to the client."""
+
+    def setUp(self):
+        self.service = service.DeliveryService.__new__(service.DeliveryService)
+        self.service.render_cache = mock.Mock()
+        self.service.router = None
+        self.service.retrier = mock.Mock()
+        self.service.retrier.retry.side_effect = lambda *a, **kw: defer.succeed(None)
+        self.client = mock.Mock()
+        self.message = mock.Mock(queue="irc.jcline")
+
+    def test_delivered(self):
+        self.client.deliver.return_value = defer.succeed(None)
+        self.successResultOf(self.service._deliver_irc(self.client, self.message))
+        self.service.retrier.restore_topic.assert_called_once_with(self.message)
+        self.service.retrier.retry.assert_not_called()
+
+    def test_parked(self):
+        """A delivery to an offline nick is sent to the delayed retry queues."""
+        self.client.deliver.return_value = defer.fail(exceptions.RetryLater())
+        self.successResultOf(self.service._deliver_irc(self.client, self.message))
+        self.service.retrier.retry.assert_called_once_with(self.message, queue=None)
+
+    def test_park_failed(self):
+        self.client.deliver.return_value = defer.fail(exceptions.RetryLater())
+        self.service.retrier.retry.side_effect = lambda *a, **kw: defer.fail(RuntimeError())
+        self.failureResultOf(self.service._deliver_irc(self.client, self.message), service.Nack)
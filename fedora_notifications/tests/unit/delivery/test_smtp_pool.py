@@ -0,0 +1,331 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.smtp_pool`."""
+from twisted.internet import defer, error, task
+from twisted.mail import smtp
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from fedora_notifications.delivery import smtp_pool
+
+
+class Session(object):
+    """Play the server's side of a pooled connection."""
+
+    def __init__(self, reactor, index):
+        _, _, self.factory, _, _ = reactor.tcpClients[index]
+        self.client = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.client.makeConnection(self.transport)
+
+    def reply(self, line):
+        """Send a line to the client and return what it wrote in response."""
+        self.client.dataReceived(line + b"\r\n")
+        sent = self.transport.value()
+        self.transport.clear()
+        return sent
+
+    def handshake(self):
+        self.reply(b"220 smtp.example.com ESMTP")
+        return self.reply(b"250 smtp.example.com")
+
+    def accept(self):
+        """Accept the message the client has started; return the client's next line."""
+        self.reply(b"250 Sender OK")
+        self.reply(b"250 Recipient OK")
+        self.reply(b"354 Go ahead")
+        # The message is written by a producer, which the test transport doesn't run
+        while self.transport.producer is not None:
+            self.transport.producer.resumeProducing()
+        self.transport.clear()
+        return self.reply(b"250 Queued")
+
+    def lose(self):
+        self.client.connectionLost(failure.Failure(error.ConnectionLost()))
+
+
+class SMTPConnectionPoolTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.reactor = proto_helpers.MemoryReactorClock()
+        self.pool = smtp_pool.SMTPConnectionPool(
+            "smtp.example.com", size=2, idle_timeout=60, reactor=self.reactor
+        )
+
+    def send(self, to=b"user@example.com"):
+        return self.pool.send(b"notifications@example.com", [to], b"Subject: Hi\r\n\r\nHi\r\n")
+
+    def test_send(self):
+        d = self.send()
+        session = Session(self.reactor, 0)
+        self.assertEqual(b"MAIL FROM:<notifications@example.com>\r\n", session.handshake())
+        self.assertEqual(b"RSET\r\n", session.accept())
+        self.assertEqual(
+            (1, [(b"user@example.com", 250, b"Recipient OK")]), self.successResultOf(d)
+        )
+
+    def test_session_reused_after_rset(self):
+        first = self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        session.reply(b"250 Reset OK")
+        self.successResultOf(first)
+        self.assertEqual(
+            {"connections": 1, "idle": 1, "connecting": 0, "pending": 0}, self.pool.stats()
+        )
+
+        second = self.send(b"other@example.com")
+        self.assertEqual(b"MAIL FROM:<notifications@example.com>\r\n", session.transport.value())
+        session.transport.clear()
+        session.accept()
+        self.successResultOf(second)
+        self.assertEqual(1, len(self.reactor.tcpClients))
+
+    def test_pool_size_bounded(self):
+        sent = [self.send() for _ in range(3)]
+        self.assertEqual(2, len(self.reactor.tcpClients))
+        self.assertEqual(3, self.pool.stats()["pending"])
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        self.successResultOf(sent[0])
+        # Messages go to whichever session is free first, in order
+        self.assertEqual(
+            b"MAIL FROM:<notifications@example.com>\r\n", session.reply(b"250 Reset OK")
+        )
+        session.accept()
+        self.successResultOf(sent[1])
+        self.assertNoResult(sent[2])
+        self.assertEqual(2, len(self.reactor.tcpClients))
+
+    def test_rejected_message_keeps_session(self):
+        d = self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        self.assertEqual(b"RSET\r\n", session.reply(b"550 No such sender"))
+        self.failureResultOf(d, smtp.SMTPDeliveryError)
+        session.reply(b"250 Reset OK")
+        self.assertEqual(1, self.pool.stats()["idle"])
+        self.assertFalse(session.transport.disconnecting)
+
+    def test_connection_failed(self):
+        d = self.send()
+        _, _, factory, _, _ = self.reactor.tcpClients[0]
+        factory.clientConnectionFailed(None, failure.Failure(error.ConnectionRefusedError()))
+        self.failureResultOf(d, error.ConnectionRefusedError)
+        self.assertEqual(
+            {"connections": 0, "idle": 0, "connecting": 0, "pending": 0}, self.pool.stats()
+        )
+
+    def test_lost_idle_session_replaced(self):
+        self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        session.reply(b"250 Reset OK")
+        session.lose()
+        self.assertEqual(0, self.pool.stats()["connections"])
+
+        d = self.send()
+        self.assertEqual(2, len(self.reactor.tcpClients))
+        replacement = Session(self.reactor, 1)
+        replacement.handshake()
+        replacement.accept()
+        self.successResultOf(d)
+
+    def test_idle_timeout(self):
+        self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        session.reply(b"250 Reset OK")
+        self.reactor.advance(60)
+        self.assertEqual(b"QUIT\r\n", session.transport.value())
+
+    def test_health_check(self):
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+        self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        session.reply(b"250 Reset OK")
+        session.transport.clear()
+
+        self.reactor.advance(self.pool.health_check_interval)
+        self.assertEqual(b"NOOP\r\n", session.transport.value())
+        session.transport.clear()
+        session.reply(b"250 OK")
+        self.assertEqual(1, self.pool.stats()["idle"])
+
+        self.reactor.advance(self.pool.health_check_interval)
+        session.reply(b"421 Closing")
+        self.assertTrue(session.transport.disconnecting)
+
+    def test_probe(self):
+        d = self.pool.probe()
+        self.assertNoResult(d)
+        Session(self.reactor, 0).handshake()
+        self.successResultOf(d)
+        self.assertEqual(
+            {"connections": 1, "idle": 1, "connecting": 0, "pending": 0}, self.pool.stats()
+        )
+        self.successResultOf(self.pool.probe())
+
+    def test_stop_fails_pending(self):
+        sent = [self.send() for _ in range(3)]
+        self.pool.stop()
+        for d in sent:
+            self.failureResultOf(d, error.ConnectionClosed)
+
+    def test_lost_session_retried_on_new_connection(self):
+        self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        session.reply(b"250 Reset OK")
+
+        d = self.send()
+        session.reply(b"250 Sender OK")
+        session.lose()
+        self.assertNoResult(d)
+        self.assertEqual(2, len(self.reactor.tcpClients))
+
+        retry = Session(self.reactor, 1)
+        self.assertEqual(b"MAIL FROM:<notifications@example.com>\r\n", retry.handshake())
+        self.assertEqual(b"RSET\r\n", retry.accept())
+        self.successResultOf(d)
+        retry.reply(b"250 Reset OK")
+        self.assertEqual(
+            {"connections": 1, "idle": 1, "connecting": 0, "pending": 0}, self.pool.stats()
+        )
+
+    def test_lost_session_retried_once(self):
+        self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        session.reply(b"250 Reset OK")
+
+        d = self.send()
+        session.lose()
+        retry = Session(self.reactor, 1)
+        retry.handshake()
+        retry.reply(b"250 Sender OK")
+        retry.lose()
+        self.failureResultOf(d, smtp_pool.SessionLost)
+        self.assertEqual(2, len(self.reactor.tcpClients))
+
+    def test_lost_session_retry_unable_to_connect(self):
+        self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        session.reply(b"250 Reset OK")
+
+        d = self.send()
+        session.lose()
+        _, _, factory, _, _ = self.reactor.tcpClients[1]
+        factory.clientConnectionFailed(None, failure.Failure(error.ConnectionRefusedError()))
+        self.failureResultOf(d, error.ConnectionRefusedError)
+
+    def test_retry_handshake_failed(self):
+        self.send()
+        session = Session(self.reactor, 0)
+        session.handshake()
+        session.accept()
+        session.reply(b"250 Reset OK")
+
+        d = self.send()
+        session.lose()
+        retry = Session(self.reactor, 1)
+        retry.reply(b"220 smtp.example.com ESMTP")
+        retry.lose()
+        failed = self.failureResultOf(d, error.ConnectionLost)
+        self.assertNotIsInstance(failed.value, smtp_pool.SessionLost)
+
+
+class FakePool(object):
+    """A connection pool whose sends are completed by the test."""
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.port = 25
+        self.sent = []
+
+    def send(self, from_addr, to_addrs, data):
+        d = defer.Deferred()
+        self.sent.append(d)
+        return d
+
+    def stats(self):
+        return {}
+
+
+class SMTPRelayPoolTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.relays = [
+            smtp_pool.SMTPRelay(FakePool("a.example.com"), weight=2),
+            smtp_pool.SMTPRelay(FakePool("b.example.com")),
+        ]
+        self.pool = smtp_pool.SMTPRelayPool(self.relays, retry_interval=30, reactor=self.clock)
+        self.a, self.b = (relay.pool for relay in self.relays)
+
+    def send(self):
+        return self.pool.send(b"notifications@example.com", [b"user@example.com"], b"Hi")
+
+    def test_weighted_least_in_flight(self):
+        for _ in range(6):
+            self.send()
+        self.assertEqual((4, 2), (len(self.a.sent), len(self.b.sent)))
+        self.assertEqual((4, 2), (self.relays[0].in_flight, self.relays[1].in_flight))
+
+    def test_round_robin_when_idle(self):
+        self.relays[0].weight = 1
+        for _ in range(4):
+            self.send()
+            for d in self.a.sent + self.b.sent:
+                if not d.called:
+                    d.callback((1, []))
+        self.assertEqual((2, 2), (len(self.a.sent), len(self.b.sent)))
+        self.assertEqual(2, self.relays[0].sent)
+
+    def test_unreachable_relay_taken_out_of_rotation(self):
+        d = self.send()
+        self.a.sent[0].errback(error.ConnectionRefusedError())
+        self.b.sent[0].callback((1, []))
+        self.successResultOf(d)
+        self.assertEqual(1, self.relays[0].failed)
+        self.assertFalse(self.pool.stats()["a.example.com:25"]["up"])
+
+        self.send()
+        self.assertEqual(2, len(self.b.sent))
+        self.clock.advance(30)
+        self.send()
+        self.assertEqual(2, len(self.a.sent))
+
+    def test_lost_session_fails_over_without_marking_relay_down(self):
+        d = self.send()
+        self.a.sent[0].errback(smtp_pool.SessionLost())
+        self.b.sent[0].callback((1, []))
+        self.successResultOf(d)
+        self.assertEqual(0, self.relays[0].failed)
+        self.assertTrue(self.pool.stats()["a.example.com:25"]["up"])
+
+    def test_refused_message_not_failed_over(self):
+        d = self.send()
+        self.a.sent[0].errback(smtp.SMTPDeliveryError(550, b"No such user"))
+        self.failureResultOf(d, smtp.SMTPDeliveryError)
+        self.assertEqual([], self.b.sent)
+        self.assertEqual(1, self.relays[0].sent)
+        self.assertEqual(0, self.relays[0].failed)
+
+    def test_no_relay_available(self):
+        d = self.send()
+        self.a.sent[0].errback(error.ConnectionRefusedError())
+        self.b.sent[0].errback(error.DNSLookupError())
+        self.failureResultOf(d, error.ConnectError)
+        self.failureResultOf(self.send(), error.ConnectError)
@@ -0,0 +1,256 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.spool`."""
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from fedora_messaging import exceptions as fml_exceptions, message
+from twisted.internet import defer, task
+from twisted.mail import smtp
+from twisted.trial import unittest
+
+from fedora_notifications.delivery import spool
+
+
+def make_message(index, queue="irc.jcline"):
+    msg = message.Message(topic="org.example.topic", body={"index": index})
+    msg.queue = queue
+    return msg
+
+
+class SpoolTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.delivered = []
+        self.dispatch = mock.Mock(side_effect=self._dispatch)
+        self.dead_letter = mock.Mock(return_value=None)
+        # Run the fsyncs synchronously rather than in the reactor's thread pool
+        threads = mock.patch.object(spool.threads, "deferToThread", side_effect=defer.maybeDeferred)
+        self.fsync = threads.start()
+        self.addCleanup(threads.stop)
+        self.spool = self.open()
+
+    def _dispatch(self, msg):
+        self.delivered.append(msg._body["index"])
+
+    def open(self, **kwargs):
+        kwargs.setdefault("segment_size", 1024)
+        kwargs.setdefault("max_attempts", 3)
+        s = spool.Spool(
+            self.directory,
+            self.dispatch,
+            sync_interval=0.05,
+            retry_interval=30,
+            dead_letter=self.dead_letter,
+            reactor=self.clock,
+            **kwargs,
+        )
+        s.start()
+        self.addCleanup(self.close, s)
+        return s
+
+    def close(self, s):
+        if s._running:
+            self.successResultOf(s.stop())
+
+    def crash(self, s):
+        """Stop a spool the way an unclean shutdown would: nothing is flushed."""
+        s._running = False
+        s._checkpoint.stop()
+        if s._sync_call is not None and s._sync_call.active():
+            s._sync_call.cancel()
+        os.close(s._write_fd)
+        s._unmap()
+
+    def append(self, *indexes):
+        deferreds = [self.spool.append(make_message(i)) for i in indexes]
+        self.clock.advance(self.spool.sync_interval)
+        for d in deferreds:
+            self.successResultOf(d)
+
+    def test_append_synced_together(self):
+        first = self.spool.append(make_message(0))
+        second = self.spool.append(make_message(1))
+        self.assertNoResult(first)
+        self.assertEqual([], self.delivered)
+
+        self.clock.advance(self.spool.sync_interval)
+        self.successResultOf(first)
+        self.successResultOf(second)
+        self.assertEqual(1, self.fsync.call_count)
+        self.assertEqual([0, 1], self.delivered)
+        self.assertEqual("irc.jcline", self.dispatch.call_args[0][0].queue)
+
+    def test_append_closed(self):
+        self.successResultOf(self.spool.stop())
+        self.failureResultOf(self.spool.append(make_message(0)), RuntimeError)
+
+    def test_in_flight_limit(self):
+        self.successResultOf(self.spool.stop())
+        pending = []
+        self.dispatch.side_effect = lambda msg: pending.append(defer.Deferred()) or pending[-1]
+        self.spool = self.open(max_in_flight=2)
+        self.append(0, 1, 2)
+        self.assertEqual(2, len(pending))
+        pending[0].callback(None)
+        self.assertEqual(3, len(pending))
+        self.assertEqual(2, self.spool.stats()["in_flight"])
+
+    def test_cursor_replay(self):
+        """Records after the checkpointed cursor are delivered again after a crash."""
+        self.successResultOf(self.spool.stop())
+        pending = []
+        self.dispatch.side_effect = lambda msg: pending.append(defer.Deferred()) or pending[-1]
+        self.spool = self.open()
+        self.append(0, 1, 2)
+        pending[0].callback(None)
+        pending[2].callback(None)
+        # The cursor can't move past the second message until it's delivered
+        self.clock.advance(spool._CHECKPOINT_INTERVAL)
+        self.crash(self.spool)
+
+        self.dispatch.side_effect = self._dispatch
+        self.spool = self.open()
+        self.assertEqual([1, 2], self.delivered)
+
+    def test_clean_restart(self):
+        self.append(0, 1)
+        self.successResultOf(self.spool.stop())
+        self.spool = self.open()
+        self.append(2)
+        self.assertEqual([0, 1, 2], self.delivered)
+
+    def test_crash_recovery(self):
+        """A record that was partly written when the service crashed is discarded."""
+        self.successResultOf(self.spool.stop())
+        self.dispatch.side_effect = lambda msg: defer.Deferred()
+        self.spool = self.open()
+        self.append(0, 1)
+        path = self.spool._path(self.spool._write_seq)
+        self.crash(self.spool)
+        size = os.path.getsize(path)
+        with open(path, "ab") as f:
+            f.write(spool._HEADER.pack(100, 0) + b"{")
+
+        self.dispatch.side_effect = self._dispatch
+        self.spool = self.open()
+        self.assertEqual(size, os.path.getsize(path))
+        self.assertEqual([0, 1], self.delivered)
+        self.append(2)
+        self.assertEqual([0, 1, 2], self.delivered)
+
+    def test_corrupt_record_skipped(self):
+        """A corrupt record before the last segment is skipped rather than truncated."""
+        self.successResultOf(self.spool.stop())
+        self.dispatch.side_effect = lambda msg: defer.Deferred()
+        # Put each record in a segment of its own
+        self.spool = self.open(segment_size=1)
+        self.append(0, 1)
+        path = self.spool._path(self.spool._write_seq - 1)
+        self.crash(self.spool)
+        with open(path, "r+b") as f:
+            f.seek(spool._HEADER.size + 2)
+            f.write(b"X")
+
+        self.dispatch.side_effect = self._dispatch
+        self.spool = self.open()
+        self.assertEqual([1], self.delivered)
+
+    def test_segments_rolled_and_deleted(self):
+        self.append(*range(20))
+        self.assertEqual(list(range(20)), self.delivered)
+        segments = self.spool._segments()
+        self.assertTrue(len(segments) > 1)
+        self.clock.advance(spool._CHECKPOINT_INTERVAL)
+        self.assertEqual(segments[-1:], self.spool._segments())
+        self.assertEqual(1, self.spool.stats()["segments"])
+
+    def test_failure_respooled(self):
+        self.dispatch.side_effect = [fml_exceptions.Nack(), None]
+        self.append(0)
+        self.assertTrue(self.spool.stats()["paused"])
+        self.assertEqual(1, self.dispatch.call_count)
+
+        self.clock.advance(self.spool.sync_interval)
+        self.clock.advance(self.spool.retry_interval)
+        self.assertEqual(2, self.dispatch.call_count)
+        self.assertEqual(
+            {
+                "appended": 2,
+                "delivered": 1,
+                "dropped": 0,
+                "dead_lettered": 0,
+                "in_flight": 0,
+                "segments": 1,
+                "paused": False,
+            },
+            self.spool.stats(),
+        )
+
+    def test_attempts_survive_restart(self):
+        self.dispatch.side_effect = fml_exceptions.Nack()
+        self.append(0)
+        self.clock.advance(self.spool.sync_interval)
+        self.successResultOf(self.spool.stop())
+
+        self.spool = self.open()
+        self.clock.advance(self.spool.sync_interval)
+        self.assertEqual(2, self.dispatch.call_count)
+        self.clock.advance(self.spool.retry_interval)
+        self.assertEqual(3, self.dispatch.call_count)
+        self.dead_letter.assert_called_once_with(self.dispatch.call_args[0][0])
+        self.assertEqual(1, self.spool.stats()["dead_lettered"])
+
+    def test_dead_lettered_after_max_attempts(self):
+        self.dispatch.side_effect = ValueError("Oops")
+        self.append(0)
+        for _ in range(self.spool.max_attempts):
+            self.clock.advance(self.spool.sync_interval)
+            self.clock.advance(self.spool.retry_interval)
+        self.assertEqual(3, self.dispatch.call_count)
+        self.assertEqual(1, self.dead_letter.call_count)
+        self.assertEqual(3, self.spool.stats()["appended"])
+
+        # The poison message no longer holds up the cursor
+        self.dispatch.side_effect = self._dispatch
+        self.append(1)
+        self.assertEqual([1], self.delivered)
+        self.assertEqual(self.spool._durable, self.spool._cursor)
+
+    def test_permanent_failure_dead_lettered(self):
+        self.dispatch.side_effect = smtp.SMTPDeliveryError(550, b"No such user")
+        self.append(0)
+        self.assertEqual(1, self.dead_letter.call_count)
+        self.assertFalse(self.spool.stats()["paused"])
+        self.assertEqual(1, self.spool.stats()["appended"])
+
+    def test_temporary_smtp_failure_respooled(self):
+        self.dispatch.side_effect = smtp.SMTPDeliveryError(451, b"Try again later")
+        self.append(0)
+        self.dead_letter.assert_not_called()
+        self.assertTrue(self.spool.stats()["paused"])
+
+    def test_dead_letter_failure_drops(self):
+        self.dispatch.side_effect = smtp.SMTPDeliveryError(550, b"No such user")
+        self.dead_letter.side_effect = fml_exceptions.ConnectionException(reason="down")
+        self.append(0)
+        self.assertEqual(1, self.spool.stats()["dropped"])
+        self.assertEqual(self.spool._durable, self.spool._cursor)
+
+    def test_no_dead_letter_drops(self):
+        self.spool.dead_letter = None
+        self.dispatch.side_effect = smtp.SMTPDeliveryError(550, b"No such user")
+        self.append(0)
+        self.assertEqual(1, self.spool.stats()["dropped"])
+
+    def test_drop(self):
+        self.dispatch.side_effect = fml_exceptions.Drop()
+        self.append(0)
+        self.assertEqual(1, self.spool.stats()["dropped"])
+        self.dead_letter.assert_not_called()
+        self.assertFalse(self.spool.stats()["paused"])
@@ -0,0 +1,167 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.delivery.throttle`."""
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from fedora_notifications.delivery import throttle
+
+
+class TokenBucketTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bucket = throttle.TokenBucket(4, 2, self.clock)
+
+    def test_burst(self):
+        for _ in range(4):
+            self.assertEqual(0, self.bucket.delay(1))
+            self.bucket.consume(1)
+        self.assertEqual(0.5, self.bucket.delay(1))
+
+    def test_refill(self):
+        self.bucket.consume(4)
+        self.clock.advance(1)
+        self.assertEqual(1, self.bucket.delay(4))
+        self.clock.advance(10)
+        self.assertEqual(0, self.bucket.delay(4))
+        self.assertEqual(4, self.bucket.tokens)
+
+    def test_cost_over_capacity(self):
+        """Something costing more than the bucket holds waits for a full bucket."""
+        self.assertEqual(0, self.bucket.delay(10))
+        self.bucket.consume(10)
+        self.assertEqual(3.5, self.bucket.delay(1))
+
+
+class FairSendQueueTests(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.queue = throttle.FairSendQueue(
+            self.sent.append, burst=2, rate=1, byte_cost=0, clock=self.clock
+        )
+
+    def test_burst_then_rate(self):
+        for i in range(4):
+            self.queue.put("PRIVMSG jcline :{}".format(i), "jcline")
+        self.assertEqual(2, len(self.sent))
+        self.assertEqual(2, self.queue.stats()["queued"])
+        self.clock.advance(1)
+        self.assertEqual(3, len(self.sent))
+        self.clock.advance(1)
+        self.assertEqual(4, len(self.sent))
+        self.assertEqual(0, self.queue.depth)
+
+    def test_round_robin(self):
+        self.queue.bucket.tokens = 0
+        for i in range(3):
+            self.queue.put("a{}".format(i), "a")
+        self.queue.put("b0", "b")
+        self.queue.put("c0", "c")
+        self.queue.put("b1", "b")
+        self.assertEqual(3, self.queue.stats()["destinations"])
+        self.clock.pump([1] * 6)
+        self.assertEqual(["a0", "b0", "c0", "a1", "b1", "a2"], self.sent)
+
+    def test_priority_first(self):
+        self.queue.bucket.tokens = 0
+        self.queue.put("a0", "a")
+        self.queue.put("b0", "b")
+        self.queue.put("PONG :server")
+        self.clock.pump([1] * 3)
+        self.assertEqual(["PONG :server", "a0", "b0"], self.sent)
+
+    def test_byte_cost(self):
+        queue = throttle.FairSendQueue(
+            self.sent.append, burst=2, rate=1, byte_cost=0.1, clock=self.clock
+        )
+        queue.put("x" * 10, "a")
+        queue.put("y", "a")
+        self.assertEqual(["x" * 10], self.sent)
+        self.clock.advance(1)
+        self.assertEqual(["x" * 10], self.sent)
+        self.clock.advance(0.1)
+        self.assertEqual(["x" * 10, "y"], self.sent)
+
+    def test_tracked(self):
+        self.queue.bucket.tokens = 0
+        d = self.queue.put("a0", "a", track=True)
+        self.assertIsNone(self.queue.put("a1", "a"))
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.successResultOf(d)
+        self.assertEqual(1.0, self.queue.time_to_wire / throttle._TIME_TO_WIRE_SMOOTHING)
+
+    def test_clear(self):
+        self.queue.bucket.tokens = 0
+        tracked = [self.queue.put("a", "a", track=True), self.queue.put("PING", track=True)]
+        self.queue.clear(failure.Failure(error.ConnectionLost()))
+        for d in tracked:
+            self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual(0, self.queue.stats()["queued"])
+        self.clock.advance(10)
+        self.assertEqual([], self.sent)
+
+    def test_several_destinations(self):
+        """A line to several destinations takes a turn from each of them."""
+        self.queue.bucket.tokens = 0
+        self.queue.put("a0", "a")
+        self.queue.put("b0", "b")
+        self.queue.put("ab", ("a", "b"))
+        self.queue.put("c0", "c")
+        self.assertEqual(4, self.queue.depth)
+        self.clock.pump([1] * 4)
+        self.assertEqual(["a0", "b0", "c0", "ab"], self.sent)
+        self.assertEqual(0, self.queue.depth)
+        self.assertEqual(0, self.queue.stats()["destinations"])
+
+    def test_several_destinations_in_order(self):
+        """A line to several destinations waits for the lines queued before it."""
+        self.queue.bucket.tokens = 0
+        self.queue.put("a0", "a")
+        self.queue.put("a1", "a")
+        self.queue.put("ab", ("a", "b"))
+        self.queue.put("b1", "b")
+        self.clock.pump([1] * 4)
+        self.assertEqual(["a0", "a1", "ab", "b1"], self.sent)
+
+    def test_clear_several_destinations(self):
+        self.queue.bucket.tokens = 0
+        d = self.queue.put("ab", ("a", "b"), track=True)
+        self.queue.clear(failure.Failure(error.ConnectionLost()))
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual(0, self.queue.depth)
+
+    def test_put_while_sending(self):
+        """Lines queued by a tracked line's callback don't start a second pump."""
+        self.queue.bucket.tokens = 1
+        d = self.queue.put("a0", "a", track=True)
+        self.queue.put("a1", "a")
+        self.assertEqual(["a0"], self.sent)
+        d.addCallback(lambda _: self.queue.put("b0", "b"))
+        self.clock.advance(1)
+        self.assertEqual(["a0", "a1"], self.sent)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.clock.advance(1)
+        self.assertEqual(["a0", "a1", "b0"], self.sent)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_put_from_send(self):
+        sent = []
+
+        def send(line):
+            sent.append(line)
+            if line == "a0":
+                queue.put("b0", "b")
+
+        queue = throttle.FairSendQueue(send, burst=1, rate=1, byte_cost=0, clock=self.clock)
+        d = queue.put("a0", "a", track=True)
+        d.addCallback(lambda _: queue.put("c0", "c"))
+        self.assertEqual(["a0"], sent)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.clock.pump([1, 1])
+        self.assertEqual(["a0", "b0", "c0"], sent)
+        self.assertEqual([], self.clock.getDelayedCalls())
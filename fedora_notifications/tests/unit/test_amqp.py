@@ -0,0 +1,39 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright (C) 2018 Red Hat, Inc.
+"""Tests for :mod:`fedora_notifications.amqp`."""
+from unittest import mock
+
+from fedora_notifications import amqp, config, db, exceptions
+from fedora_notifications.tests.unit.base import DatabaseTestCase
+
+
+class CheckExchangeModeTests(DatabaseTestCase):
+    def set_mode(self, tiered):
+        patcher = mock.patch.dict(config.conf, {"SEVERITY_EXCHANGES": tiered})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def applied(self):
+        return db.Session().query(db.AppliedTopology.severity_exchanges).scalar()
+
+    def test_recorded_the_first_time(self):
+        self.set_mode(True)
+        amqp.check_exchange_mode()
+        self.assertTrue(self.applied())
+
+    def test_matches(self):
+        db.Session.add(db.AppliedTopology(id=1, severity_exchanges=False))
+        db.Session.commit()
+        self.set_mode(False)
+        amqp.check_exchange_mode()
+        self.assertFalse(self.applied())
+
+    def test_changed_without_converting(self):
+        db.Session.add(db.AppliedTopology(id=1, severity_exchanges=False))
+        db.Session.commit()
+        self.set_mode(True)
+        with self.assertRaises(exceptions.ConfigurationError) as cm:
+            amqp.check_exchange_mode()
+        self.assertIn("convert-bindings", str(cm.exception))
+        self.assertFalse(self.applied())
@@ -68,7 +68,8 @@ class QueueResource(flask_restful.Resource):
                          are no projects, this will return 200.
         :statuscode 400: If one or more of the query arguments is invalid.
         """
-        queues = db.Queue.query.all()
+        with db.replica():
+            queues = db.Queue.query.summaries()
         return {
             'items': [
                 {
@@ -86,6 +86,7 @@ setup(
         "fedora.messages": [
             "fn_queue_deleted=fedora_notifications.messages:QueueDeleted",
             "fn_queue_created=fedora_notifications.messages:QueueCreated",
+            "fn_queue_updated=fedora_notifications.messages:QueueUpdated",
         ],
     },
 )